@@ -8,11 +8,11 @@ from django.db import models, transaction, IntegrityError
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.utils import timezone
-import django.db
 
 from phone_auth.models import PhoneNumber, PhoneNumberLinkCode
 from photos.models import Album
 from photos import photo_operations
+from photos import worker_pool
 
 
 class Organization(models.Model):
@@ -77,31 +77,16 @@ class EventManager(models.Manager):
 
             now = timezone.now()
 
-            class CreateAlbumAction(photo_operations.ExThread):
-                def run_with_exception(self):
-                    try:
-                        self.perform_action()
-                    finally:
-                        django.db.close_old_connections()
-
-                def perform_action(self):
-                    with transaction.atomic():
-                        self.new_album = Album.objects.create_album(mazaltov_album.creator, mazaltov_album.name, now)
-                        with self.new_album.modify(now) as m:
-                            m.add_user_id(mazaltov_album.creator, user.id)
-
-            action = CreateAlbumAction()
-            # TODO This is only current needed to make tests work with sqlite
-            # See this bug:
-            #     https://code.djangoproject.com/ticket/12118
-            if settings.USING_LOCAL_PHOTOS:
-                action.perform_action()
-            else:
-                action.daemon = False
-                action.start()
-                action.join_with_exception()
+            def create_album():
+                with transaction.atomic():
+                    new_album = Album.objects.create_album(mazaltov_album.creator, mazaltov_album.name, now)
+                    with new_album.modify(now) as m:
+                        m.add_user_id(mazaltov_album.creator, user.id)
+                return new_album
+
+            new_album = worker_pool.run_action(create_album)
 
-            photo_operations.copy_photos_to_album(mazaltov_album.creator, photo_ids, action.new_album.id, now)
+            photo_operations.copy_photos_to_album(mazaltov_album.creator, photo_ids, new_album.id, now)
 
 
 class Event(models.Model):
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from phone_auth.models import User
+
+
+class Command(BaseCommand):
+    help = 'Recalculate the invite status of all of the users from their phone numbers and link codes'
+
+    def handle(self, *args, **options):
+        num_fixed = User.objects.rebuild_invite_statuses()
+        self.stdout.write('Fixed the invite status of %d users' % num_fixed)
@@ -1,6 +1,6 @@
 import collections
 import random
-from phone_auth.signals import user_avatar_changed
+from phone_auth.signals import user_avatar_changed, user_invite_status_changed
 import re
 import os
 import string
@@ -9,7 +9,7 @@ import django.contrib.auth.models
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
-from django.db import models, IntegrityError
+from django.db import connection, models, IntegrityError
 from django.utils import crypto
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
@@ -81,6 +81,55 @@ class UserManager(django.contrib.auth.models.BaseUserManager):
     def make_default_nickname(self):
         return 'noname'
 
+    def advance_invite_status(self, user_id, invite_status):
+        """
+        Sets the `invite_status' of the user, unless it is already the same or
+        further along (see `User.INVITE_STATUS_ORDER').
+
+        Returns True if the status changed
+        """
+        earlier_statuses = User.INVITE_STATUS_ORDER[:User.INVITE_STATUS_ORDER.index(invite_status)]
+        if not earlier_statuses:
+            return False
+        num_updated = self.filter(id=user_id, invite_status__in=earlier_statuses).update(invite_status=invite_status)
+        if num_updated == 0:
+            return False
+        user_invite_status_changed.send(sender=self.model, user_id=user_id, invite_status=invite_status)
+        return True
+
+    def rebuild_invite_statuses(self):
+        """
+        Recalculates the `invite_status' of all of the users from their phone
+        numbers and link codes.
+
+        Returns the number of users whose status was wrong
+        """
+        cursor = connection.cursor()
+        cursor.execute(
+            """
+            SELECT u.id,
+                   u.invite_status,
+                   MAX(CASE WHEN pn.verified THEN 2
+                            WHEN lc.was_visited THEN 1
+                            ELSE 0
+                       END)
+            FROM phone_auth_user u
+            LEFT OUTER JOIN phone_auth_phonenumber pn
+            ON pn.user_id=u.id
+            LEFT OUTER JOIN phone_auth_phonenumberlinkcode lc
+            ON lc.phone_number_id=pn.id
+            GROUP BY u.id, u.invite_status
+            """)
+
+        num_fixed = 0
+        for user_id, invite_status, level in cursor.fetchall():
+            correct_status = User.INVITE_STATUS_ORDER[level or 0]
+            if invite_status != correct_status:
+                self.filter(id=user_id).update(invite_status=correct_status)
+                user_invite_status_changed.send(sender=self.model, user_id=user_id, invite_status=correct_status)
+                num_fixed += 1
+        return num_fixed
+
     def create_superuser(self, id, nickname, password):
         # The given id is ignored
         user = self.create_user(
@@ -97,6 +146,13 @@ class User(django.contrib.auth.models.AbstractBaseUser, django.contrib.auth.mode
     STATUS_JOINED = 'joined'
     STATUS_SMS_SENT = 'sms_sent'
     STATUS_INVITATION_VIEWED = 'invitation_viewed'
+    # A user's status only moves forward in this order
+    INVITE_STATUS_ORDER = (STATUS_SMS_SENT, STATUS_INVITATION_VIEWED, STATUS_JOINED)
+    INVITE_STATUS_CHOICES = (
+        (STATUS_SMS_SENT, 'SMS sent'),
+        (STATUS_INVITATION_VIEWED, 'Invitation viewed'),
+        (STATUS_JOINED, 'Joined'),
+    )
 
     id = models.IntegerField(primary_key=True)
     nickname = models.CharField(max_length=128)
@@ -124,6 +180,19 @@ class User(django.contrib.auth.models.AbstractBaseUser, django.contrib.auth.mode
 
     user_glance_score = models.IntegerField(default=25)
 
+    # The last time that the list of albums of the user (GET /albums/) could
+    # have changed, because of the user's membership in one of the albums
+    # (joining, leaving, viewing, hiding a photo), or a revision of one of
+    # the albums that changes the list (all but photo updates). See
+    # photos.models.touch_album_lists
+    album_list_last_changed = models.DateTimeField(null=True, blank=True)
+
+    # Denormalized from the user's phone numbers and link codes, so that the
+    # members of an album can be listed without looking at them. Kept up to
+    # date by `update_invite_status_from_phone_number' and
+    # `update_invite_status_from_link_code'
+    invite_status = models.CharField(max_length=32, choices=INVITE_STATUS_CHOICES, default=STATUS_SMS_SENT)
+
     # hidden_photos = models.CharField(default='{}',)
 
     objects = UserManager()
@@ -147,16 +216,7 @@ class User(django.contrib.auth.models.AbstractBaseUser, django.contrib.auth.mode
         super(User, self).save(*args, **kwargs)
 
     def get_invite_status(self):
-        query = self.phonenumber_set.filter(verified=True)
-        if query.count() > 0:
-            return User.STATUS_JOINED
-        else:
-            query = PhoneNumberLinkCode.objects.filter(
-                phone_number__in=self.phonenumber_set.all())
-            for link_code in query:
-                if link_code.was_visited:
-                    return User.STATUS_INVITATION_VIEWED
-            return User.STATUS_SMS_SENT
+        return self.invite_status
 
     def get_full_name(self):
         return self.nickname
@@ -534,3 +594,19 @@ def update_anonymous_phone_number_avatar(sender, **kwargs):
             phone_contact.anonymous_phone_number.save()
 
 user_avatar_changed.connect(update_anonymous_phone_number_avatar)
+
+def update_invite_status_from_phone_number(sender, instance, raw=False, **kwargs):
+    # Called when a phone number is confirmed (`confirm_phone_number' and
+    # `app_init')
+    if not raw and instance.verified:
+        User.objects.advance_invite_status(instance.user_id, User.STATUS_JOINED)
+
+models.signals.post_save.connect(update_invite_status_from_phone_number, sender=PhoneNumber)
+
+def update_invite_status_from_link_code(sender, instance, raw=False, **kwargs):
+    # Called when the invite page is visited
+    if not raw and instance.was_visited:
+        user_id = PhoneNumber.objects.filter(pk=instance.phone_number_id).values_list('user_id', flat=True).get()
+        User.objects.advance_invite_status(user_id, User.STATUS_INVITATION_VIEWED)
+
+models.signals.post_save.connect(update_invite_status_from_link_code, sender=PhoneNumberLinkCode)
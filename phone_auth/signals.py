@@ -1,3 +1,8 @@
 from django.dispatch import Signal
 
 user_avatar_changed = Signal(providing_args=["user"])
+
+user_nickname_changed = Signal(providing_args=["user"])
+
+# Sent when `User.invite_status' advances
+user_invite_status_changed = Signal(providing_args=["user_id", "invite_status"])
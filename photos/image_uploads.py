@@ -6,7 +6,13 @@ from PIL import ImageOps
 from django.conf import settings
 from django.utils import timezone
 
+import hashlib
+import multiprocessing
 import os, errno
+import select
+import threading
+import time
+import traceback
 
 class ImageDimensions(object):
     __metaclass__ = abc.ABCMeta
@@ -102,31 +108,62 @@ image_sizes = {
         '940x570': BoxFitConstrainOnlyShrink(940, 570)
         }
 
-def photo_is_processed(storage_id):
-    # Check that the original file exists
-    img_file_path = os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, storage_id + '.jpg')
-    if not os.path.isfile(img_file_path):
-        return False
-
-    # Check that all the processed resized images exist
-    for image_size_str in image_sizes.iterkeys():
-        resized_img_file_path = os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, storage_id + '_' + image_size_str + '.jpg')
-        if not os.path.isfile(resized_img_file_path):
-            return False
-
-    return True
-
-"""
-Takes into account EXIF Orientation metadata
-"""
-def load_image_correct_orientation(img_file_path):
-    # Values for the "Orientation" tag from the EXIF Standard
-    # See <http://www.sno.phy.queensu.ca/~phil/exiftool/TagNames/EXIF.html>
-    EXIF_ORIENTATION_DEGREES = {
-            3 : 180, # Rotated 180
-            6 : 270, # Rotated 90 CW
-            8 : 90 } # Rotated 90 CCW
+# Increment this whenever the way that the resized images are rendered
+# changes, so that all photos will be considered as needing to be processed
+# again. Changes to `image_sizes' are detected automatically (see
+# `get_image_sizes_version')
+IMAGE_PROCESSING_VERSION = 1
+
+def get_image_sizes_version():
+    """
+    Returns a short string that identifies the current `image_sizes'
+    configuration and IMAGE_PROCESSING_VERSION. This is recorded in the
+    manifest of each processed photo
+    """
+    h = hashlib.sha1(str(IMAGE_PROCESSING_VERSION))
+    for image_size_str in sorted(image_sizes.iterkeys()):
+        d = image_sizes[image_size_str]
+        h.update(repr((image_size_str,
+            [klass.__name__ for klass in type(d).__mro__],
+            sorted(vars(d).items()))))
+    return h.hexdigest()[:16]
+
+def get_eager_image_size_strs():
+    """
+    Returns the `image_sizes' that are created when a photo is uploaded. When
+    `settings.PHOTO_PROCESSING_LAZY' is set, this is only the hot set, and the
+    rest are rendered on demand (see `photos.render_cache')
+    """
+    if settings.PHOTO_PROCESSING_LAZY:
+        return settings.PHOTO_PROCESSING_HOT_SIZES
+    else:
+        return image_sizes.keys()
 
+def photo_is_processed(storage_id):
+    """
+    Answered from the processing manifest (see `ProcessedImageManifest'),
+    without touching the filesystem. For many photos at once use
+    `ProcessedImageManifest.objects.get_missing_image_sizes'
+    """
+    from photos.models import ProcessedImageManifest
+
+    return not ProcessedImageManifest.objects.get_missing_image_sizes([storage_id])[storage_id]
+
+# Values for the "Orientation" tag from the EXIF Standard, mapped to the
+# transpose operation that brings the image to its upright orientation
+# See <http://www.sno.phy.queensu.ca/~phil/exiftool/TagNames/EXIF.html>
+EXIF_ORIENTATION_TRANSPOSE = {
+        3 : Image.ROTATE_180, # Rotated 180
+        6 : Image.ROTATE_270, # Rotated 90 CW
+        8 : Image.ROTATE_90 } # Rotated 90 CCW
+
+def open_image_orientation(img_file_path):
+    """
+    Opens the image without decoding any pixel data yet
+
+    Returns a tuple (img, transpose_method), where transpose_method is the
+    operation that should be applied to correct the orientation, or None
+    """
     # Helper function
     def get_tag_value(exif, tag_name):
         if not exif:
@@ -139,22 +176,92 @@ def load_image_correct_orientation(img_file_path):
 
         return None
 
-    # Actual execution starts here:
     img = Image.open(img_file_path)
     if hasattr(img, '_getexif'):
         orientation_value = get_tag_value(img._getexif(), 'Orientation')
     else:
         orientation_value = None
-    degrees = EXIF_ORIENTATION_DEGREES.get(orientation_value)
-    if not (degrees is None):
-        return img.rotate(degrees)
+    return (img, EXIF_ORIENTATION_TRANSPOSE.get(orientation_value))
+
+"""
+Takes into account EXIF Orientation metadata
+"""
+def load_image_correct_orientation(img_file_path):
+    img, transpose_method = open_image_orientation(img_file_path)
+    if not (transpose_method is None):
+        return img.transpose(transpose_method)
     else:
         return img
 
-def create_mipmaps(img):
-    (img_width, img_height) = (img.size[0], img.size[1])
+def get_image_size_strs(image_size_strs=None):
+    if image_size_strs is None:
+        return image_sizes.keys()
+    else:
+        return image_size_strs
+
+def get_max_image_dimensions(img_width, img_height, image_size_strs=None):
+    """
+    Returns the smallest (width, height) that is at least as large as every
+    one of the `image_sizes' (or only those in `image_size_strs') of an image
+    with the given dimensions
+    """
+    max_width = 0
+    max_height = 0
+    for d in [image_sizes[s] for s in get_image_size_strs(image_size_strs)]:
+        w, h = d.get_image_dimensions(img_width, img_height)
+        if w > max_width:
+            max_width = w
+        if h > max_height:
+            max_height = h
+    return (max_width, max_height)
+
+def load_image_for_resizing(img_file_path, image_size_strs=None):
+    """
+    Like `load_image_correct_orientation', but for JPEG files it lets the
+    decoder skip directly to the smallest scale (1/2, 1/4 or 1/8) that is still
+    large enough for all of the `image_sizes' (or only those in
+    `image_size_strs'). This is much faster and uses much less memory than
+    decoding the full resolution image.
+
+    Returns a tuple (img, (img_width, img_height)), where the dimensions are
+    those of the full resolution (orientation corrected) image. The returned
+    `img' may be smaller than that.
+    """
+    img, transpose_method = open_image_orientation(img_file_path)
+
+    sideways = transpose_method in (Image.ROTATE_90, Image.ROTATE_270)
+    if sideways:
+        (img_width, img_height) = (img.size[1], img.size[0])
+    else:
+        (img_width, img_height) = (img.size[0], img.size[1])
+
+    if img.format == 'JPEG':
+        draft_width, draft_height = get_max_image_dimensions(img_width, img_height, image_size_strs)
+        if sideways:
+            draft_width, draft_height = draft_height, draft_width
+        img.draft(img.mode, (draft_width, draft_height))
+
+    if not (transpose_method is None):
+        img = img.transpose(transpose_method)
+
+    return (img, (img_width, img_height))
+
+def create_mipmaps(img, img_width=None, img_height=None, resample=Image.BILINEAR, image_size_strs=None):
+    """
+    img_width, img_height: The dimensions of the full resolution image that
+    the resized images will be calculated from. By default this is the size of
+    `img', but it may be larger if `img' was decoded at a reduced scale
+
+    resample: The filter used for halving each level. Image.BOX is an exact
+    2x2 average, and is much faster than the default
+
+    image_size_strs: If not None, then only enough mipmaps for resizing to
+    these `image_sizes' are created
+    """
+    if img_width is None or img_height is None:
+        (img_width, img_height) = (img.size[0], img.size[1])
     def calc_min_dimensions():
-        target_sizes = [d.get_image_dimensions(img_width, img_height) for d in image_sizes.itervalues()]
+        target_sizes = [image_sizes[s].get_image_dimensions(img_width, img_height) for s in get_image_size_strs(image_size_strs)]
 
         min_width = 9999999
         min_height = 9999999
@@ -167,8 +274,8 @@ def create_mipmaps(img):
 
     min_width, min_height = calc_min_dimensions()
 
-    w = img_width
-    h = img_height
+    w = img.size[0]
+    h = img.size[1]
 
     mipmaps = [((w, h), img)]
 
@@ -176,7 +283,7 @@ def create_mipmaps(img):
         w //= 2
         h //= 2
 
-        m = mipmaps[-1][1].resize((w, h), Image.BILINEAR)
+        m = mipmaps[-1][1].resize((w, h), resample)
         mipmaps.append(((w, h), m))
 
     mipmaps.reverse()
@@ -189,48 +296,174 @@ def get_best_mipmap(mipmaps, width, height):
     # No matches found, return the largest mipmap (will be the original image):
     return mipmaps[-1][1]
 
-def process_uploaded_image(storage_id):
-    img_file_path = os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, storage_id + '.jpg')
+def plan_image_sizes(img_width, img_height, image_size_strs=None):
+    """
+    Figures out which files need to be created for an image of the given
+    (orientation corrected) dimensions. If `image_size_strs' is not None, then
+    only those `image_sizes' are planned.
+
+    Returns a list of (image_size_str, (width, height), same_as) tuples. If
+    `same_as' is not None, then it is the image_size_str of an earlier entry
+    that has the exact same dimensions, and so the file should be created as a
+    symlink to that entry's file instead of being rendered again.
+    """
+    plan = []
+    rendered_sizes = []
+
+    for image_size_str in get_image_size_strs(image_size_strs):
+        dimensions = image_sizes[image_size_str].get_image_dimensions(img_width, img_height)
+
+        same_as = None
+        for rendered_size_str, rendered_dimensions in rendered_sizes:
+            if rendered_dimensions == dimensions:
+                same_as = rendered_size_str
+                break
+
+        if same_as is None:
+            rendered_sizes.append((image_size_str, dimensions))
+
+        plan.append((image_size_str, dimensions, same_as))
+
+    return plan
+
+def resize_image(mipmaps, img_width, img_height, new_width, new_height):
+    mipmap = get_best_mipmap(mipmaps, new_width, new_height)
+    if new_width == mipmap.size[0] and new_height == mipmap.size[1]:
+        return mipmap
+    elif new_height * img_width // img_height == new_width or new_width * img_height // img_width == new_height:
+        return mipmap.resize((new_width, new_height), Image.BILINEAR)
+    else:
+        return ImageOps.fit(mipmap, (new_width, new_height), Image.BILINEAR, 0, (0.5, 0.5))
+
+def get_resized_image_filename(storage_id, image_size_str):
+    return storage_id + '_' + image_size_str + '.jpg'
+
+def parse_resized_image_filename(filename):
+    """
+    The reverse of `get_resized_image_filename'. Returns a tuple (storage_id,
+    image_size_str), or None if the filename is not of a resized image
+    """
+    # Some image sizes end with other image sizes (and storage ids may contain
+    # "_"), so the longest one is used
+    for image_size_str in sorted(image_sizes.iterkeys(), key=len, reverse=True):
+        suffix = '_' + image_size_str + '.jpg'
+        if filename.endswith(suffix) and len(filename) > len(suffix):
+            return (filename[:-len(suffix)], image_size_str)
+    return None
+
+# The mipmaps of the image that is rendered by the pool of this worker process
+# (see `_init_pool_worker')
+_pool_mipmaps = None
+
+def _init_pool_worker(mipmaps):
+    # The initializer arguments are inherited by the forked worker processes,
+    # so the already decoded images are not sent over a pipe. They are given
+    # to each pool (instead of being set in the parent process), since
+    # several threads may be rendering different images at the same time
+    global _pool_mipmaps
+    _pool_mipmaps = mipmaps
+
+def _render_image_size_in_pool(args):
+    (img_width, img_height, new_width, new_height, save_file_path) = args
+    new_img = resize_image(_pool_mipmaps, img_width, img_height, new_width, new_height)
+    new_img.save(save_file_path)
+
+def render_image_sizes(mipmaps, img_width, img_height, render_jobs, num_workers):
+    """
+    render_jobs: list of ((width, height), save_file_path) tuples
+
+    num_workers: If greater than 1, then the images are encoded in parallel by
+    a pool of this many worker processes
+    """
+    if num_workers <= 1 or len(render_jobs) <= 1:
+        for (new_width, new_height), save_file_path in render_jobs:
+            resize_image(mipmaps, img_width, img_height, new_width, new_height).save(save_file_path)
+        return
 
-    img = load_image_correct_orientation(img_file_path)
-    (img_width, img_height) = (img.size[0], img.size[1])
+    pool = multiprocessing.Pool(min(num_workers, len(render_jobs)), _init_pool_worker, (mipmaps,))
+    try:
+        pool.map(_render_image_size_in_pool,
+                [(img_width, img_height, w, h, save_file_path) for (w, h), save_file_path in render_jobs],
+                chunksize=1)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def render_uploaded_image(storage_id, num_workers=None, fast_decode=None, image_size_strs=None):
+    """
+    Creates all of the resized versions of an uploaded photo (see
+    `image_sizes'), or only those in `image_size_strs' if it is not None.
+
+    This does not access the database (see `process_uploaded_image').
+
+    num_workers: The number of processes that should be used for encoding the
+    resized images. If None, then `settings.PHOTO_PROCESSING_NUM_WORKERS' is
+    used
+
+    fast_decode: If True, then the image is decoded at a reduced scale (see
+    `load_image_for_resizing') and the mipmaps are built with a box filter. If
+    None, then `settings.PHOTO_PROCESSING_FAST_DECODE' is used
+
+    Returns the (orientation corrected) dimensions of the original image
+    """
+    if num_workers is None:
+        num_workers = settings.PHOTO_PROCESSING_NUM_WORKERS
+    if fast_decode is None:
+        fast_decode = settings.PHOTO_PROCESSING_FAST_DECODE
 
-    mipmaps = create_mipmaps(img)
+    img_file_path = os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, storage_id + '.jpg')
 
-    saved_images = []
+    if fast_decode:
+        img, (img_width, img_height) = load_image_for_resizing(img_file_path, image_size_strs)
+        mipmaps = create_mipmaps(img, img_width, img_height, Image.BOX, image_size_strs)
+    else:
+        img = load_image_correct_orientation(img_file_path)
+        (img_width, img_height) = (img.size[0], img.size[1])
+        mipmaps = create_mipmaps(img, image_size_strs=image_size_strs)
 
-    def get_matching_saved_image(width, height):
-        for (w, h), filename in saved_images:
-            if w == new_width and h == new_height:
-                return filename
-        return None
+    plan = plan_image_sizes(img_width, img_height, image_size_strs)
 
-    for image_size_str, image_dimensions_calculator in image_sizes.iteritems():
-        (new_width, new_height) = image_dimensions_calculator.get_image_dimensions(img_width, img_height)
+    render_jobs = []
+    for image_size_str, dimensions, same_as in plan:
+        if same_as is None:
+            filename = get_resized_image_filename(storage_id, image_size_str)
+            render_jobs.append((dimensions, os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, filename)))
 
-        filename = storage_id + '_' + image_size_str + '.jpg'
+    render_image_sizes(mipmaps, img_width, img_height, render_jobs, num_workers)
 
-        saved_image = get_matching_saved_image(new_width, new_height)
-        if saved_image:
-            symlink_name = os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, filename)
+    for image_size_str, dimensions, same_as in plan:
+        if same_as is not None:
+            symlink_name = os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, get_resized_image_filename(storage_id, image_size_str))
             if os.path.isfile(symlink_name):
                 os.remove(symlink_name)
-            os.symlink(saved_image, symlink_name)
-            continue
-
-        mipmap = get_best_mipmap(mipmaps, new_width, new_height)
-        if new_width == mipmap.size[0] and new_height == mipmap.size[1]:
-            new_img = mipmap
-        elif new_height * img_width // img_height == new_width or new_width * img_height // img_width == new_height:
-            new_img = mipmap.resize((new_width, new_height), Image.BILINEAR)
-        else:
-            new_img = ImageOps.fit(mipmap, (new_width, new_height), Image.BILINEAR, 0, (0.5, 0.5))
-        new_img.save(os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, filename))
-        saved_images.append(((new_width, new_height), filename))
+            os.symlink(get_resized_image_filename(storage_id, same_as), symlink_name)
 
     return (img_width, img_height)
 
+def process_uploaded_image(storage_id, num_workers=None, fast_decode=None, image_size_strs=None):
+    """
+    Same as `render_uploaded_image', and also records the manifest of the
+    created files
+
+    Returns the (orientation corrected) dimensions of the original image
+    """
+    from photos.models import ProcessedImageManifest
+
+    (img_width, img_height) = render_uploaded_image(storage_id, num_workers, fast_decode, image_size_strs)
+    ProcessedImageManifest.objects.record(storage_id, img_width, img_height, get_image_size_strs(image_size_strs), timezone.now())
+    return (img_width, img_height)
+
 def process_file_upload(pending_photo, chunks):
+    """
+    Saves the uploaded file, and processes it. When
+    `settings.PHOTO_PROCESSING_ASYNC' is set, the processing is only queued
+    (see `run_processing_job')
+    """
+    from photos.models import PhotoProcessingJob
+
     mkdir_p(settings.LOCAL_PHOTOS_DIRECTORY)
     save_file_path = os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, pending_photo.storage_id + '.jpg')
 
@@ -244,10 +477,177 @@ def process_file_upload(pending_photo, chunks):
 
     pending_photo.set_uploaded(now)
 
-    process_uploaded_image(pending_photo.storage_id)
+    if settings.PHOTO_PROCESSING_ASYNC:
+        PhotoProcessingJob.objects.enqueue(pending_photo.storage_id, now)
+        return
+
+    process_uploaded_image(pending_photo.storage_id, image_size_strs=get_eager_image_size_strs())
 
     pending_photo.set_processing_done(now)
 
+def run_processing_job(job):
+    """
+    Processes the photo of a claimed `PhotoProcessingJob', marks the
+    PendingPhoto as done, and deletes the job
+    """
+    from photos.models import PendingPhoto
+
+    process_uploaded_image(job.storage_id, image_size_strs=get_eager_image_size_strs())
+
+    now = timezone.now()
+    # The PendingPhoto will not exist if the job was run again after the
+    # photo was already added to an album
+    for pending_photo in PendingPhoto.objects.filter(storage_id=job.storage_id):
+        pending_photo.set_processing_done(now)
+
+    job.delete()
+
+def process_queued_jobs(storage_ids=None):
+    """
+    Claims and runs queued processing jobs until there are none left. A job
+    that raises an exception doesn't stop the others, it is recorded with
+    `PhotoProcessingJob.objects.record_failure'.
+
+    storage_ids: If not None, then only these jobs are run
+
+    Returns a tuple (num_ran, errors), where errors is a list of tuples
+    (storage_id, traceback) of the jobs that raised an exception
+    """
+    from photos.models import PhotoProcessingJob
+
+    num_ran = 0
+    errors = []
+    while True:
+        job = PhotoProcessingJob.objects.claim(timezone.now(), storage_ids)
+        if job is None:
+            return (num_ran, errors)
+        try:
+            run_processing_job(job)
+        except Exception:
+            error = traceback.format_exc()
+            PhotoProcessingJob.objects.record_failure(job, timezone.now(), error)
+            errors.append((job.storage_id, error))
+        else:
+            num_ran += 1
+        notify_jobs_finished()
+
+
+# The workers announce that jobs have finished (or failed) on this PostgreSQL
+# notification channel
+JOBS_FINISHED_CHANNEL = 'photo_processing_jobs_finished'
+
+class _JobsFinishedEvent(object):
+    """
+    Wakes up the threads of this process that are waiting for jobs to finish
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.generation = 0
+
+    def notify(self):
+        with self.condition:
+            self.generation += 1
+            self.condition.notify_all()
+
+    def wait(self, generation, timeout):
+        """
+        Waits until `notify' is called after `generation' was read, or until
+        the timeout
+        """
+        with self.condition:
+            if self.generation == generation:
+                self.condition.wait(timeout)
+
+_jobs_finished = _JobsFinishedEvent()
+
+def notify_jobs_finished():
+    from django.db import connection
+
+    if connection.vendor == 'postgresql':
+        connection.cursor().execute('NOTIFY ' + JOBS_FINISHED_CHANNEL)
+    _jobs_finished.notify()
+
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+def start_jobs_finished_listener():
+    """
+    Starts a thread (once per process) that wakes up the waiting threads when
+    a worker notifies that jobs have finished. It has its own connection,
+    since notifications are not received inside of a transaction (and the
+    waiting requests are in one)
+    """
+    global _listener_pid
+
+    with _listener_lock:
+        if _listener_pid == os.getpid():
+            return
+        _listener_pid = os.getpid()
+
+    t = threading.Thread(target=_listen_for_jobs_finished)
+    t.daemon = True
+    t.start()
+
+def _listen_for_jobs_finished():
+    from django.db import connection
+
+    while True:
+        try:
+            conn = connection.get_new_connection(connection.get_connection_params())
+            try:
+                conn.autocommit = True
+                conn.cursor().execute('LISTEN ' + JOBS_FINISHED_CHANNEL)
+                while True:
+                    if select.select([conn], [], [], 60) != ([], [], []):
+                        conn.poll()
+                        if conn.notifies:
+                            del conn.notifies[:]
+                            _jobs_finished.notify()
+            finally:
+                conn.close()
+        except Exception:
+            # Until the connection is back, the waiting threads still check
+            # the jobs every PHOTO_PROCESSING_WAIT_CHECK_INTERVAL seconds
+            time.sleep(settings.PHOTO_PROCESSING_WAIT_CHECK_INTERVAL)
+
+def wait_for_queued_jobs(storage_ids, timeout):
+    """
+    Waits until the workers have finished the processing jobs of all of the
+    `storage_ids' (see `process_queued_jobs'). The jobs are never run here, so
+    that photos are only decoded and resized by the workers.
+
+    Returns a list of the storage ids whose jobs failed, or None if the
+    timeout expired first
+    """
+    from django.db import connection
+    from photos.models import PhotoProcessingJob
+
+    if connection.vendor == 'postgresql':
+        start_jobs_finished_listener()
+
+    storage_ids = list(storage_ids)
+    deadline = time.time() + timeout
+    while True:
+        generation = _jobs_finished.generation
+
+        jobs = []
+        # Stay well below the limit of the number of query parameters of the
+        # database
+        CHUNK_SIZE = 500
+        for i in xrange(0, len(storage_ids), CHUNK_SIZE):
+            jobs.extend(PhotoProcessingJob.objects
+                    .filter(storage_id__in=storage_ids[i:i+CHUNK_SIZE])
+                    .values_list('storage_id', 'date_failed'))
+
+        if all(date_failed is not None for storage_id, date_failed in jobs):
+            return [storage_id for storage_id, date_failed in jobs]
+
+        time_left = deadline - time.time()
+        if time_left <= 0:
+            return None
+
+        _jobs_finished.wait(generation, min(time_left, settings.PHOTO_PROCESSING_WAIT_CHECK_INTERVAL))
+
 # Taken from <http://stackoverflow.com/a/600612>
 def mkdir_p(path):
     try:
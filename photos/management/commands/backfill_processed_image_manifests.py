@@ -0,0 +1,114 @@
+from optparse import make_option
+import os
+
+from PIL import Image
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from photos import image_uploads
+from photos import render_cache
+from photos.models import Photo, ProcessedImageManifest
+
+
+class Command(BaseCommand):
+    args = '[storage_id ...]'
+    help = ('Record the processing manifests of the given photos (or of all photos) that have none, '
+            'from the resized images that are already on disk. Photos that were processed before '
+            'the manifests were recorded are otherwise considered unprocessed')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run',
+            action='store_true',
+            dest='dry_run',
+            default=False,
+            help='Only report the photos, without recording anything'),
+        )
+
+    def handle(self, *args, **options):
+        if args:
+            storage_ids = list(args)
+        else:
+            storage_ids = list(Photo.objects
+                    .filter(media_type=Photo.MEDIA_TYPE_PHOTO)
+                    .order_by('storage_id')
+                    .values_list('storage_id', flat=True)
+                    .distinct())
+
+        num_unrecorded = 0
+        num_recorded = 0
+        num_missing = 0
+        # Stay well below the limit of the number of query parameters of the
+        # database
+        CHUNK_SIZE = 500
+        for i in xrange(0, len(storage_ids), CHUNK_SIZE):
+            chunk = storage_ids[i:i+CHUNK_SIZE]
+            recorded = set(ProcessedImageManifest.objects
+                    .filter(storage_id__in=chunk)
+                    .values_list('storage_id', flat=True))
+            dimensions = dict((storage_id, (width, height)) for storage_id, width, height in Photo.objects
+                    .filter(storage_id__in=chunk, width__isnull=False, height__isnull=False)
+                    .values_list('storage_id', 'width', 'height'))
+
+            for storage_id in chunk:
+                if storage_id in recorded:
+                    continue
+                num_unrecorded += 1
+
+                img_dimensions = dimensions.get(storage_id) or get_original_dimensions(storage_id)
+                if img_dimensions is None:
+                    num_missing += 1
+                    continue
+
+                image_size_strs = find_resized_images(storage_id, *img_dimensions)
+                if not image_size_strs:
+                    num_missing += 1
+                    continue
+
+                if not options['dry_run']:
+                    (img_width, img_height) = img_dimensions
+                    ProcessedImageManifest.objects.record(storage_id, img_width, img_height, image_size_strs, timezone.now())
+                num_recorded += 1
+
+        self.stdout.write('%d photos without a manifest: %d %s, %d have no resized images' % (
+            num_unrecorded,
+            num_recorded,
+            'can be recorded' if options['dry_run'] else 'recorded',
+            num_missing))
+
+
+def get_original_dimensions(storage_id):
+    """
+    Returns the (orientation corrected) dimensions of the original image,
+    without decoding it, or None if it doesn't exist
+    """
+    try:
+        img, transpose_method = image_uploads.open_image_orientation(
+                os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, storage_id + '.jpg'))
+    except IOError:
+        return None
+
+    (width, height) = img.size
+    if transpose_method in (Image.ROTATE_90, Image.ROTATE_270):
+        return (height, width)
+    return (width, height)
+
+def find_resized_images(storage_id, img_width, img_height):
+    """
+    Returns the image sizes of the photo whose files exist (in the photos
+    directory or in the render cache), with the dimensions that the current
+    image sizes would create
+    """
+    image_size_strs = []
+    for image_size_str, d in image_uploads.image_sizes.iteritems():
+        filename = image_uploads.get_resized_image_filename(storage_id, image_size_str)
+        for directory in (settings.LOCAL_PHOTOS_DIRECTORY, render_cache.get_cache_directory()):
+            try:
+                size = Image.open(os.path.join(directory, filename)).size
+            except IOError:
+                continue
+            if size == d.get_image_dimensions(img_width, img_height):
+                image_size_strs.append(image_size_str)
+                break
+    return image_size_strs
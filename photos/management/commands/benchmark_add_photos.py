@@ -0,0 +1,73 @@
+from optparse import make_option
+import time
+
+from django.contrib import auth
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from photos import photo_operations
+from photos.models import Album, Photo
+
+
+class Command(BaseCommand):
+    help = ('Compare the time and number of queries it takes to add pending photos to an album '
+            'with bulk inserts and one photo at a time. Nothing is saved to the database')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--counts',
+            dest='counts',
+            default='10,100,1000',
+            help='Comma separated numbers of photos to add'),
+        )
+
+    def handle(self, *args, **options):
+        counts = [int(c) for c in options['counts'].split(',')]
+
+        self.stdout.write('%8s %12s %10s %12s %10s %8s' % ('photos', 'bulk', 'queries', 'one by one', 'queries', 'speedup'))
+
+        for num_photos in counts:
+            bulk_time, bulk_queries = self.time_add_photos(num_photos, bulk=True)
+            single_time, single_queries = self.time_add_photos(num_photos, bulk=False)
+
+            self.stdout.write('%8d %11.3fs %10d %11.3fs %10d %7.2fx' % (
+                num_photos, bulk_time, bulk_queries, single_time, single_queries, single_time / bulk_time))
+
+    def time_add_photos(self, num_photos, bulk):
+        """
+        Returns a tuple (seconds, num_queries)
+        """
+        with transaction.atomic():
+            sid = transaction.savepoint()
+            try:
+                now = timezone.now()
+                user = auth.get_user_model().objects.create_user('benchmark')
+                album = Album.objects.create_album(user, 'Benchmark', now)
+
+                photo_ids = []
+                for i in xrange(num_photos):
+                    pending_photo = Photo.objects.upload_request(author=user)
+                    pending_photo.set_uploaded(now)
+                    pending_photo.set_processing_done(now)
+                    photo_ids.append(pending_photo.photo_id)
+
+                action = photo_operations.AddPendingPhotosToAlbumAction(photo_ids, album.id, now)
+
+                with CaptureQueriesContext(connection) as queries:
+                    start = time.time()
+                    if bulk:
+                        action.verify_all_uploaded(photo_ids)
+                        action.add_photos_to_db(photo_ids)
+                    else:
+                        pending_photos = []
+                        for photo_id in photo_ids:
+                            pending_photos.append(action.get_pending_photos([photo_id])[photo_id])
+                        action.add_photos_to_db_one_by_one(album, pending_photos)
+                        for pending_photo in pending_photos:
+                            pending_photo.delete()
+                    elapsed = time.time() - start
+
+                return (elapsed, len(queries))
+            finally:
+                transaction.savepoint_rollback(sid)
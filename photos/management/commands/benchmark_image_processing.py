@@ -0,0 +1,144 @@
+from optparse import make_option
+import glob
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from photos import image_uploads
+
+
+class Command(BaseCommand):
+    args = '[photos_directory]'
+    help = ('Compare the time it takes to process photos serially and with a pool of worker processes, '
+            'or (with --decode) with fast and full resolution decoding')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers',
+            type='int',
+            dest='workers',
+            default=multiprocessing.cpu_count(),
+            help='Number of worker processes for the parallel run'),
+        make_option('--repeat',
+            type='int',
+            dest='repeat',
+            default=3,
+            help='Number of times to process each photo (the best time is reported)'),
+        make_option('--decode',
+            action='store_true',
+            dest='decode',
+            default=False,
+            help='Compare fast (reduced scale) decoding against full resolution decoding, including peak memory use'),
+        )
+
+    def handle(self, photos_directory='photos/test_photos', **options):
+        num_workers = options['workers']
+        repeat = options['repeat']
+
+        photo_files = sorted(glob.glob(os.path.join(photos_directory, '*.jpg')))
+        if not photo_files:
+            self.stderr.write('No photos found in: ' + photos_directory)
+            return
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            with override_settings(LOCAL_PHOTOS_DIRECTORY=tmp_dir):
+                if options['decode']:
+                    self.compare_decode(photo_files, tmp_dir, repeat)
+                    return
+
+                self.stdout.write('%-40s %12s %12s %8s' % ('photo', 'serial', 'workers=%d' % (num_workers,), 'speedup'))
+
+                total_serial = 0.0
+                total_parallel = 0.0
+                for photo_file in photo_files:
+                    storage_id = os.path.splitext(os.path.basename(photo_file))[0]
+                    shutil.copyfile(photo_file, os.path.join(tmp_dir, storage_id + '.jpg'))
+
+                    serial_time = self.time_processing(storage_id, 1, repeat)
+                    parallel_time = self.time_processing(storage_id, num_workers, repeat)
+                    total_serial += serial_time
+                    total_parallel += parallel_time
+
+                    self.stdout.write('%-40s %11.3fs %11.3fs %7.2fx' % (
+                        storage_id[:40], serial_time, parallel_time, serial_time / parallel_time))
+
+                self.stdout.write('%-40s %11.3fs %11.3fs %7.2fx' % (
+                    'average per photo',
+                    total_serial / len(photo_files),
+                    total_parallel / len(photo_files),
+                    total_serial / total_parallel))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def compare_decode(self, photo_files, tmp_dir, repeat):
+        self.stdout.write('%-40s %12s %12s %8s %12s %12s' % ('photo', 'full', 'fast', 'speedup', 'full mem', 'fast mem'))
+
+        total_full = 0.0
+        total_fast = 0.0
+        for photo_file in photo_files:
+            storage_id = os.path.splitext(os.path.basename(photo_file))[0]
+            shutil.copyfile(photo_file, os.path.join(tmp_dir, storage_id + '.jpg'))
+
+            full_time = self.time_processing(storage_id, 1, repeat, fast_decode=False)
+            fast_time = self.time_processing(storage_id, 1, repeat, fast_decode=True)
+            total_full += full_time
+            total_fast += fast_time
+
+            full_mem = measure_peak_memory(storage_id, fast_decode=False)
+            fast_mem = measure_peak_memory(storage_id, fast_decode=True)
+
+            self.stdout.write('%-40s %11.3fs %11.3fs %7.2fx %10dKB %10dKB' % (
+                storage_id[:40], full_time, fast_time, full_time / fast_time, full_mem, fast_mem))
+
+        self.stdout.write('%-40s %11.3fs %11.3fs %7.2fx' % (
+            'average per photo',
+            total_full / len(photo_files),
+            total_fast / len(photo_files),
+            total_full / total_fast))
+
+    def time_processing(self, storage_id, num_workers, repeat, fast_decode=None):
+        best = None
+        for i in xrange(repeat):
+            start = time.time()
+            image_uploads.render_uploaded_image(storage_id, num_workers, fast_decode)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        return best
+
+
+def measure_peak_memory(storage_id, fast_decode):
+    """
+    Processes the photo in a fresh child process, and returns how much the
+    peak resident memory of the child grew above its starting resident memory
+    (in kilobytes)
+
+    Only works on Linux (uses /proc)
+    """
+    def current_rss_kb():
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * resource.getpagesize() // 1024
+
+    def run(result_queue):
+        # The peak memory of the parent is inherited by the child, so reset
+        # it (supported since Linux 4.0)
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        before = current_rss_kb()
+        image_uploads.render_uploaded_image(storage_id, 1, fast_decode)
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result_queue.put(after - before)
+
+    result_queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=run, args=(result_queue,))
+    p.start()
+    result = result_queue.get()
+    p.join()
+    return result
@@ -0,0 +1,97 @@
+from optparse import make_option
+import datetime
+import time
+
+from django.contrib import auth
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from mock import patch
+from rest_framework.renderers import JSONRenderer
+
+from photos.models import Album, Photo, PhotoComment
+from photos_api import optimized_views
+from photos_api import streaming
+from photos_api.payload_cache import PayloadCache
+
+
+class Command(BaseCommand):
+    help = ('Compare the time it takes to build the payload of an album detail (from the cache), '
+            'to render it with JSONRenderer, and to stream its JSON. Nothing is saved to the database')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--counts',
+            dest='counts',
+            default='100,1000,5000',
+            help='Comma separated numbers of photos in the album'),
+        make_option('--repeat',
+            type='int',
+            dest='repeat',
+            default=10,
+            help='Number of times that each album is rendered'),
+        )
+
+    def handle(self, *args, **options):
+        counts = [int(c) for c in options['counts'].split(',')]
+
+        self.stdout.write('Milliseconds per 1000 photos:')
+        self.stdout.write('%8s %14s %14s %14s' % ('photos', 'Payload', 'JSONRenderer', 'Streaming'))
+
+        for num_photos in counts:
+            times = self.time_render(num_photos, options['repeat'])
+            self.stdout.write('%8d %14.2f %14.2f %14.2f' % ((num_photos,) + tuple(
+                t * 1000 * 1000 / num_photos for t in times)))
+
+    def time_render(self, num_photos, repeat):
+        """
+        Returns a tuple of the seconds that building the payload, rendering
+        it, and streaming it take
+        """
+        with transaction.atomic():
+            sid = transaction.savepoint()
+            try:
+                now = timezone.now()
+                user = auth.get_user_model().objects.create_user('benchmark')
+                album = Album.objects.create_album(user, 'Benchmark', now)
+
+                photos = []
+                for i in xrange(num_photos):
+                    photos.append(Photo(
+                        photo_id = Photo.generate_photo_id(),
+                        media_type = Photo.MEDIA_TYPE_PHOTO,
+                        client_upload_id = '',
+                        storage_id = Photo.generate_photo_id(),
+                        subdomain = Photo.choose_random_subdomain(),
+                        date_created = now + datetime.timedelta(microseconds=i),
+                        author = user,
+                        album = album,
+                        album_index = i,
+                        width = 1920,
+                        height = 1080))
+                Photo.objects.bulk_create(photos)
+                # Every third photo has a comment
+                PhotoComment.objects.bulk_create([PhotoComment(
+                    photo = photo,
+                    date_created = now,
+                    author = user,
+                    client_msg_id = 1,
+                    comment_text = 'Benchmark') for photo in photos[::3]])
+                album.save_revision(now, True)
+
+                # A new cache, since the album id is reused after every
+                # rollback
+                with patch('photos_api.optimized_views.album_payload_cache', PayloadCache(1024 * 1024 * 1024)):
+                    # Fill the cache
+                    payload = optimized_views.get_album_detail_payload(user, album)
+
+                    return (self.time(lambda: optimized_views.get_album_detail_payload(user, album), repeat),
+                            self.time(lambda: JSONRenderer().render(payload), repeat),
+                            self.time(lambda: ''.join(streaming.iter_album_detail_json(user, album)), repeat))
+            finally:
+                transaction.savepoint_rollback(sid)
+
+    def time(self, fn, repeat):
+        start = time.time()
+        for i in xrange(repeat):
+            fn()
+        return (time.time() - start) / repeat
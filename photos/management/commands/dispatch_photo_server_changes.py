@@ -0,0 +1,46 @@
+from optparse import make_option
+import datetime
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from photos import photo_operations
+from photos.models import PhotoServerChange
+
+
+class Command(BaseCommand):
+    help = 'Deliver the changes to the photos to all of the photo servers (see photos.models.PhotoServerChange)'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--once',
+            action='store_true',
+            dest='once',
+            default=False,
+            help='Exit after delivering the current changes once, instead of waiting for new ones'),
+        make_option('--poll-interval',
+            type='float',
+            dest='poll_interval',
+            default=1.0,
+            help='Number of seconds to wait before checking for new changes'),
+        make_option('--prune-after',
+            type='float',
+            dest='prune_after',
+            default=24.0,
+            help='Number of hours after which changes that all of the photo servers have received are deleted'),
+        )
+
+    def handle(self, *args, **options):
+        already_sent = {}
+        while True:
+            now = timezone.now()
+            num_sent = photo_operations.dispatch_photo_server_changes(now, already_sent)
+            if num_sent > 0:
+                self.stdout.write('Successfully delivered %d changes' % num_sent)
+
+            PhotoServerChange.objects.prune(now - datetime.timedelta(hours=options['prune_after']))
+
+            if options['once']:
+                return
+
+            time.sleep(options['poll_interval'])
@@ -0,0 +1,36 @@
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand
+
+from photos import image_uploads
+
+
+class Command(BaseCommand):
+    help = 'Run the queued photo processing jobs (see settings.PHOTO_PROCESSING_ASYNC)'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--once',
+            action='store_true',
+            dest='once',
+            default=False,
+            help='Exit when there are no more queued jobs, instead of waiting for new ones'),
+        make_option('--poll-interval',
+            type='float',
+            dest='poll_interval',
+            default=1.0,
+            help='Number of seconds to wait before checking for new jobs when the queue is empty'),
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            num_ran, errors = image_uploads.process_queued_jobs()
+            if num_ran > 0:
+                self.stdout.write('Successfully ran %d jobs' % num_ran)
+            for storage_id, error in errors:
+                self.stderr.write('Error processing %s:\n%s' % (storage_id, error))
+
+            if options['once']:
+                return
+
+            time.sleep(options['poll_interval'])
@@ -0,0 +1,22 @@
+from optparse import make_option
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from photos.models import AlbumChange
+
+
+class Command(BaseCommand):
+    help = 'Delete the old entries of the album change journal (see photos.models.AlbumChange)'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days',
+            type='float',
+            dest='days',
+            default=30.0,
+            help='Number of days after which changes are deleted. Clients that have not synced an album since then will download all of it again'),
+        )
+
+    def handle(self, *args, **options):
+        AlbumChange.objects.prune(timezone.now() - datetime.timedelta(days=options['days']))
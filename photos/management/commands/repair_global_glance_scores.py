@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from photos.models import Photo
+
+
+class Command(BaseCommand):
+    help = 'Recalculate the global glance score of all of the original photos from the scores of their copies'
+
+    def handle(self, *args, **options):
+        num_fixed = Photo.objects.rebuild_global_glance_scores()
+        self.stdout.write('Fixed the global glance score of %d photos' % num_fixed)
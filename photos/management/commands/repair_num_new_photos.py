@@ -0,0 +1,24 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from photos.models import AlbumMember
+
+
+class Command(BaseCommand):
+    help = 'Count the new photos of every album membership again, and fix the counts that are wrong'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run',
+            action='store_true',
+            dest='dry_run',
+            default=False,
+            help='Only report the number of wrong counts, without fixing them'),
+        )
+
+    def handle(self, *args, **options):
+        num_wrong = AlbumMember.objects.repair_num_new_photos(options['dry_run'])
+        if options['dry_run']:
+            self.stdout.write('Found %d memberships with a wrong number of new photos' % num_wrong)
+        else:
+            self.stdout.write('Fixed the number of new photos of %d memberships' % num_wrong)
@@ -0,0 +1,173 @@
+from optparse import make_option
+import multiprocessing
+import os
+import signal
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from photos import image_uploads
+from photos.models import Photo, ProcessedImageManifest
+
+
+def _init_worker():
+    # Ctrl-C is handled by the parent process, which stops the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _render_photo(args):
+    """
+    Runs in a worker process. Only renders the files, the parent process
+    records the manifests
+
+    Returns a tuple (storage_id, (img_width, img_height), num_bytes, error)
+    """
+    storage_id, image_size_strs = args
+    try:
+        num_bytes = os.path.getsize(os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, storage_id + '.jpg'))
+        dimensions = image_uploads.render_uploaded_image(storage_id, 1, None, image_size_strs)
+        return (storage_id, dimensions, num_bytes, None)
+    except Exception as e:
+        return (storage_id, None, 0, '%s: %s' % (type(e).__name__, e))
+
+
+class Command(BaseCommand):
+    args = '[storage_id ...]'
+    help = ('Create the resized versions of the given photos (or of all photos) that are not '
+            'up to date with the current image sizes. Progress is saved to a checkpoint file, '
+            'so that an interrupted run can be resumed by running the same command again')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers',
+            type='int',
+            dest='workers',
+            default=multiprocessing.cpu_count(),
+            help='Number of worker processes'),
+        make_option('--checkpoint',
+            dest='checkpoint',
+            default='reprocess_photos.checkpoint',
+            help='File that the storage ids of the finished photos are saved to (after the '
+                 'version of the image sizes that they were processed with)'),
+        make_option('--force',
+            action='store_true',
+            dest='force',
+            default=False,
+            help='Also process photos whose manifest is already up to date'),
+        )
+
+    def handle(self, *args, **options):
+        num_workers = options['workers']
+        checkpoint_file = options['checkpoint']
+
+        if args:
+            storage_ids = list(args)
+        else:
+            storage_ids = list(Photo.objects
+                    .filter(media_type=Photo.MEDIA_TYPE_PHOTO)
+                    .order_by('storage_id')
+                    .values_list('storage_id', flat=True)
+                    .distinct())
+
+        # The photos in a checkpoint of a different version of the image sizes
+        # are out of date
+        version = image_uploads.get_image_sizes_version()
+        done = set()
+        if os.path.exists(checkpoint_file):
+            with open(checkpoint_file) as f:
+                lines = [line.strip() for line in f]
+            if lines and lines[0] == version:
+                done = set(lines[1:])
+                self.stdout.write('Resuming from checkpoint (%d photos already done)' % (len(done),))
+            else:
+                self.stdout.write('Ignoring checkpoint of a different version of the image sizes')
+                os.remove(checkpoint_file)
+        storage_ids = [s for s in storage_ids if s not in done]
+
+        image_size_strs = image_uploads.get_eager_image_size_strs()
+
+        if not options['force']:
+            missing_image_sizes = ProcessedImageManifest.objects.get_missing_image_sizes(storage_ids, image_size_strs)
+            storage_ids = [s for s in storage_ids if missing_image_sizes[s]]
+
+        if not storage_ids:
+            self.stdout.write('Nothing to process')
+            if os.path.exists(checkpoint_file):
+                os.remove(checkpoint_file)
+            return
+
+        self.stdout.write('Processing %d photos with %d workers' % (len(storage_ids), num_workers))
+
+        jobs = [(storage_id, image_size_strs) for storage_id in storage_ids]
+
+        if num_workers <= 1:
+            pool = None
+            results = (_render_photo(job) for job in jobs)
+        else:
+            # The connection must not be shared with the forked workers
+            connection.close()
+            pool = multiprocessing.Pool(num_workers, _init_worker)
+            results = wait_interruptibly(pool.imap_unordered(_render_photo, jobs))
+
+        num_processed = 0
+        num_failed = 0
+        total_bytes = 0
+        start_time = time.time()
+        try:
+            with open(checkpoint_file, 'a') as checkpoint:
+                if checkpoint.tell() == 0:
+                    checkpoint.write(version + '\n')
+                    checkpoint.flush()
+                for storage_id, dimensions, num_bytes, error in results:
+                    if error:
+                        num_failed += 1
+                        self.stderr.write('Error processing %s: %s' % (storage_id, error))
+                        continue
+
+                    (img_width, img_height) = dimensions
+                    ProcessedImageManifest.objects.record(storage_id, img_width, img_height, image_size_strs, timezone.now())
+                    checkpoint.write(storage_id + '\n')
+                    checkpoint.flush()
+
+                    num_processed += 1
+                    total_bytes += num_bytes
+                    if num_processed % 100 == 0:
+                        self.write_progress(num_processed, len(storage_ids), total_bytes, start_time)
+        except KeyboardInterrupt:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            self.write_progress(num_processed, len(storage_ids), total_bytes, start_time)
+            raise CommandError('Interrupted. Run the command again to resume')
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        self.write_progress(num_processed, len(storage_ids), total_bytes, start_time)
+        if num_failed:
+            raise CommandError('%d photos failed. Run the command again to retry them' % (num_failed,))
+
+        os.remove(checkpoint_file)
+        self.stdout.write('Done')
+
+    def write_progress(self, num_processed, num_total, total_bytes, start_time):
+        elapsed = max(time.time() - start_time, 0.001)
+        self.stdout.write('%d/%d photos, %.2f photos/s, %.2f MB/s' % (
+            num_processed,
+            num_total,
+            num_processed / elapsed,
+            total_bytes / elapsed / (1024 * 1024)))
+
+
+def wait_interruptibly(pool_results):
+    """
+    Waiting on a pool result without a timeout can't be interrupted by Ctrl-C
+    in Python 2, so wait with a (very long) timeout instead
+    """
+    while True:
+        try:
+            yield pool_results.next(timeout=365 * 24 * 60 * 60)
+        except StopIteration:
+            return
@@ -1,10 +1,12 @@
 from django.contrib import auth
 from django.contrib.auth import get_user_model
+import json
 import os
 import random
 import datetime
 
 from django.conf import settings
+from django.db import connection
 from django.db import models
 from django.db import transaction
 from django.db import IntegrityError
@@ -13,6 +15,7 @@ from django.utils import timezone
 import phonenumbers
 
 from phone_auth.models import PhoneNumber, PhoneNumberLinkCode
+from phone_auth.signals import user_avatar_changed, user_nickname_changed, user_invite_status_changed
 from photos import image_uploads
 from photos_api.signals import members_added_to_album, album_created
 from photos_api import device_push
@@ -30,7 +33,8 @@ class AlbumManager(models.Manager):
                 name = name,
                 creator = creator,
                 last_updated = date_created,
-                revision_number = 0
+                revision_number = 0,
+                last_revision_date = timezone.now()
                 )
 
         AlbumMember.objects.create(
@@ -55,14 +59,93 @@ class Album(models.Model):
     creator = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='+')
     last_updated = models.DateTimeField()
     revision_number = models.IntegerField()
+    # When the last revision was saved. Tells apart revisions with the same
+    # number when one of them was rolled back. Null if there has been no
+    # revision since this was added
+    last_revision_date = models.DateTimeField(null=True, blank=True)
+    # The album_index that the next photo added to the album will get. Only
+    # accessed through `allocate_album_indexes'
+    next_album_index = models.PositiveIntegerField(default=0)
 
     objects = AlbumManager()
 
-    def save_revision(self, revision_date, update_last_updated=False):
-        if update_last_updated:
-            self.last_updated = revision_date
-            self.save(update_fields=['last_updated'])
-        Album.objects.filter(pk=self.id).update(revision_number=models.F('revision_number')+1)
+    def save_revision(self, revision_date, update_last_updated=False, changes=None):
+        """
+        changes: A list of new (unsaved) `AlbumChange' objects that describe
+        what was changed in this revision. An empty list means that only the
+        name or last_updated of the album could have changed. If None, then
+        the change is unknown, and clients that sync the album will download
+        all of it again
+        """
+        if changes is None:
+            changes = [AlbumChange(change_type=AlbumChange.CHANGE_UNKNOWN)]
+        elif not changes:
+            changes = [AlbumChange(change_type=AlbumChange.CHANGE_ALBUM)]
+
+        with transaction.atomic():
+            if update_last_updated:
+                self.last_updated = revision_date
+                self.save(update_fields=['last_updated'])
+            Album.objects.filter(pk=self.id).update(
+                    revision_number=models.F('revision_number')+1,
+                    last_revision_date=timezone.now())
+            self.revision_number, self.last_revision_date = Album.objects.filter(pk=self.id) \
+                    .values_list('revision_number', 'last_revision_date').get()
+
+            for change in changes:
+                change.album_id = self.id
+                change.revision_number = self.revision_number
+                change.date_created = revision_date
+            AlbumChange.objects.bulk_create(changes)
+
+            AlbumMember.objects.update_num_new_photos(self.id, changes)
+
+            # Photo updates (comments, glances, tags) are the most common
+            # changes, and are not shown in the album lists
+            if update_last_updated or any(c.change_type != AlbumChange.CHANGE_PHOTO_UPDATED for c in changes):
+                touch_album_lists(get_user_model().objects.filter(album_membership__album=self.id))
+
+    def allocate_album_indexes(self, count=1):
+        """
+        Reserves `count' consecutive album_index values for new photos in this
+        album, and returns the first one.
+
+        This is a single UPDATE statement, so the row lock that it takes makes
+        concurrent callers wait until the end of the current transaction, and
+        the same values are never handed out twice.
+
+        Photos that were given an album_index some other way (for example
+        `public_feed.set_public_feed' or fixtures) are taken into account by
+        never returning a value that is not above the current maximum.
+        """
+        if connection.vendor == 'sqlite':
+            greatest = 'MAX'
+        else:
+            greatest = 'GREATEST'
+
+        with transaction.atomic():
+            cursor = connection.cursor()
+            cursor.execute(
+                """
+                UPDATE photos_album
+                SET next_album_index = """ + greatest + """(
+                        next_album_index,
+                        (SELECT COALESCE(MAX(album_index) + 1, 0)
+                         FROM photos_photo
+                         WHERE album_id = %s)) + %s
+                WHERE id = %s
+                """,
+                [self.id, count, self.id])
+            cursor.execute(
+                """
+                SELECT next_album_index
+                FROM photos_album
+                WHERE id = %s
+                """,
+                [self.id])
+            (next_album_index,) = cursor.fetchone()
+
+        return next_album_index - count
 
     @staticmethod
     def default_sms_message_formatter(link_code):
@@ -85,12 +168,23 @@ class Album(models.Model):
             self.album = album
             self.current_date = current_date
             self.update_last_updated = update_last_updated
+            self.changes = []
 
         def __enter__(self):
             return self
 
         def __exit__(self, type, value, traceback):
-            self.album.save_revision(self.current_date, self.update_last_updated)
+            self.album.save_revision(self.current_date, self.update_last_updated, self.changes)
+
+        def record_photo_change(self, photo):
+            self.changes.append(AlbumChange(
+                change_type = AlbumChange.CHANGE_PHOTO_UPDATED,
+                photo_id = photo.photo_id))
+
+        def record_member_added(self, user):
+            self.changes.append(AlbumChange(
+                change_type = AlbumChange.CHANGE_MEMBER_ADDED,
+                user_id = user.id))
 
         def add_user_id(self, inviter, user_id):
             """
@@ -108,6 +202,7 @@ class Album(models.Model):
                 })
 
             if created:
+                self.record_member_added(added_user)
                 members_added_to_album.send(sender=None, member_users=[added_user], by_user=inviter, to_album=self.album)
 
             return True
@@ -137,6 +232,8 @@ class Album(models.Model):
                 'datetime_added': self.current_date,
                 'album_admin': False
                 })
+            if member_created:
+                self.record_member_added(phone_number.user)
 
             if phone_number.verified:
                 if member_created:
@@ -160,6 +257,7 @@ class Album(models.Model):
                     client_msg_id = client_msg_id,
                     comment_text = comment_text
                     )
+            self.record_photo_change(photo)
 
             if photo.author.id != commenter.id:
                 photo.author.increment_user_glance_score(5)
@@ -176,6 +274,7 @@ class Album(models.Model):
                 raise ValueError('photo is not part of this album')
 
             photo_comment.delete()
+            self.record_photo_change(photo_comment.photo)
 
         def photo_tag_user(self, photo, author, tagged_user, tag_coord_x, tag_coord_y):
             if photo.album != self.album:
@@ -190,6 +289,7 @@ class Album(models.Model):
                     tagged_user = tagged_user,
                     tag_coord_x = tag_coord_x,
                     tag_coord_y = tag_coord_y)
+            self.record_photo_change(photo)
 
             # Notify the tagged user as (if he didn't tag himself)
             if tagged_user != author:
@@ -200,10 +300,12 @@ class Album(models.Model):
                 raise ValueError('photo is not part of this album')
 
             photo_user_tag.delete()
+            self.record_photo_change(photo_user_tag.photo)
 
         def set_photo_user_glance_score_delta(self, user, photo, score_delta):
             changed = PhotoGlanceScoreDelta.objects.set_photo_user_glance_score_delta(user, photo, score_delta, self.current_date)
             if changed:
+                self.record_photo_change(photo)
                 if photo.author.id != user.id:
                     photo.author.increment_user_glance_score(3 * score_delta)
 
@@ -229,6 +331,7 @@ class Album(models.Model):
                 photo_glance.date_created = self.current_date
                 photo_glance.emoticon_name = emoticon_name
                 photo_glance.save(update_fields=['date_created', 'emoticon_name'])
+            self.record_photo_change(photo)
 
             device_push.broadcast_photo_glance(photo.author.id, glancer.nickname, photo.album.id, photo.album.name)
 
@@ -316,28 +419,139 @@ class Album(models.Model):
     def is_user_member(self, user_id):
         return AlbumMember.objects.filter(album=self, user__pk=user_id).exists()
 
-    def get_etag(self):
-        return u'{0}'.format(self.revision_number)
+    def get_etag(self, last_access=None, num_hidden_photos=0):
+        return Album.format_etag(self.revision_number, last_access, num_hidden_photos)
+
+    @staticmethod
+    def format_etag(revision_number, last_access, num_hidden_photos):
+        """
+        Besides the revision of the album, the album payload of a user also
+        depends on when the user last viewed the album, and on the photos that
+        the user has hidden
+        """
+        if last_access is None and num_hidden_photos == 0:
+            return u'{0}'.format(revision_number)
+        elif last_access is None:
+            return u'{0}--{1}'.format(revision_number, num_hidden_photos)
+        else:
+            return u'{0}-{1:%Y%m%d%H%M%S%f}-{2}'.format(revision_number, last_access, num_hidden_photos)
 
     def get_member_users(self):
         return [membership.user for membership in AlbumMember.objects.filter(album=self).only('user')]
 
-    def get_num_new_photos(self, since_date, user_id):
-        queryset = self.photo_set.exclude(author__id=user_id)
 
-        if since_date:
-            # due to serializer issues, since_date is accurate only up to a millisecond
-            # while the database is accurate up to a microsecond
-            since_date = since_date + datetime.timedelta(milliseconds=1)
-            return queryset.filter(date_created__gt=since_date).count()
-        else:
-            return queryset.count()
+def new_photos_count_sql(photos_filter_sql):
+    """
+    SQL for the number of new photos of the membership row `photos_album_members'
+    (see `AlbumMember.num_new_photos'), out of the photos `p' that match
+    `photos_filter_sql'
+    """
+    # due to serializer issues, last_access is accurate only up to a
+    # millisecond while the database is accurate up to a microsecond
+    if connection.vendor == 'sqlite':
+        last_access_offset = "datetime(photos_album_members.last_access, '0.1 second')"
+    else:
+        last_access_offset = "(photos_album_members.last_access + INTERVAL '0.001 second')"
+
+    return \
+        """
+        (SELECT COUNT(*)
+         FROM photos_photo p
+         WHERE """ + photos_filter_sql + """ AND
+               p.author_id != photos_album_members.user_id AND
+               (photos_album_members.last_access IS NULL OR
+                p.date_created > """ + last_access_offset + """))
+        """
 
 
 class AlbumMemberManager(models.Manager):
+    # Limits the number of query parameters (sqlite allows at most 999)
+    CHUNK_SIZE = 500
+
     def get_user_memberships(self, user_id):
         return AlbumMember.objects.filter(user__id=user_id).select_related('album')
 
+    def update_num_new_photos(self, album_id, changes):
+        """
+        Updates the `num_new_photos' of the members of the album after a
+        revision with the list of `changes' (`AlbumChange' objects)
+        """
+        change_types = set(c.change_type for c in changes)
+        if AlbumChange.CHANGE_UNKNOWN in change_types or AlbumChange.CHANGE_PHOTO_REMOVED in change_types:
+            self.recalculate_num_new_photos(album_id)
+            return
+
+        added_photo_ids = [c.photo_id for c in changes if c.change_type == AlbumChange.CHANGE_PHOTO_ADDED]
+        added_user_ids = [c.user_id for c in changes if c.change_type == AlbumChange.CHANGE_MEMBER_ADDED]
+
+        # The new members already count the added photos
+        self.recalculate_num_new_photos(album_id, added_user_ids)
+
+        if not added_photo_ids:
+            return
+
+        where_sql = 'album_id = %s'
+        where_params = [album_id]
+        if added_user_ids:
+            where_sql += ' AND user_id NOT IN (' + ', '.join(['%s'] * len(added_user_ids)) + ')'
+            where_params += added_user_ids
+
+        cursor = connection.cursor()
+        for i in xrange(0, len(added_photo_ids), self.CHUNK_SIZE):
+            chunk = added_photo_ids[i:i + self.CHUNK_SIZE]
+            photos_filter_sql = 'p.photo_id IN (' + ', '.join(['%s'] * len(chunk)) + ')'
+            cursor.execute(
+                """
+                UPDATE photos_album_members
+                SET num_new_photos = num_new_photos + """ + new_photos_count_sql(photos_filter_sql) + """
+                WHERE """ + where_sql,
+                chunk + where_params)
+
+    def recalculate_num_new_photos(self, album_id, user_ids=None):
+        """
+        Counts the new photos of the members of the album again. If `user_ids'
+        is given, then only of those members
+        """
+        where_sql = 'album_id = %s'
+        where_params = [album_id]
+        if user_ids is not None:
+            if not user_ids:
+                return
+            where_sql += ' AND user_id IN (' + ', '.join(['%s'] * len(user_ids)) + ')'
+            where_params += user_ids
+
+        cursor = connection.cursor()
+        cursor.execute(
+            """
+            UPDATE photos_album_members
+            SET num_new_photos = """ + new_photos_count_sql('p.album_id = photos_album_members.album_id') + """
+            WHERE """ + where_sql,
+            where_params)
+
+    def repair_num_new_photos(self, dry_run=False):
+        """
+        Counts the new photos of every membership again, and fixes the ones
+        whose `num_new_photos' is wrong (unless `dry_run').
+
+        Returns the number of memberships whose count was wrong
+        """
+        cursor = connection.cursor()
+        cursor.execute(
+            """
+            SELECT id, num_new_photos, num_new_photos_correct
+            FROM (SELECT id,
+                         num_new_photos,
+                         """ + new_photos_count_sql('p.album_id = photos_album_members.album_id') + """ as num_new_photos_correct
+                  FROM photos_album_members) as T
+            WHERE num_new_photos != num_new_photos_correct
+            """)
+
+        wrong_counts = cursor.fetchall()
+        if not dry_run:
+            for membership_id, _, num_new_photos in wrong_counts:
+                self.filter(pk=membership_id).update(num_new_photos=num_new_photos)
+        return len(wrong_counts)
+
 
 class AlbumMember(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="album_membership")
@@ -350,6 +564,11 @@ class AlbumMember(models.Model):
 
     last_access = models.DateTimeField(null=True, blank=True)
 
+    # The number of photos in the album, by other users, that were added after
+    # `last_access'. Kept up to date by every album revision and by
+    # `update_last_access' (see `AlbumMemberManager.update_num_new_photos')
+    num_new_photos = models.IntegerField(default=0)
+
     objects = AlbumMemberManager()
 
     class Meta:
@@ -360,19 +579,193 @@ class AlbumMember(models.Model):
         return u"Member {0} of album {1} (Membership #{2})".format(self.user, self.album, self.pk)
 
     def get_num_new_photos(self):
-        return self.album.get_num_new_photos(self.last_access, self.user.id)
+        return self.num_new_photos
 
     def update_last_access(self, timestamp):
         if self.last_access is None or self.last_access < timestamp:
             self.last_access = timestamp
             self.save(update_fields=['last_access'])
+            AlbumMember.objects.recalculate_num_new_photos(self.album_id, [self.user_id])
+            self.num_new_photos = AlbumMember.objects.filter(pk=self.pk).values_list('num_new_photos', flat=True).get()
 
     def get_other_members(self):
         all_users = self.album.get_member_users()
         return [user for user in all_users if user.id != self.user.id]
 
 
+class AlbumChangeManager(models.Manager):
+    def get_changes(self, album, since_revision_number, revision_number):
+        """
+        Returns a list of the changes to the album after the revision
+        `since_revision_number', up to `revision_number', or None if they are
+        not all known (some are unknown changes, or have already been deleted)
+        """
+        changes = list(self.filter(
+            album = album,
+            revision_number__gt = since_revision_number,
+            revision_number__lte = revision_number).order_by('id'))
+
+        # Every revision has at least one change
+        if len(set(c.revision_number for c in changes)) != revision_number - since_revision_number:
+            return None
+        if any(c.change_type == AlbumChange.CHANGE_UNKNOWN for c in changes):
+            return None
+        return changes
+
+    def get_revision_date(self, album, revision_number):
+        """
+        Returns a time at or before which the revision `revision_number' of
+        the album was saved. This is the date the album was created if the
+        time of the revision is not known (its changes have already been
+        deleted, or it was saved before they were recorded)
+        """
+        if revision_number == album.revision_number and album.last_revision_date is not None:
+            return album.last_revision_date
+        revision_date = self.filter(album=album, revision_number=revision_number) \
+                .aggregate(models.Min('date_created'))['date_created__min']
+        return revision_date or album.date_created
+
+    def prune(self, before):
+        """
+        Deletes the changes from before the time `before'. Clients that have
+        not synced an album since then will download all of it again
+        """
+        self.filter(date_created__lt=before).delete()
+
+
+class AlbumChange(models.Model):
+    """
+    A journal of the changes to each album, written together with every new
+    album revision (see `Album.save_revision'), so that clients can download
+    only what changed since the revision that they already have (see
+    `photos_api.optimized_views.get_album_changes_payload')
+    """
+    CHANGE_UNKNOWN = 0
+    CHANGE_ALBUM = 1
+    CHANGE_PHOTO_ADDED = 2
+    CHANGE_PHOTO_REMOVED = 3
+    CHANGE_PHOTO_UPDATED = 4
+    CHANGE_MEMBER_ADDED = 5
+    CHANGE_MEMBER_REMOVED = 6
+    CHANGE_MEMBER_UPDATED = 7
+    CHANGE_TYPE_CHOICES = (
+        (CHANGE_UNKNOWN, 'unknown'),
+        (CHANGE_ALBUM, 'album'),
+        (CHANGE_PHOTO_ADDED, 'photo_added'),
+        (CHANGE_PHOTO_REMOVED, 'photo_removed'),
+        (CHANGE_PHOTO_UPDATED, 'photo_updated'),
+        (CHANGE_MEMBER_ADDED, 'member_added'),
+        (CHANGE_MEMBER_REMOVED, 'member_removed'),
+        (CHANGE_MEMBER_UPDATED, 'member_updated'),
+    )
+
+    album = models.ForeignKey(Album)
+    # The revision of the album that this change is part of
+    revision_number = models.IntegerField()
+    change_type = models.IntegerField(choices=CHANGE_TYPE_CHOICES)
+    # Only for the photo changes. Not a ForeignKey, since the photo may have
+    # been deleted
+    photo_id = models.CharField(max_length=128, blank=True)
+    # Only for the member changes
+    user_id = models.IntegerField(null=True, blank=True)
+    date_created = models.DateTimeField(db_index=True)
+
+    objects = AlbumChangeManager()
+
+    class Meta:
+        index_together = (('album', 'revision_number'),)
+
+    def __unicode__(self):
+        return u'Album {0} revision {1}: {2}'.format(self.album_id, self.revision_number, self.get_change_type_display())
+
+
+class GlobalGlanceScoreChangeManager(models.Manager):
+    def record(self, original_photo_id):
+        """
+        Must be called in the transaction that changed the score, after the
+        row of the original photo was updated (its lock keeps concurrent
+        callers from both inserting the same row)
+        """
+        now = timezone.now()
+        if not self.filter(pk=original_photo_id).update(last_changed=now):
+            self.create(original_photo_id=original_photo_id, last_changed=now)
+
+    def get_changed_photo_ids(self, album, since):
+        """
+        Returns the ids of the photos of the album whose `global_glance_score'
+        has changed after the time `since'
+        """
+        cursor = connection.cursor()
+        cursor.execute(
+            """
+            SELECT photo_id
+            FROM photos_photo
+            WHERE album_id = %s AND
+                  COALESCE(copied_from_photo_id, photo_id) IN (
+                      SELECT original_photo_id
+                      FROM photos_globalglancescorechange
+                      WHERE last_changed > %s)
+            """,
+            [album.id, since])
+        return [photo_id for (photo_id,) in cursor.fetchall()]
+
+
+class GlobalGlanceScoreChange(models.Model):
+    """
+    When the `global_glance_score' of each original photo last changed.
+
+    The score is shown by the original and by all of its copies, which may be
+    in many albums (for example the public feed), so only the album where the
+    photo was glanced saves a revision. The other albums find their changed
+    photos here (see `photos_api.optimized_views.get_album_changes_payload')
+    """
+    # Not a ForeignKey, since the photo may have been deleted
+    original_photo_id = models.CharField(max_length=128, primary_key=True)
+    last_changed = models.DateTimeField(db_index=True)
+
+    objects = GlobalGlanceScoreChangeManager()
+
+    def __unicode__(self):
+        return u'Photo {0} at {1}'.format(self.original_photo_id, self.last_changed)
+
+
 class PhotoManager(models.Manager):
+    def rebuild_global_glance_scores(self):
+        """
+        Recalculates the `global_glance_score' of all of the original photos
+        from the `photo_glance_score' of the photos and their copies.
+
+        Returns the number of photos whose score was wrong
+        """
+        wrong_score_sql = """
+            copied_from_photo_id IS NULL AND
+            global_glance_score != (photo_glance_score +
+                                    (SELECT COALESCE(SUM(c.photo_glance_score), 0)
+                                     FROM photos_photo c
+                                     WHERE c.copied_from_photo_id = photos_photo.photo_id))
+            """
+        with transaction.atomic():
+            cursor = connection.cursor()
+            cursor.execute(
+                """
+                SELECT photo_id
+                FROM photos_photo
+                WHERE """ + wrong_score_sql)
+            photo_ids = [photo_id for (photo_id,) in cursor.fetchall()]
+            cursor.execute(
+                """
+                UPDATE photos_photo
+                SET global_glance_score = (photo_glance_score +
+                                           (SELECT COALESCE(SUM(c.photo_glance_score), 0)
+                                            FROM photos_photo c
+                                            WHERE c.copied_from_photo_id = photos_photo.photo_id))
+                WHERE """ + wrong_score_sql)
+            # So that the albums of the photos and their copies send the fixed
+            # scores to clients that sync their changes
+            for photo_id in photo_ids:
+                GlobalGlanceScoreChange.objects.record(photo_id)
+            return len(photo_ids)
+
     def upload_request(self, author):
         success = False
         while not success:
@@ -424,13 +817,24 @@ class Photo(models.Model):
     album = models.ForeignKey(Album)
     album_index = models.PositiveIntegerField(db_index=True)
     photo_glance_score = models.IntegerField(default=0)
+    # Only used for original photos (that are not copies): the sum of the
+    # photo_glance_score of the photo and of all of its copies. Kept up to date
+    # by `update_glance_score' and when a copy is deleted (see
+    # `PhotoManager.rebuild_global_glance_scores')
+    global_glance_score = models.IntegerField(default=0)
     copied_from_photo = models.ForeignKey('self', null=True, blank=True)
     youtube_id = models.CharField(max_length=64, null=True, blank=True)
+    # Dimensions of the original (orientation corrected) image. These are null
+    # for videos and for photos that were added before they were recorded
+    width = models.IntegerField(null=True, blank=True)
+    height = models.IntegerField(null=True, blank=True)
 
     objects = PhotoManager()
 
     class Meta:
         unique_together = (('album', 'album_index'),)
+        # For sending all of the photos of a subdomain to a photo server
+        index_together = (('subdomain', 'photo_id'),)
         get_latest_by = 'album_index'
         ordering = ['album_index']
 
@@ -471,6 +875,12 @@ class Photo(models.Model):
         return self.get_photo_url()[:-4]
 
     def get_image_dimensions(self, image_size_str=None):
+        """
+        Returns None if the dimensions of the photo are not known
+        """
+        if self.width is None or self.height is None:
+            return None
+
         if not image_size_str:
             # Original Image dimensions
             return (self.width, self.height)
@@ -519,22 +929,23 @@ class Photo(models.Model):
         contain the old value. If the new value is needed, you should refresh
         the object from the db.
         """
-        Photo.objects.filter(pk=self.photo_id) \
-                .update(photo_glance_score=models.F('photo_glance_score') + score_delta)
+        with transaction.atomic():
+            Photo.objects.filter(pk=self.photo_id) \
+                    .update(photo_glance_score=models.F('photo_glance_score') + score_delta)
+            Photo.objects.filter(pk=self.get_original_photo_id()) \
+                    .update(global_glance_score=models.F('global_glance_score') + score_delta)
+            GlobalGlanceScoreChange.objects.record(self.get_original_photo_id())
+
+    def get_original_photo_id(self):
+        if self.copied_from_photo_id:
+            return self.copied_from_photo_id
+        else:
+            return self.photo_id
 
     def get_global_glance_score(self):
-        query_result = Photo.objects.filter(copied_from_photo=self.get_original_photo()) \
-                .aggregate(models.Sum('photo_glance_score'))
-        sum_excluding_original = query_result['photo_glance_score__sum']
-        if sum_excluding_original is None:
-            sum_excluding_original = 0
-
-        # Force a refresh from the db to guarantee that we later read the
-        # most up-to-date value of photo_glance_score
-        original = Photo.objects.get(pk=self.get_original_photo().photo_id)
-
-        total_sum = sum_excluding_original + original.photo_glance_score
-        return total_sum
+        # Read from the db to guarantee that we get the most up-to-date value
+        return Photo.objects.filter(pk=self.get_original_photo_id()) \
+                .values_list('global_glance_score', flat=True).get()
 
     def get_glances(self):
         return self.photoglance_set.order_by('date_created')
@@ -558,7 +969,9 @@ class Photo(models.Model):
                 author = author,
                 album = album,
                 album_index = album_index,
-                copied_from_photo_id = self.get_original_photo()
+                copied_from_photo_id = self.get_original_photo(),
+                width = self.width,
+                height = self.height
                 )
 
 
@@ -617,45 +1030,253 @@ class PendingPhoto(models.Model):
         return not (self.processing_done_time is None)
 
 
-class VideoManager(models.Manager):
-    def set_processing(self, client_upload_id, storage_id, author, album, now):
-        def get_next_album_index(album):
-            album_index_q = Photo.objects.filter(album=album).aggregate(models.Max('album_index'))
+class PhotoProcessingJobManager(models.Manager):
+    def enqueue(self, storage_id, now):
+        """
+        Safe to call more than once for the same storage_id
+        """
+        try:
+            with transaction.atomic():
+                self.create(storage_id=storage_id, date_queued=now)
+        except IntegrityError:
+            # Already queued
+            pass
 
-            max_album_index = album_index_q['album_index__max']
-            if max_album_index is None:
-                return 0
-            else:
-                return max_album_index + 1
+    def claim(self, now, storage_ids=None):
+        """
+        Atomically marks the oldest job that is waiting (or whose worker seems
+        to have died) as started, and returns it. Returns None if there are no
+        such jobs.
+
+        A job whose worker seems to have died after it was already attempted
+        `settings.PHOTO_PROCESSING_JOB_MAX_ATTEMPTS' times is marked as failed
+        instead (the photo may be crashing the workers).
+
+        storage_ids: If not None, then only these jobs will be claimed
+        """
+        stale_time = now - datetime.timedelta(seconds=settings.PHOTO_PROCESSING_JOB_TIMEOUT)
+        while True:
+            candidates = self.filter(models.Q(date_started__isnull=True) | models.Q(date_started__lt=stale_time),
+                    date_failed__isnull=True)
+            if storage_ids is not None:
+                candidates = candidates.filter(storage_id__in=storage_ids)
+            job = candidates.order_by('date_queued').first()
+            if job is None:
+                return None
+
+            if job.num_attempts >= settings.PHOTO_PROCESSING_JOB_MAX_ATTEMPTS:
+                self.filter(pk=job.pk, date_started=job.date_started, date_failed__isnull=True) \
+                        .update(date_failed=now, error=u'Timed out')
+                continue
+
+            # Only succeeds if no other worker claimed the job in the meantime
+            num_claimed = self.filter(pk=job.pk, date_started=job.date_started) \
+                    .update(date_started=now, num_attempts=models.F('num_attempts') + 1)
+            if num_claimed == 1:
+                job.date_started = now
+                job.num_attempts += 1
+                return job
+
+    def record_failure(self, job, now, error):
+        """
+        Called when running a claimed job raised an exception. The job will be
+        run again, unless it was already attempted
+        `settings.PHOTO_PROCESSING_JOB_MAX_ATTEMPTS' times, in which case it is
+        marked as failed
+        """
+        if job.num_attempts >= settings.PHOTO_PROCESSING_JOB_MAX_ATTEMPTS:
+            self.filter(pk=job.pk).update(date_failed=now, error=error)
+        else:
+            self.filter(pk=job.pk).update(date_started=None, error=error)
+
+    def get_queue_length(self):
+        """
+        The number of jobs that have not failed
+        """
+        return self.filter(date_failed__isnull=True).count()
+
+    def get_num_failed(self):
+        return self.filter(date_failed__isnull=False).count()
+
+
+class PhotoProcessingJob(models.Model):
+    """
+    A photo that has been uploaded (when USING_LOCAL_PHOTOS) and still needs
+    to be processed. The job is deleted when it is done. Jobs that failed are
+    kept (with their date_failed), so that the photo will not be waited for
+    """
+    storage_id = models.CharField(unique=True, max_length=128)
+    date_queued = models.DateTimeField(db_index=True)
+    date_started = models.DateTimeField(null=True, blank=True)
+    num_attempts = models.IntegerField(default=0)
+    date_failed = models.DateTimeField(null=True, blank=True)
+    # The error of the last failed attempt
+    error = models.TextField(blank=True)
+
+    objects = PhotoProcessingJobManager()
+
+    def __unicode__(self):
+        return self.storage_id
+
+
+class ProcessedImageManifestManager(models.Manager):
+    def record(self, storage_id, img_width, img_height, image_size_strs, now):
+        """
+        Records that the resized versions `image_size_strs' of the photo have
+        been created. They are added to the sizes that are already in the
+        manifest (unless it is from a different version of the image sizes)
+        """
+        current_version = image_uploads.get_image_sizes_version()
+
+        new_sizes = {}
+        for image_size_str in image_size_strs:
+            new_sizes[image_size_str] = image_uploads.image_sizes[image_size_str].get_image_dimensions(img_width, img_height)
+
+        while True:
+            with transaction.atomic():
+                manifest = self.select_for_update().filter(storage_id=storage_id).first()
+                if manifest is not None:
+                    if manifest.version == current_version:
+                        sizes = manifest.get_sizes()
+                    else:
+                        sizes = {}
+                    sizes.update(new_sizes)
+                    manifest.width = img_width
+                    manifest.height = img_height
+                    manifest.sizes = json.dumps(sizes, separators=(',', ':'), sort_keys=True)
+                    manifest.version = current_version
+                    manifest.date_processed = now
+                    manifest.save()
+                    return
 
-        success = False
-        while not success:
             try:
                 with transaction.atomic():
-                    next_album_index = get_next_album_index(album)
-                    p, created = Photo.objects.get_or_create(
-                        client_upload_id = client_upload_id,
-                        storage_id=storage_id,
-                        defaults={
-                            'photo_id': Photo.generate_photo_id(),
-                            'media_type': Photo.MEDIA_TYPE_VIDEO,
-                            'date_created': now,
-                            'author': author,
-                            'album': album,
-                            'album_index': next_album_index
-                        })
+                    self.create(
+                            storage_id = storage_id,
+                            width = img_width,
+                            height = img_height,
+                            sizes = json.dumps(new_sizes, separators=(',', ':'), sort_keys=True),
+                            version = current_version,
+                            date_processed = now)
+                    return
             except IntegrityError:
-                # This will happen if there is a collision with a duplicate
-                # 'album_index' from a concurrent request
-                success = False
-            else:
-                success = True
+                # Created concurrently, so add to it instead
+                pass
+
+    def forget(self, storage_id, image_size_strs):
+        """
+        Records that the resized versions `image_size_strs' of the photo no
+        longer exist
+        """
+        with transaction.atomic():
+            manifest = self.select_for_update().filter(storage_id=storage_id).first()
+            if manifest is None:
+                return
+            sizes = manifest.get_sizes()
+            for image_size_str in image_size_strs:
+                sizes.pop(image_size_str, None)
+            manifest.sizes = json.dumps(sizes, separators=(',', ':'), sort_keys=True)
+            manifest.save(update_fields=['sizes'])
+
+    def get_original_dimensions(self, storage_id):
+        """
+        Returns the (width, height) of the original image, or (None, None) if
+        the photo has not been processed
+        """
+        dimensions = self.filter(storage_id=storage_id).values_list('width', 'height').first()
+        if dimensions is None:
+            return (None, None)
+        return dimensions
+
+    def get_missing_image_sizes(self, storage_ids, image_size_strs=None):
+        """
+        Returns a dict that maps every one of the `storage_ids' to a list of
+        the resized versions that still need to be created. An empty list means
+        that the photo is fully processed.
+
+        image_size_strs: The resized versions that are required. By default
+        these are the ones that are created during upload
+
+        Photos that have no manifest, or that were processed with a different
+        version of `image_uploads.image_sizes', are missing all of them.
+        """
+        if image_size_strs is None:
+            image_size_strs = image_uploads.get_eager_image_size_strs()
+        image_size_strs = sorted(image_size_strs)
+
+        current_version = image_uploads.get_image_sizes_version()
+
+        result = {}
+        for storage_id in storage_ids:
+            result[storage_id] = image_size_strs
+
+        storage_ids = list(storage_ids)
+        # Stay well below the limit of the number of query parameters of the
+        # database
+        CHUNK_SIZE = 500
+        for i in xrange(0, len(storage_ids), CHUNK_SIZE):
+            manifests = self.filter(storage_id__in=storage_ids[i:i+CHUNK_SIZE]).values_list('storage_id', 'sizes', 'version')
+            for storage_id, sizes, version in manifests:
+                if version == current_version:
+                    sizes = json.loads(sizes)
+                    result[storage_id] = [s for s in image_size_strs if s not in sizes]
+
+        return result
+
+
+class ProcessedImageManifest(models.Model):
+    """
+    Records which resized versions of a photo exist (and their dimensions), so
+    that the files don't need to be checked one by one
+    """
+    storage_id = models.CharField(primary_key=True, max_length=128)
+    width = models.IntegerField()
+    height = models.IntegerField()
+    # JSON object that maps each image size (see `image_uploads.image_sizes')
+    # to its [width, height]
+    sizes = models.TextField()
+    # See `image_uploads.get_image_sizes_version'
+    version = models.CharField(max_length=40)
+    date_processed = models.DateTimeField()
+
+    objects = ProcessedImageManifestManager()
+
+    def __unicode__(self):
+        return self.storage_id
+
+    def get_sizes(self):
+        return json.loads(self.sizes)
+
+
+class VideoManager(models.Manager):
+    def set_processing(self, client_upload_id, storage_id, author, album, now):
+        with transaction.atomic():
+            try:
+                Photo.objects.get(client_upload_id=client_upload_id, storage_id=storage_id)
+                created = False
+            except Photo.DoesNotExist:
+                photo = Photo.objects.create(
+                    client_upload_id = client_upload_id,
+                    storage_id = storage_id,
+                    photo_id = Photo.generate_photo_id(),
+                    media_type = Photo.MEDIA_TYPE_VIDEO,
+                    date_created = now,
+                    author = author,
+                    album = album,
+                    album_index = album.allocate_album_indexes())
+                created = True
         if created:
             Video.objects.create(
                 storage_id = storage_id,
                 status = Video.STATUS_PROCESSING,
                 duration = 0)
-            album.save_revision(now)
+            album.save_revision(now, changes=[AlbumChange(
+                change_type = AlbumChange.CHANGE_PHOTO_ADDED,
+                photo_id = photo.photo_id)])
+
+    def get_album_video_changes(self, storage_id, album):
+        return [AlbumChange(change_type=AlbumChange.CHANGE_PHOTO_UPDATED, photo_id=photo_id)
+                for photo_id in Photo.objects.filter(album=album, storage_id=storage_id).values_list('photo_id', flat=True)]
 
     def set_invalid(self, client_upload_id, storage_id, author, album, now):
         self.set_processing(client_upload_id, storage_id, author, album, now)
@@ -663,7 +1284,7 @@ class VideoManager(models.Manager):
         if video.status == Video.STATUS_PROCESSING:
             video.status = Video.STATUS_INVALID
             video.save(update_fields=['status'])
-            album.save_revision(now)
+            album.save_revision(now, changes=self.get_album_video_changes(storage_id, album))
         elif video.status != Video.STATUS_INVALID:
             raise RuntimeError('Invalid transition from status: ' + video.status)
 
@@ -674,7 +1295,7 @@ class VideoManager(models.Manager):
             video.status = Video.STATUS_READY
             video.duration = duration
             video.save(update_fields=['status', 'duration'])
-            album.save_revision(now,True)
+            album.save_revision(now, True, self.get_album_video_changes(storage_id, album))
 
             photo = video.get_photo()
 
@@ -768,23 +1389,25 @@ class PhotoGlanceScoreDeltaManager(models.Manager):
         Returns True if the score was different from the previous score set by
         the user.  Returns False if the score did not change.
         """
-        photo_glance_score_delta, created = self.get_or_create(photo=photo, author=user,
-                defaults={
-                    'date_created': now,
-                    'score_delta': score_delta
-                })
-        if created:
-            changed = (score_delta != 0)
-            if changed:
-                photo.update_glance_score(score_delta)
-        if not created:
-            old_score_delta = photo_glance_score_delta.score_delta
-            changed = (old_score_delta != score_delta)
-            if changed:
-                photo_glance_score_delta.score_delta = score_delta
-                photo_glance_score_delta.date_created = now
-                photo_glance_score_delta.save(update_fields=['score_delta', 'date_created'])
-                photo.update_glance_score(score_delta - old_score_delta)
+        # The delta and the photo scores must always be changed together
+        with transaction.atomic():
+            photo_glance_score_delta, created = self.get_or_create(photo=photo, author=user,
+                    defaults={
+                        'date_created': now,
+                        'score_delta': score_delta
+                    })
+            if created:
+                changed = (score_delta != 0)
+                if changed:
+                    photo.update_glance_score(score_delta)
+            if not created:
+                old_score_delta = photo_glance_score_delta.score_delta
+                changed = (old_score_delta != score_delta)
+                if changed:
+                    photo_glance_score_delta.score_delta = score_delta
+                    photo_glance_score_delta.date_created = now
+                    photo_glance_score_delta.save(update_fields=['score_delta', 'date_created'])
+                    photo.update_glance_score(score_delta - old_score_delta)
 
         return changed
 
@@ -822,6 +1445,9 @@ class PhotoServer(models.Model):
     auth_key = models.CharField(max_length=128)
     date_registered = models.DateTimeField()
     unreachable = models.BooleanField()
+    # The id of the last PhotoServerChange that was sent to the server when it
+    # registered
+    last_change_id = models.IntegerField(default=0)
 
     def __unicode__(self):
         result = ''
@@ -833,3 +1459,181 @@ class PhotoServer(models.Model):
     def set_unreachable(self):
         self.unreachable = True
         self.save(update_fields=['unreachable'])
+
+
+class PhotoServerChangeManager(models.Manager):
+    def record_set_photos(self, photos, now):
+        self.bulk_create([PhotoServerChange(
+            subdomain = p.subdomain,
+            photo_id = p.photo_id,
+            cmd = PhotoServerChange.CMD_SET,
+            storage_id = p.storage_id,
+            date_created = now) for p in photos])
+
+    def record_delete_photos(self, photos, now):
+        self.bulk_create([PhotoServerChange(
+            subdomain = p.subdomain,
+            photo_id = p.photo_id,
+            cmd = PhotoServerChange.CMD_DELETE,
+            storage_id = '',
+            date_created = now) for p in photos])
+
+    def get_last_id(self, before=None):
+        """
+        before: If given, only changes from before this time are considered
+
+        Returns 0 if there are no changes
+        """
+        q = self.all()
+        if before is not None:
+            q = q.filter(date_created__lt=before)
+        last_id = q.order_by('-id').values_list('id', flat=True).first()
+        if last_id is None:
+            return 0
+        return last_id
+
+    def prune(self, before):
+        """
+        Deletes the changes from before the time `before' that all of the
+        reachable photo servers have already received
+        """
+        min_last_change_id = PhotoServer.objects.filter(unreachable=False).aggregate(models.Min('last_change_id'))['last_change_id__min']
+        if min_last_change_id is None:
+            # No photo servers. New ones are sent the photos themselves, so
+            # old changes are not needed
+            self.filter(date_created__lt=before).delete()
+        else:
+            self.filter(id__lte=min_last_change_id, date_created__lt=before).delete()
+
+
+class PhotoServerChange(models.Model):
+    """
+    An append-only log of the changes to the photos that the photo servers
+    must know about, in the order that they happened. Changes are recorded in
+    the same transaction as the change to the Photo, and are delivered to
+    every photo server in batches by `photo_operations.dispatch_photo_server_changes'.
+
+    A newly registered photo server is first sent all of the photos of its
+    subdomain, and then the changes that happened while that was being done
+    (see `photo_operations.register_photo_server')
+    """
+    CMD_SET = 1
+    CMD_DELETE = 2
+    CMD_CHOICES = (
+        (CMD_SET, 'set'),
+        (CMD_DELETE, 'delete'),
+    )
+
+    subdomain = models.CharField(max_length=64)
+    photo_id = models.CharField(max_length=128)
+    cmd = models.IntegerField(choices=CMD_CHOICES, default=CMD_SET)
+    # Empty for CMD_DELETE
+    storage_id = models.CharField(max_length=128)
+    date_created = models.DateTimeField()
+
+    objects = PhotoServerChangeManager()
+
+    class Meta:
+        index_together = (('subdomain', 'id'),)
+
+    def get_command(self):
+        """
+        Returns the command in the format of the photo server update API
+        """
+        if self.cmd == PhotoServerChange.CMD_SET:
+            return {
+                'cmd': 'set',
+                'key': self.photo_id,
+                'value': self.storage_id,
+                }
+        else:
+            return {
+                'cmd': 'delete',
+                'key': self.photo_id,
+                }
+
+
+def record_photo_server_delete(sender, instance, **kwargs):
+    # Videos are not stored on the photo servers
+    if instance.subdomain:
+        PhotoServerChange.objects.record_delete_photos([instance], timezone.now())
+
+models.signals.post_delete.connect(record_photo_server_delete, sender=Photo)
+
+def remove_deleted_copy_glance_score(sender, instance, **kwargs):
+    if instance.copied_from_photo_id:
+        # The instance may have an old value
+        score = Photo.objects.filter(pk=instance.photo_id).values_list('photo_glance_score', flat=True).first()
+        if score:
+            Photo.objects.filter(pk=instance.copied_from_photo_id) \
+                    .update(global_glance_score=models.F('global_glance_score') - score)
+            GlobalGlanceScoreChange.objects.record(instance.copied_from_photo_id)
+
+models.signals.pre_delete.connect(remove_deleted_copy_glance_score, sender=Photo)
+
+def touch_album_lists(users):
+    """
+    Records that the album lists of the users (a queryset) have changed now
+    (see `User.album_list_last_changed')
+    """
+    users.update(album_list_last_changed=timezone.now())
+
+def touch_member_album_list(sender, instance, raw=False, **kwargs):
+    # Fixtures don't change anything that was already sent to clients
+    if not raw:
+        touch_album_lists(get_user_model().objects.filter(pk=instance.user_id))
+
+models.signals.post_save.connect(touch_member_album_list, sender=AlbumMember)
+models.signals.post_delete.connect(touch_member_album_list, sender=AlbumMember)
+models.signals.post_save.connect(touch_member_album_list, sender=UserHiddenPhoto)
+
+def save_member_updated_revisions(user_id):
+    """
+    Saves a revision of every album of the user, after a change to the fields
+    of the user that are part of the members of the albums
+    """
+    now = timezone.now()
+    for album in Album.objects.filter(memberships__user=user_id):
+        album.save_revision(now, changes=[AlbumChange(
+            change_type = AlbumChange.CHANGE_MEMBER_UPDATED,
+            user_id = user_id)])
+
+def save_album_revisions_on_invite_status_changed(sender, user_id, **kwargs):
+    # The invite status is part of the members of every album of the user
+    save_member_updated_revisions(user_id)
+
+user_invite_status_changed.connect(save_album_revisions_on_invite_status_changed)
+
+def save_user_updated_revisions(user_id):
+    """
+    Saves a revision of every album that shows the user, after a change to
+    the fields of the user that are part of the members of the albums, and
+    of the authors of photos and comments. These are the albums of the user,
+    and the albums with photos or comments by the user (who may have left
+    them)
+    """
+    now = timezone.now()
+    album_changes = {}
+    for album_id in AlbumMember.objects.filter(user=user_id).values_list('album_id', flat=True):
+        album_changes.setdefault(album_id, []).append(AlbumChange(
+            change_type = AlbumChange.CHANGE_MEMBER_UPDATED,
+            user_id = user_id))
+    for album_id, photo_id in Photo.objects \
+            .filter(models.Q(author=user_id) | models.Q(photocomment__author=user_id)) \
+            .values_list('album_id', 'photo_id') \
+            .distinct():
+        album_changes.setdefault(album_id, []).append(AlbumChange(
+            change_type = AlbumChange.CHANGE_PHOTO_UPDATED,
+            photo_id = photo_id))
+
+    for album in Album.objects.filter(pk__in=album_changes.keys()):
+        album.save_revision(now, changes=album_changes[album.id])
+
+def save_album_revisions_on_user_changed(sender, user, **kwargs):
+    # The nickname and avatar are part of the members of every album of the
+    # user (and the nickname is part of the name of the albums without one),
+    # and of the authors of the user's photos and comments
+    save_user_updated_revisions(user.id)
+
+user_avatar_changed.connect(save_album_revisions_on_user_changed)
+user_nickname_changed.connect(save_album_revisions_on_user_changed)
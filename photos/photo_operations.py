@@ -1,57 +1,25 @@
-import Queue
+import datetime
 import sys
-import threading
 import time
-import json
 
 from django.conf import settings
-from django.db.models import Max
 from django.db import IntegrityError
 from django.db import transaction
-from django.db import connection
-import django.db
+from django.utils import timezone
 
 import requests
 
+from photos import image_uploads
 from photos.models import Album
+from photos.models import AlbumChange
 from photos.models import PendingPhoto
 from photos.models import Photo
 from photos.models import PhotoServer
+from photos.models import PhotoServerChange
+from photos.models import ProcessedImageManifest
+from photos import photo_servers
+from photos import worker_pool
 from photos_api.signals import photos_added_to_album
-from photos_api.device_push import in_testing_mode
-
-# TODO This module should use be updated to use real background tasks instead
-# of a background thread
-
-# See:
-#     http://stackoverflow.com/questions/2829329/catch-a-threads-exception-in-the-caller-thread-in-python/6874161#6874161
-class ExThread(threading.Thread):
-    def __init__(self):
-        threading.Thread.__init__(self)
-        self.__status_queue = Queue.Queue()
-
-    def run_with_exception(self):
-        """This method should be overriden."""
-        raise NotImplementedError
-
-    def run(self):
-        """This method should NOT be overriden."""
-        try:
-            self.run_with_exception()
-        except Exception:
-            self.__status_queue.put(sys.exc_info())
-        self.__status_queue.put(None)
-
-    def wait_for_exc_info(self):
-        return self.__status_queue.get()
-
-    def join_with_exception(self):
-        ex_info = self.wait_for_exc_info()
-        if ex_info is None:
-            return
-        else:
-            raise ex_info[1]
-
 
 class AddPhotoException(Exception):
     pass
@@ -65,133 +33,199 @@ class InvalidPhotoIdAddPhotoException(AddPhotoException):
     pass
 
 
-class AddPendingPhotosToAlbumAction(ExThread):
-    def __init__(self, photo_ids, album_id, date_created):
-        ExThread.__init__(self)
+class PhotoProcessingFailedAddPhotoException(AddPhotoException):
+    pass
 
+
+class AddPendingPhotosToAlbumAction(object):
+    def __init__(self, photo_ids, album_id, date_created):
         self.photo_ids = photo_ids
         self.album_id = album_id
         self.date_created = date_created
 
+    def get_pending_photos(self, photo_ids):
+        """
+        Returns a dictionary from photo_id to PendingPhoto, for all of the
+        `photo_ids' that have not been added yet.
+
+        Raises InvalidPhotoIdAddPhotoException if any of the `photo_ids' is
+        neither a PendingPhoto nor a Photo. The number of queries does not
+        depend on the number of photos.
+        """
+        pending_photos = bulk_get(PendingPhoto.objects.all(), photo_ids)
+
+        # If there is no PendingPhoto but there is a Photo, then we are ok
+        missing_photo_ids = set(photo_ids) - set(pending_photos)
+        if missing_photo_ids:
+            photos = bulk_get(Photo.objects.only('photo_id'), missing_photo_ids)
+            if len(photos) != len(missing_photo_ids):
+                raise InvalidPhotoIdAddPhotoException()
+
+        return pending_photos
+
     def verify_all_uploaded(self, photo_ids):
         # Make sure that all photos have been already uploaded
-        for photo_id in photo_ids:
-            try:
-                pending_photo = PendingPhoto.objects.get(photo_id=photo_id)
-            except PendingPhoto.DoesNotExist:
-                # If there is no PendingPhoto but there is a Photo, then we are ok
-                try:
-                    Photo.objects.get(photo_id=photo_id)
-                except Photo.DoesNotExist:
-                    raise InvalidPhotoIdAddPhotoException()
-                else:
-                    pass
-            else:
-                if not pending_photo.is_file_uploaded():
-                    raise PhotoNotUploadedAddPhotoException()
+        for pending_photo in self.get_pending_photos(photo_ids).itervalues():
+            if not pending_photo.is_file_uploaded():
+                raise PhotoNotUploadedAddPhotoException()
 
     def all_processing_done(self, photo_ids):
-        for photo_id in photo_ids:
-            try:
-                pending_photo = PendingPhoto.objects.get(photo_id=photo_id)
-            except PendingPhoto.DoesNotExist:
-                # If there is no PendingPhoto but there is a Photo, then we are ok
-                try:
-                    Photo.objects.get(photo_id=photo_id)
-                except Photo.DoesNotExist:
-                    raise InvalidPhotoIdAddPhotoException()
-                else:
-                    pass
-            else:
-                if not pending_photo.is_processing_done():
-                    return False
+        for pending_photo in self.get_pending_photos(photo_ids).itervalues():
+            if not pending_photo.is_processing_done():
+                return False
 
         return True
 
+    def wait_for_queued_processing(self, photo_ids):
+        """
+        Used when settings.PHOTO_PROCESSING_ASYNC is set. Waits for the workers
+        to finish the processing jobs of the photos (see
+        `image_uploads.wait_for_queued_jobs')
+
+        Raises PhotoProcessingFailedAddPhotoException if any of the jobs
+        failed
+        """
+        storage_ids = [p.storage_id for p in self.get_pending_photos(photo_ids).itervalues()]
+
+        failed_storage_ids = image_uploads.wait_for_queued_jobs(storage_ids, settings.PHOTO_PROCESSING_JOB_TIMEOUT)
+        if failed_storage_ids:
+            raise PhotoProcessingFailedAddPhotoException()
+        if failed_storage_ids is None or not self.all_processing_done(photo_ids):
+            raise RuntimeError('Photo Processing Timeout: ' + str(photo_ids))
+
     def add_photos_to_db(self, photo_ids):
         """
         Returns a dictionary from subdomain values to lists of Photo objects
         """
-        added_photos = {}
-
         album = Album.objects.get(pk=self.album_id)
-        album_index_q = Photo.objects.filter(album=album).aggregate(Max('album_index'))
 
-        max_album_index = album_index_q['album_index__max']
-        if max_album_index is None:
-            next_album_index = 0
-        else:
-            next_album_index = max_album_index + 1
+        pending_photos_by_id = self.get_pending_photos(photo_ids)
 
+        # In the order of `photo_ids', which is the order that they are added
+        # to the album
+        pending_photos = []
         for photo_id in photo_ids:
+            pending_photo = pending_photos_by_id.pop(photo_id, None)
+            if pending_photo is not None:
+                pending_photos.append(pending_photo)
+
+        if not pending_photos:
+            return {}
+
+        try:
+            with transaction.atomic():
+                added_photos = self.bulk_add_photos_to_db(album, pending_photos)
+        except IntegrityError:
+            # Some of the photos were added by a concurrent request. Fall back
+            # to adding them one at a time, which skips those
+            added_photos = self.add_photos_to_db_one_by_one(album, pending_photos)
+
+        # This is safe to call even if some were already deleted by a
+        # concurrent request
+        for chunk in chunks([p.photo_id for p in pending_photos], BULK_CHUNK_SIZE):
+            PendingPhoto.objects.filter(photo_id__in=chunk).delete()
+
+        return added_photos
+
+    def bulk_add_photos_to_db(self, album, pending_photos):
+        """
+        Adds all of the photos with a single INSERT statement (per chunk).
+        Raises IntegrityError if any of them was already added
+
+        Returns a dictionary from subdomain values to lists of Photo objects
+        """
+        manifests = bulk_get(
+                ProcessedImageManifest.objects.only('storage_id', 'width', 'height'),
+                [p.storage_id for p in pending_photos])
+
+        next_album_index = album.allocate_album_indexes(len(pending_photos))
+
+        added_photos = {}
+        new_photos = []
+        for pending_photo in pending_photos:
+            manifest = manifests.get(pending_photo.storage_id)
+            chosen_subdomain = Photo.choose_random_subdomain()
+            p = Photo(
+                photo_id = pending_photo.photo_id,
+                media_type = Photo.MEDIA_TYPE_PHOTO,
+                client_upload_id = '',
+                storage_id = pending_photo.storage_id,
+                subdomain = chosen_subdomain,
+                date_created = self.date_created,
+                author_id = pending_photo.author_id,
+                album = album,
+                album_index = next_album_index,
+                width = manifest.width if manifest else None,
+                height = manifest.height if manifest else None,
+            )
+            new_photos.append(p)
+            if chosen_subdomain in added_photos:
+                added_photos[chosen_subdomain].append(p)
+            else:
+                added_photos[chosen_subdomain] = [p]
+
+            next_album_index += 1
+
+        Photo.objects.bulk_create(new_photos, batch_size=BULK_CHUNK_SIZE)
+
+        return added_photos
+
+    def add_photos_to_db_one_by_one(self, album, pending_photos):
+        """
+        Like `bulk_add_photos_to_db', but photos that were already added (by
+        a concurrent request) are skipped
+
+        Returns a dictionary from subdomain values to lists of Photo objects
+        """
+        added_photos = {}
+
+        next_album_index = album.allocate_album_indexes(len(pending_photos))
+
+        for pending_photo in pending_photos:
+            photo_id = pending_photo.photo_id
+            (width, height) = ProcessedImageManifest.objects.get_original_dimensions(pending_photo.storage_id)
             try:
-                pending_photo = PendingPhoto.objects.get(photo_id=photo_id)
-            except PendingPhoto.DoesNotExist:
+                with transaction.atomic():
+                    chosen_subdomain = Photo.choose_random_subdomain()
+                    p = Photo.objects.create(
+                        photo_id=photo_id,
+                        media_type = Photo.MEDIA_TYPE_PHOTO,
+                        client_upload_id = '',
+                        storage_id = pending_photo.storage_id,
+                        subdomain = chosen_subdomain,
+                        date_created = self.date_created,
+                        author_id=pending_photo.author_id,
+                        album=album,
+                        album_index = next_album_index,
+                        width = width,
+                        height = height,
+                    )
+                    if chosen_subdomain in added_photos:
+                        added_photos[chosen_subdomain].append(p)
+                    else:
+                        added_photos[chosen_subdomain] = [p]
+            except IntegrityError:
+                t, v, tb = sys.exc_info()
+                # The album_index values were reserved for this request, so
+                # this can only happen if photo_id was already added (by a
+                # concurrent request). In that case there is nothing to
+                # do, and the reserved album_index is left unused
                 try:
                     Photo.objects.get(pk=photo_id)
                 except Photo.DoesNotExist:
-                    raise InvalidPhotoIdAddPhotoException()
-                else:
-                    pass
-            else:
-                try:
-                    with transaction.atomic():
-                        chosen_subdomain = Photo.choose_random_subdomain()
-                        p = Photo.objects.create(
-                            photo_id=photo_id,
-                            media_type = Photo.MEDIA_TYPE_PHOTO,
-                            client_upload_id = '',
-                            storage_id = pending_photo.storage_id,
-                            subdomain = chosen_subdomain,
-                            date_created = self.date_created,
-                            author=pending_photo.author,
-                            album=album,
-                            album_index = next_album_index,
-                        )
-                        if chosen_subdomain in added_photos:
-                            added_photos[chosen_subdomain].append(p)
-                        else:
-                            added_photos[chosen_subdomain] = [p]
-                except IntegrityError:
-                    t, v, tb = sys.exc_info()
-                    # Two possible scenarios:
-                    #
-                    # 1)  The album_index we tried to add was already added (by a
-                    #     concurrent request)
-                    #
-                    # 2)  photo_id was already added (by a concurrent request)
-
-                    try:
-                        Photo.objects.get(pk=photo_id)
-                    except Photo.DoesNotExist:
-                        # This is most likely case (1). We let the original
-                        # exception bubble up (the calling code will retry this function)
-                        raise t, v, tb
-                    else:
-                        # This is case (2)
-                        # The photo is already added, so there is nothing to do
-                        pass
-                else:
-                    # Notice that this is only incremented if a new object was
-                    # actually inserted
-                    next_album_index += 1
+                    raise t, v, tb
 
-                # This is safe to call even if it was already deleted by a
-                # concurrent request (will be a nop)
-                pending_photo.delete()
+            next_album_index += 1
 
         return added_photos
 
-    def run_with_exception(self):
-        try:
-            self.perform_action()
-        finally:
-            django.db.close_old_connections()
-
     def perform_action(self):
         self.verify_all_uploaded(self.photo_ids)
 
-        if not settings.USING_LOCAL_PHOTOS:
+        if settings.USING_LOCAL_PHOTOS:
+            if settings.PHOTO_PROCESSING_ASYNC:
+                self.wait_for_queued_processing(self.photo_ids)
+        else:
             retry_count = 2
             while not self.all_processing_done(self.photo_ids):
                 # TODO This should be more robust and also "kick" the photo
@@ -208,26 +242,28 @@ class AddPendingPhotosToAlbumAction(ExThread):
                 time.sleep(RETRY_TIME)
 
         with transaction.atomic():
-            success = False
-            while not success:
-                try:
-                    with transaction.atomic():
-                        added_photos = self.add_photos_to_db(self.photo_ids)
-                except IntegrityError:
-                    success = False
-                else:
-                    success = True
+            added_photos = self.add_photos_to_db(self.photo_ids)
 
             update_all_photo_servers(added_photos)
 
             album = Album.objects.get(pk=self.album_id)
-            album.save_revision(self.date_created, True)
+            album.save_revision(self.date_created, True, photos_added_changes(added_photos))
 
 
-class CopyPhotosToAlbumAction(ExThread):
-    def __init__(self, author, photo_ids, album_id, date_created):
-        ExThread.__init__(self)
+def photos_added_changes(added_photos):
+    """
+    added_photos: A dict from subdomains to lists of photos (as used by
+    `update_all_photo_servers')
+
+    Returns the `AlbumChange' objects for the album revision
+    """
+    return [AlbumChange(change_type=AlbumChange.CHANGE_PHOTO_ADDED, photo_id=p.photo_id)
+            for photos in added_photos.itervalues()
+            for p in photos]
 
+
+class CopyPhotosToAlbumAction(object):
+    def __init__(self, author, photo_ids, album_id, date_created):
         self.author = author
         self.photo_ids = photo_ids
         self.album_id = album_id
@@ -240,14 +276,9 @@ class CopyPhotosToAlbumAction(ExThread):
         added_photos = {}
 
         album = Album.objects.get(pk=self.album_id)
-        album_index_q = Photo.objects.filter(album=album).aggregate(Max('album_index'))
-
-        max_album_index = album_index_q['album_index__max']
-        if max_album_index is None:
-            next_album_index = 0
-        else:
-            next_album_index = max_album_index + 1
 
+        photos_to_copy = []
+        storage_ids_to_copy = set()
         for photo_id in photo_ids:
             try:
                 photo = Photo.objects.get(photo_id=photo_id)
@@ -255,29 +286,34 @@ class CopyPhotosToAlbumAction(ExThread):
                 # Silently ignore any non-existing photo_ids
                 pass
             else:
+                if photo.storage_id in storage_ids_to_copy:
+                    continue
                 if not Photo.objects.filter(
                         album=album,
                         storage_id=photo.storage_id,
                         author=self.author).exists():
-                    p = photo.create_copy(self.author, album, next_album_index, self.date_created)
-                    chosen_subdomain = p.subdomain
-                    if chosen_subdomain in added_photos:
-                        added_photos[chosen_subdomain].append(p)
-                    else:
-                        added_photos[chosen_subdomain] = [p]
+                    photos_to_copy.append(photo)
+                    storage_ids_to_copy.add(photo.storage_id)
 
-                    if PendingPhoto.objects.filter(photo_id=p.photo_id).exists():
-                        raise IntegrityError
+        if not photos_to_copy:
+            return added_photos
 
-                    next_album_index += 1
+        next_album_index = album.allocate_album_indexes(len(photos_to_copy))
 
-        return added_photos
+        for photo in photos_to_copy:
+            p = photo.create_copy(self.author, album, next_album_index, self.date_created)
+            chosen_subdomain = p.subdomain
+            if chosen_subdomain in added_photos:
+                added_photos[chosen_subdomain].append(p)
+            else:
+                added_photos[chosen_subdomain] = [p]
 
-    def run_with_exception(self):
-        try:
-            self.perform_action()
-        finally:
-            django.db.close_old_connections()
+            if PendingPhoto.objects.filter(photo_id=p.photo_id).exists():
+                raise IntegrityError
+
+            next_album_index += 1
+
+        return added_photos
 
     def perform_action(self):
         with transaction.atomic():
@@ -287,6 +323,9 @@ class CopyPhotosToAlbumAction(ExThread):
                     with transaction.atomic():
                         added_photos = self.add_photos_to_db(self.photo_ids)
                 except IntegrityError:
+                    # A newly generated photo_id collided with a PendingPhoto
+                    # (see `add_photos_to_db'). This is very unlikely, so just
+                    # try again with new photo_ids
                     success = False
                 else:
                     success = True
@@ -294,105 +333,65 @@ class CopyPhotosToAlbumAction(ExThread):
             update_all_photo_servers(added_photos)
 
             album = Album.objects.get(pk=self.album_id)
-            album.save_revision(self.date_created, True)
+            album.save_revision(self.date_created, True, photos_added_changes(added_photos))
 
 
-def request_with_n_retries(num_retries, initial_retry_time, action):
-    num_retries_left = num_retries
-    retry_time = initial_retry_time
-    while True:
-        try:
-            return action()
-        except requests.exceptions.RequestException:
-            if num_retries_left > 0:
-                time.sleep(retry_time)
-                retry_time *= 2
-                num_retries_left -= 1
-            else:
-                raise
+# Stay well below the limit of the number of query parameters of the database
+BULK_CHUNK_SIZE = 500
+
+def chunks(l, n):
+    for i in xrange(0, len(l), n):
+        yield l[i:i + n]
+
+def bulk_get(queryset, pks):
+    """
+    Like `queryset.in_bulk(pks)', but works with any number of pks
+    """
+    result = {}
+    for chunk in chunks(list(pks), BULK_CHUNK_SIZE):
+        result.update(queryset.in_bulk(chunk))
+    return result
 
 
 def add_pending_photos_to_album(photo_ids, album_id, date_created):
     """
     May throw 'AddPhotoException'
     """
-
-    # TODO This is only current needed to make tests work with sqlite
-    # See this bug:
-    #     https://code.djangoproject.com/ticket/12118
-    if settings.USING_LOCAL_PHOTOS:
-        action = AddPendingPhotosToAlbumAction(photo_ids, album_id, date_created)
-        action.perform_action()
-    else:
-        thread = AddPendingPhotosToAlbumAction(photo_ids, album_id, date_created)
-        thread.daemon = False
-        thread.start()
-        thread.join_with_exception()
+    action = AddPendingPhotosToAlbumAction(photo_ids, album_id, date_created)
+    worker_pool.run_action(action.perform_action)
 
 
 def copy_photos_to_album(author, photo_ids, album_id, date_created):
-    # TODO This is only current needed to make tests work with sqlite
-    # See this bug:
-    #     https://code.djangoproject.com/ticket/12118
-    if settings.USING_LOCAL_PHOTOS:
-        action = CopyPhotosToAlbumAction(author, photo_ids, album_id, date_created)
-        action.perform_action()
-    else:
-        thread = CopyPhotosToAlbumAction(author, photo_ids, album_id, date_created)
-        thread.daemon = False
-        thread.start()
-        thread.join_with_exception()
-
-def add_photo(client_upload_id, storage_id, author, album, now):
-    def get_next_album_index(album):
-        album_index_q = Photo.objects.filter(album=album).aggregate(Max('album_index'))
-
-        max_album_index = album_index_q['album_index__max']
-        if max_album_index is None:
-            return 0
-        else:
-            return max_album_index + 1
+    action = CopyPhotosToAlbumAction(author, photo_ids, album_id, date_created)
+    worker_pool.run_action(action.perform_action)
 
-    success = False
-    while not success:
+def add_photo(client_upload_id, storage_id, author, album, now, width=None, height=None):
+    """
+    width, height: The dimensions of the original (orientation corrected)
+    image, if they are known
+    """
+    with transaction.atomic():
         try:
-            with transaction.atomic():
-                next_album_index = get_next_album_index(album)
-                p, created = Photo.objects.get_or_create(
-                    storage_id=storage_id,
-                    defaults={
-                        'photo_id': Photo.generate_photo_id(),
-                        'media_type': Photo.MEDIA_TYPE_PHOTO,
-                        'client_upload_id': client_upload_id,
-                        'subdomain': Photo.choose_random_subdomain(),
-                        'date_created': now,
-                        'author': author,
-                        'album': album,
-                        'album_index': next_album_index
-                    })
-        except IntegrityError:
-            # This will happen if there is a collision with a duplicate
-            # 'album_index' from a concurrent request
-            success = False
-        else:
-            success = True
+            p = Photo.objects.get(storage_id=storage_id)
+            created = False
+        except Photo.DoesNotExist:
+            p = Photo.objects.create(
+                photo_id = Photo.generate_photo_id(),
+                media_type = Photo.MEDIA_TYPE_PHOTO,
+                client_upload_id = client_upload_id,
+                storage_id = storage_id,
+                subdomain = Photo.choose_random_subdomain(),
+                date_created = now,
+                author = author,
+                album = album,
+                album_index = album.allocate_album_indexes(),
+                width = width,
+                height = height)
+            created = True
     if created:
-        if not in_testing_mode():
-            # Update the photo servers:
-            for photo_server in PhotoServer.objects.filter(subdomain=p.subdomain, unreachable=False):
-                # TODO We should use concurrent requests for this
+        update_all_photo_servers({ p.subdomain: [p] })
 
-                num_retries = 5
-                initial_retry_time = 4
-
-                try:
-                    request_with_n_retries(num_retries, initial_retry_time,
-                            lambda: photo_server_set_photos(photo_server.photos_update_url, photo_server.auth_key, [p]))
-                except requests.exceptions.RequestException:
-                    # TODO Log this
-                    photo_server.set_unreachable()
-
-        album.save_revision(now,True)
+        album.save_revision(now, True, photos_added_changes({ p.subdomain: [p] }))
 
         photos_added_to_album.send(sender=None,
                                    photos=[p.photo_id],
@@ -400,56 +399,27 @@ def add_photo(client_upload_id, storage_id, author, album, now):
                                    to_album=album)
 
 def add_youtube_photo(client_upload_id, storage_id, author, album, now,youtube_id):
-    def get_next_album_index(album):
-        album_index_q = Photo.objects.filter(album=album).aggregate(Max('album_index'))
-
-        max_album_index = album_index_q['album_index__max']
-        if max_album_index is None:
-            return 0
-        else:
-            return max_album_index + 1
-
-    success = False
-    while not success:
+    with transaction.atomic():
         try:
-            with transaction.atomic():
-                next_album_index = get_next_album_index(album)
-                p, created = Photo.objects.get_or_create(
-                    storage_id=storage_id,
-                    defaults={
-                        'photo_id': Photo.generate_photo_id(),
-                        'media_type': Photo.MEDIA_TYPE_YOUTUBE,
-                        'client_upload_id': client_upload_id,
-                        'subdomain': Photo.choose_random_subdomain(),
-                        'date_created': now,
-                        'author': author,
-                        'album': album,
-                        'album_index': next_album_index,
-                        'youtube_id' : youtube_id
-                    })
-        except IntegrityError:
-            # This will happen if there is a collision with a duplicate
-            # 'album_index' from a concurrent request
-            success = False
-        else:
-            success = True
+            p = Photo.objects.get(storage_id=storage_id)
+            created = False
+        except Photo.DoesNotExist:
+            p = Photo.objects.create(
+                photo_id = Photo.generate_photo_id(),
+                media_type = Photo.MEDIA_TYPE_YOUTUBE,
+                client_upload_id = client_upload_id,
+                storage_id = storage_id,
+                subdomain = Photo.choose_random_subdomain(),
+                date_created = now,
+                author = author,
+                album = album,
+                album_index = album.allocate_album_indexes(),
+                youtube_id = youtube_id)
+            created = True
     if created:
-        if not in_testing_mode():
-            # Update the photo servers:
-            for photo_server in PhotoServer.objects.filter(subdomain=p.subdomain, unreachable=False):
-                # TODO We should use concurrent requests for this
+        update_all_photo_servers({ p.subdomain: [p] })
 
-                num_retries = 5
-                initial_retry_time = 4
-
-                try:
-                    request_with_n_retries(num_retries, initial_retry_time,
-                            lambda: photo_server_set_photos(photo_server.photos_update_url, photo_server.auth_key, [p]))
-                except requests.exceptions.RequestException:
-                    # TODO Log this
-                    photo_server.set_unreachable()
-
-        album.save_revision(now, True)
+        album.save_revision(now, True, photos_added_changes({ p.subdomain: [p] }))
 
         photos_added_to_album.send(sender=None,
                                    photos=[p.photo_id],
@@ -457,24 +427,36 @@ def add_youtube_photo(client_upload_id, storage_id, author, album, now,youtube_i
                                    to_album=album)
 
 
-def is_postgresql(conn):
-    return conn.settings_dict['ENGINE'].rsplit('.', 1)[-1] == 'postgresql_psycopg2'
-
 def register_photo_server(photos_update_url, subdomain, auth_key, date_registered):
-    # We need to lock the Photo table to make sure that nothing is changed
-    # between the time we send it the current data and the time we register it
-    # in the database.
-
-    if is_postgresql(connection):
-        # This mode will only block concurrent writes to the table
-        lock_mode = 'SHARE'
-
-        cursor = connection.cursor()
-        cursor.execute('LOCK TABLE %s IN %s MODE' % (connection.ops.quote_name(Photo._meta.db_table), lock_mode))
+    """
+    Sends all of the photos of the subdomain to the photo server, and then
+    registers it so that the dispatcher sends it all of the later changes
+    (see `dispatch_photo_server_changes').
+
+    The photos are read and sent in chunks, ordered by photo_id, without
+    locking the Photo table. The changes that happen while this is being done
+    are delivered afterwards by the dispatcher, which starts from a change
+    that is old enough that no change before it can still be uncommitted.
+    Commands are idempotent, so any photo that is sent twice is harmless.
+
+    Must not be called inside a transaction: every chunk must see the
+    changes that were committed before it
+    """
+    # The server is back, so don't skip it because of its earlier failures
+    photo_servers.reset_circuit_breaker(photos_update_url)
 
-    all_subdomain_photos = Photo.objects.filter(subdomain=subdomain)
+    start_change_id = PhotoServerChange.objects.get_last_id(before=get_change_settled_time(date_registered))
 
-    photo_server_set_photos(photos_update_url, auth_key, all_subdomain_photos)
+    last_photo_id = ''
+    while True:
+        photos = list(Photo.objects
+                .filter(subdomain=subdomain, photo_id__gt=last_photo_id)
+                .order_by('photo_id')
+                .only('photo_id', 'storage_id')[:settings.PHOTO_SERVER_SYNC_CHUNK_SIZE])
+        if not photos:
+            break
+        photo_server_set_photos(photos_update_url, auth_key, photos)
+        last_photo_id = photos[-1].photo_id
 
     obj, created = PhotoServer.objects.get_or_create(
             photos_update_url = photos_update_url,
@@ -482,45 +464,131 @@ def register_photo_server(photos_update_url, subdomain, auth_key, date_registere
                 'subdomain': subdomain,
                 'auth_key': auth_key,
                 'date_registered': date_registered,
-                'unreachable': False
+                'unreachable': False,
+                'last_change_id': start_change_id
                 })
     if not created:
         obj.subdomain = subdomain
         obj.auth_key = auth_key
         obj.date_registered = date_registered
         obj.unreachable = False
+        obj.last_change_id = start_change_id
         obj.save()
 
+def get_change_settled_time(now):
+    """
+    Transactions don't necessarily commit in the same order as the ids of
+    the changes that they record, so a change may appear after a change with
+    a larger id has already been delivered. Changes from before the returned
+    time are assumed to be "settled": all of the transactions that could
+    still add a change before them have finished.
+    """
+    return now - datetime.timedelta(seconds=settings.PHOTO_SERVER_CHANGE_SETTLE_TIME)
 
-def photo_server_set_photos(photos_update_url, photo_server_auth_key, photos):
-    body = []
+def dispatch_photo_server_changes(now, already_sent=None):
+    """
+    Delivers the PhotoServerChange log to all of the reachable photo servers,
+    in batches of PHOTO_SERVER_SYNC_CHUNK_SIZE. Every server has an
+    acknowledged offset (PhotoServer.last_change_id), and is sent all of the
+    changes after it. The offset is only moved forward after the changes have
+    been delivered, so every change is delivered at least once.
+
+    The offset is not moved past changes that are not yet settled (see
+    `get_change_settled_time'), so those are read again every time.
+
+    already_sent: A dict from photo server ids to the sets of change ids that
+    have already been delivered but not acknowledged. These are not sent
+    again. The caller should keep it between calls.
+
+    Returns the number of changes that were delivered
+    """
+    if already_sent is None:
+        already_sent = {}
+
+    settled_time = get_change_settled_time(now)
+
+    num_sent = 0
+    for photo_server in PhotoServer.objects.filter(unreachable=False):
+        sent_ids = already_sent.setdefault(photo_server.id, set())
+
+        acked_change_id = photo_server.last_change_id
+        last_change_id = acked_change_id
+        all_settled = True
+        while True:
+            changes = list(PhotoServerChange.objects
+                    .filter(subdomain=photo_server.subdomain, id__gt=last_change_id)
+                    .order_by('id')[:settings.PHOTO_SERVER_SYNC_CHUNK_SIZE])
+            if not changes:
+                break
+
+            commands = [c.get_command() for c in changes if c.id not in sent_ids]
+            if commands:
+                try:
+                    photo_servers.post_update(photo_server.photos_update_url, photo_server.auth_key, commands)
+                except requests.exceptions.RequestException:
+                    # Everything after the offset will be sent again next time
+                    break
+                num_sent += len(commands)
+
+            for c in changes:
+                if all_settled and c.date_created < settled_time:
+                    acked_change_id = c.id
+                else:
+                    all_settled = False
+                    sent_ids.add(c.id)
+
+            last_change_id = changes[-1].id
+
+        if acked_change_id != photo_server.last_change_id:
+            PhotoServer.objects.filter(pk=photo_server.pk).update(last_change_id=acked_change_id)
+        sent_ids.difference_update([i for i in sent_ids if i <= acked_change_id])
+
+    return num_sent
+
+
+def photo_server_set_photos_commands(photos):
+    commands = []
     for p in photos:
-        body.append({
+        commands.append({
             'cmd': 'set',
             'key': p.photo_id,
             'value': p.storage_id,
             })
+    return commands
 
-    r = requests.post(photos_update_url,
-            headers = { 'Authorization': 'Key ' + photo_server_auth_key },
-            data = json.dumps(body))
-    r.raise_for_status()
+def photo_server_set_photos(photos_update_url, photo_server_auth_key, photos):
+    photo_servers.post_update(photos_update_url, photo_server_auth_key, photo_server_set_photos_commands(photos))
 
 def photo_server_delete_photos(photos_update_url, photo_server_auth_key, photo_ids):
-    # TODO ...
-    pass
+    commands = []
+    for photo_id in photo_ids:
+        commands.append({
+            'cmd': 'delete',
+            'key': photo_id,
+            })
+    photo_servers.post_update(photos_update_url, photo_server_auth_key, commands)
 
 def update_all_photo_servers(added_photos):
-    for subdomain, photos in added_photos.iteritems():
-        for photo_server in PhotoServer.objects.filter(subdomain=subdomain, unreachable=False):
-            # TODO We should use concurrent requests for this
+    """
+    Records the new photos in the PhotoServerChange log, from which they are
+    delivered to the photo servers by `dispatch_photo_server_changes'.
 
-            num_retries = 5
-            initial_retry_time = 4
+    If settings.PHOTO_SERVER_IMMEDIATE_UPDATES is set, then they are also sent
+    right away to all of the photo servers of their subdomains, concurrently
+    (see `photos.photo_servers')
+    """
+    if not added_photos:
+        return
 
-            try:
-                request_with_n_retries(num_retries, initial_retry_time,
-                        lambda: photo_server_set_photos(photo_server.photos_update_url, photo_server.auth_key, photos))
-            except requests.exceptions.RequestException:
-                # TODO Log this
-                photo_server.set_unreachable()
+    for photos in added_photos.itervalues():
+        PhotoServerChange.objects.record_set_photos(photos, timezone.now())
+
+    if not settings.PHOTO_SERVER_IMMEDIATE_UPDATES:
+        return
+
+    updates = []
+    for photo_server in PhotoServer.objects.filter(subdomain__in=added_photos.keys(), unreachable=False):
+        photos = added_photos[photo_server.subdomain]
+        updates.append((photo_server, photo_server_set_photos_commands(photos)))
+
+    photo_servers.send_updates(updates)
@@ -0,0 +1,187 @@
+"""
+Sends updates to the photo servers (see `PhotoServer').
+
+An update is sent to all of the servers at the same time, from a pool of
+threads that keep their HTTP connections open between requests. The caller
+only waits for a single attempt, which is limited by
+`settings.PHOTO_SERVER_TIMEOUT'. Updates that fail are not retried here: every
+change is also in the PhotoServerChange log, which the dispatcher delivers to
+every server until the server has acknowledged it (see
+`photo_operations.dispatch_photo_server_changes').
+
+Each server has a circuit breaker: after several consecutive failures no
+requests are sent to it for a while, so that a server that is down does not
+slow down every update.
+"""
+
+import json
+import os
+import threading
+import time
+
+from django.conf import settings
+
+import requests
+
+from photos import worker_pool
+
+
+class CircuitOpenException(requests.exceptions.RequestException):
+    pass
+
+
+class CircuitBreaker(object):
+    def __init__(self, failure_threshold, cooldown):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+        self.lock = threading.Lock()
+        self.num_failures = 0
+        self.open_until = None
+
+    def allow_request(self):
+        """
+        When the circuit is open, a single request is allowed after the
+        cooldown has passed. If it fails, the circuit stays open for another
+        cooldown
+        """
+        with self.lock:
+            if self.open_until is None:
+                return True
+            now = time.time()
+            if now < self.open_until:
+                return False
+            self.open_until = now + self.cooldown
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.num_failures = 0
+            self.open_until = None
+
+    def record_failure(self):
+        with self.lock:
+            self.num_failures += 1
+            if self.num_failures >= self.failure_threshold:
+                self.open_until = time.time() + self.cooldown
+
+    def is_open(self):
+        with self.lock:
+            return self.open_until is not None
+
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(photos_update_url):
+    with _circuit_breakers_lock:
+        try:
+            return _circuit_breakers[photos_update_url]
+        except KeyError:
+            breaker = CircuitBreaker(
+                    settings.PHOTO_SERVER_CIRCUIT_BREAKER_THRESHOLD,
+                    settings.PHOTO_SERVER_CIRCUIT_BREAKER_COOLDOWN)
+            _circuit_breakers[photos_update_url] = breaker
+            return breaker
+
+def reset_circuit_breaker(photos_update_url):
+    get_circuit_breaker(photos_update_url).record_success()
+
+
+# requests.Session objects should not be shared between threads, so every
+# thread has its own
+_local = threading.local()
+
+def get_session():
+    try:
+        return _local.session
+    except AttributeError:
+        _local.session = requests.Session()
+        return _local.session
+
+def post_update(photos_update_url, auth_key, commands):
+    """
+    Sends the list of `commands' to a single photo server.
+
+    Raises `requests.exceptions.RequestException' if the request failed (or
+    `CircuitOpenException' if it was not sent because the server has been
+    failing)
+    """
+    breaker = get_circuit_breaker(photos_update_url)
+    if not breaker.allow_request():
+        raise CircuitOpenException('Circuit open for photo server: ' + photos_update_url)
+
+    try:
+        r = get_session().post(photos_update_url,
+                headers = { 'Authorization': 'Key ' + auth_key },
+                data = json.dumps(commands),
+                timeout = settings.PHOTO_SERVER_TIMEOUT)
+        r.raise_for_status()
+    except requests.exceptions.RequestException:
+        breaker.record_failure()
+        raise
+    else:
+        breaker.record_success()
+
+
+class _Update(object):
+    def __init__(self, photo_server, commands):
+        self.photos_update_url = photo_server.photos_update_url
+        self.auth_key = photo_server.auth_key
+        self.commands = commands
+
+    def send(self):
+        post_update(self.photos_update_url, self.auth_key, self.commands)
+
+
+_fanout_pool = None
+_fanout_pool_pid = None
+_fanout_pool_lock = threading.Lock()
+
+def get_fanout_pool():
+    """
+    Threads don't survive a fork, so a new pool is created in child processes
+    """
+    global _fanout_pool, _fanout_pool_pid
+
+    with _fanout_pool_lock:
+        if _fanout_pool is None or _fanout_pool_pid != os.getpid():
+            _fanout_pool = worker_pool.WorkerPool(
+                    settings.PHOTO_SERVER_NUM_THREADS,
+                    settings.PHOTO_SERVER_MAX_QUEUE_SIZE,
+                    0)
+            _fanout_pool_pid = os.getpid()
+        return _fanout_pool
+
+def send_updates(updates):
+    """
+    updates: A list of tuples (photo_server, commands)
+
+    Sends all of the updates concurrently, and waits until each one has
+    either succeeded or failed.
+
+    Returns the number of updates that failed
+    """
+    pool = get_fanout_pool()
+
+    pending = []
+    for photo_server, commands in updates:
+        update = _Update(photo_server, commands)
+        try:
+            task = pool.submit(update.send)
+        except worker_pool.WorkerPoolFullException:
+            task = None
+        pending.append(task)
+
+    num_failed = 0
+    for task in pending:
+        if task is None:
+            # Too many updates are already in progress
+            num_failed += 1
+            continue
+        try:
+            task.wait()
+        except requests.exceptions.RequestException:
+            num_failed += 1
+
+    return num_failed
@@ -42,12 +42,13 @@ def compute_public_feed(now):
 
     for p in original_photos:
         num_copies[p.photo_id] = 0
-        total_photo_score[p.photo_id] = p.photo_glance_score
+        # Copies are always newer than the original, so this includes the
+        # scores of all of the copies
+        total_photo_score[p.photo_id] = p.global_glance_score
 
-    for p in photo_copies:
+    for copied_from_photo_id in photo_copies.values_list('copied_from_photo_id', flat=True):
         try:
-            num_copies[p.copied_from_photo.photo_id] += 1
-            total_photo_score[p.copied_from_photo.photo_id] += p.photo_glance_score
+            num_copies[copied_from_photo_id] += 1
         except KeyError:
             pass
 
@@ -139,4 +140,8 @@ def set_public_feed(new_photos, now):
 
         i += 1
 
+    # Updates the num_new_photos of the members, and lets clients know that
+    # the album has changed
+    public_feed_album.save_revision(now, update_last_updated=True)
+
     photo_operations.update_all_photo_servers(added_photos)
@@ -0,0 +1,142 @@
+"""
+On demand rendering of the resized versions of photos that were not created
+when the photo was uploaded (see `settings.PHOTO_PROCESSING_LAZY').
+
+Rendered files are stored in a disk cache that has a size budget. The
+modification time of a file is used as its last access time, and the least
+recently used files are deleted when the cache grows past its budget.
+
+The files in the cache are also recorded in the processing manifests (see
+`ProcessedImageManifest'), until they are evicted.
+"""
+
+from PIL import Image
+
+import os
+import tempfile
+
+from django.conf import settings
+from django.utils import timezone
+
+from photos import image_uploads
+from photos.models import ProcessedImageManifest
+
+def get_cache_directory():
+    if settings.PHOTO_RENDER_CACHE_DIRECTORY is None:
+        return os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, 'render_cache')
+    else:
+        return settings.PHOTO_RENDER_CACHE_DIRECTORY
+
+# An estimate of the total size of the cache directory, in bytes. This is only
+# the view of the current process (the directory may be shared with other
+# processes), so when it grows past the budget the directory is rescanned
+# before anything is evicted. None means that the directory has not been
+# scanned yet.
+_cache_bytes = None
+
+# Files that are still being written. These are never evicted
+TMP_FILE_PREFIX = '.rendering-'
+
+def find_or_render(storage_id, image_size_str):
+    """
+    Returns a tuple (directory, filename) of a file that contains the resized
+    version `image_size_str' of the photo, rendering it if necessary.
+
+    Returns None if the original photo does not exist.
+    """
+    global _cache_bytes
+
+    filename = image_uploads.get_resized_image_filename(storage_id, image_size_str)
+    if os.path.isfile(os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, filename)):
+        return (settings.LOCAL_PHOTOS_DIRECTORY, filename)
+
+    cache_directory = get_cache_directory()
+    cached_file_path = os.path.join(cache_directory, filename)
+    try:
+        # Mark the file as recently used
+        os.utime(cached_file_path, None)
+        return (cache_directory, filename)
+    except OSError:
+        pass
+
+    img_file_path = os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, storage_id + '.jpg')
+    if not os.path.isfile(img_file_path):
+        return None
+
+    img, (img_width, img_height) = image_uploads.load_image_for_resizing(img_file_path, [image_size_str])
+
+    # If one of the sizes that was created during upload has the same
+    # dimensions, then it can be used instead
+    new_width, new_height = image_uploads.image_sizes[image_size_str].get_image_dimensions(img_width, img_height)
+    for hot_size_str in image_uploads.get_eager_image_size_strs():
+        if image_uploads.image_sizes[hot_size_str].get_image_dimensions(img_width, img_height) == (new_width, new_height):
+            hot_filename = image_uploads.get_resized_image_filename(storage_id, hot_size_str)
+            if os.path.isfile(os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, hot_filename)):
+                return (settings.LOCAL_PHOTOS_DIRECTORY, hot_filename)
+
+    mipmaps = image_uploads.create_mipmaps(img, img_width, img_height, Image.BOX, [image_size_str])
+    new_img = image_uploads.resize_image(mipmaps, img_width, img_height, new_width, new_height)
+
+    image_uploads.mkdir_p(cache_directory)
+
+    # Write to a temporary file first so that concurrent requests for the same
+    # file never see it half written
+    fd, tmp_file_path = tempfile.mkstemp(prefix=TMP_FILE_PREFIX, suffix='.jpg', dir=cache_directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            new_img.save(f, 'JPEG')
+        os.rename(tmp_file_path, cached_file_path)
+    except:
+        os.remove(tmp_file_path)
+        raise
+
+    ProcessedImageManifest.objects.record(storage_id, img_width, img_height, [image_size_str], timezone.now())
+
+    if _cache_bytes is not None:
+        _cache_bytes += os.path.getsize(cached_file_path)
+    if _cache_bytes is None or _cache_bytes > settings.PHOTO_RENDER_CACHE_MAX_BYTES:
+        _cache_bytes = evict(cache_directory, settings.PHOTO_RENDER_CACHE_MAX_BYTES, keep=filename)
+
+    return (cache_directory, filename)
+
+def evict(cache_directory, max_bytes, keep=None):
+    """
+    Deletes the least recently used files from the cache directory until its
+    total size is at most `max_bytes' (and removes them from the manifests).
+    The file named `keep' is never deleted.
+
+    Returns the total size of the files that remain
+    """
+    entries = []
+    total_bytes = 0
+    for filename in os.listdir(cache_directory):
+        if filename.startswith(TMP_FILE_PREFIX):
+            continue
+        try:
+            st = os.stat(os.path.join(cache_directory, filename))
+        except OSError:
+            # Deleted by another process
+            continue
+        entries.append((st.st_mtime, filename, st.st_size))
+        total_bytes += st.st_size
+
+    entries.sort()
+    for mtime, filename, size in entries:
+        if total_bytes <= max_bytes:
+            break
+        if filename == keep:
+            continue
+        try:
+            os.remove(os.path.join(cache_directory, filename))
+        except OSError:
+            pass
+        else:
+            parsed = image_uploads.parse_resized_image_filename(filename)
+            # The file may have been created outside of the cache since then
+            # (see `reprocess_photos')
+            if parsed is not None and not os.path.isfile(os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, filename)):
+                storage_id, image_size_str = parsed
+                ProcessedImageManifest.objects.forget(storage_id, [image_size_str])
+        total_bytes -= size
+
+    return total_bytes
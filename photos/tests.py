@@ -1,18 +1,36 @@
+import BaseHTTPServer
 import datetime
+import filecmp
+import json
+import multiprocessing
+import os
 import shutil
+import socket
+import threading
+import time
+from StringIO import StringIO
 from django.db.models.query import QuerySet
 
 from django.conf import settings
 from django.contrib import auth
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
 from django.test import TestCase
+from django.utils import timezone
 from django.utils.timezone import utc
-from django.test.utils import override_settings
+from django.test.utils import override_settings, CaptureQueriesContext
 
+from mock import patch
 import phonenumbers
+from PIL import Image
 
-from photos.models import Album, Photo, PendingPhoto, AlbumMember, PhotoGlanceScoreDelta
+from photos.models import Album, Photo, PendingPhoto, AlbumMember, GlobalGlanceScoreChange, PhotoGlanceScoreDelta, ProcessedImageManifest, PhotoServer, PhotoServerChange
 from photos import image_uploads
 from photos import photo_operations
+from photos import photo_servers
+from photos import render_cache
+from photos import worker_pool
 from phone_auth.models import User, PhoneNumber
 
 def read_in_chunks(file_object, chunk_size=1024):
@@ -103,6 +121,8 @@ class ModelTest(TestCase):
 
         self.assertEqual(len(album2_photos), 1)
         self.assertEqual(album2_photos[0].storage_id, Photo.objects.get(pk=pending_photo.photo_id).storage_id)
+        self.assertEqual(album2_photos[0].get_image_dimensions(), (1024, 768))
+        self.assertEqual(album2_photos[0].get_image_dimensions('r_qvga'), (320, 240))
 
     def test_copy_photo_to_album_copied_from(self):
         date1 = datetime.datetime(2010, 1, 1, tzinfo=utc)
@@ -148,6 +168,52 @@ class ModelTest(TestCase):
         self.assertEqual(album3_photos[0].storage_id, Photo.objects.get(pk=pending_photo.photo_id).storage_id)
         self.assertEqual(album3_photos[0].copied_from_photo, Photo.objects.get(pk=pending_photo.photo_id))
 
+    def create_processed_pending_photos(self, num_photos, the_date):
+        pending_photos = []
+        for i in xrange(num_photos):
+            pending_photo = Photo.objects.upload_request(author=self.amanda)
+            pending_photo.set_uploaded(the_date)
+            pending_photo.set_processing_done(the_date)
+            pending_photos.append(pending_photo)
+        return pending_photos
+
+    def test_add_many_pending_photos(self):
+        the_date = datetime.datetime(2010, 1, 1, tzinfo=utc)
+        album = Album.objects.create_album(self.amanda, 'Party', the_date)
+        pending_photos = self.create_processed_pending_photos(30, the_date)
+        photo_ids = [p.photo_id for p in pending_photos]
+
+        with CaptureQueriesContext(connection) as queries:
+            photo_operations.add_pending_photos_to_album(photo_ids, album.id, the_date)
+        # The number of queries must not depend on the number of photos
+        self.assertLess(len(queries), 30)
+
+        self.assertEqual([p.photo_id for p in album.get_photos()], photo_ids)
+        self.assertEqual([p.album_index for p in album.get_photos()], range(30))
+        self.assertFalse(PendingPhoto.objects.filter(photo_id__in=photo_ids).exists())
+
+    def test_add_pending_photos_already_added(self):
+        the_date = datetime.datetime(2010, 1, 1, tzinfo=utc)
+        album = Album.objects.create_album(self.amanda, 'Party', the_date)
+        pending_photos = self.create_processed_pending_photos(3, the_date)
+        photo_ids = [p.photo_id for p in pending_photos]
+
+        # Simulate a concurrent request that added the second photo, but has
+        # not deleted its PendingPhoto yet
+        Photo.objects.create(
+                photo_id = photo_ids[1],
+                media_type = Photo.MEDIA_TYPE_PHOTO,
+                storage_id = pending_photos[1].storage_id,
+                date_created = the_date,
+                author = self.amanda,
+                album = album,
+                album_index = album.allocate_album_indexes())
+
+        photo_operations.add_pending_photos_to_album(photo_ids, album.id, the_date)
+
+        self.assertEqual(set(p.photo_id for p in album.get_photos()), set(photo_ids))
+        self.assertFalse(PendingPhoto.objects.filter(photo_id__in=photo_ids).exists())
+
     def test_copy_photo_to_album_twice(self):
         date1 = datetime.datetime(2010, 1, 1, tzinfo=utc)
         album1 = Album.objects.create_album(self.amanda, 'Album 1', date1)
@@ -239,6 +305,36 @@ class ModelTest(TestCase):
         self.assertEqual(photo2.get_global_glance_score(), 3)
         self.assertEqual(photo3.get_global_glance_score(), 3)
 
+    def test_photo_global_glance_score_copy_deleted(self):
+        date1 = datetime.datetime(2010, 1, 1, tzinfo=utc)
+        album1 = Album.objects.create_album(self.amanda, 'Album 1', date1)
+        pending_photo = Photo.objects.upload_request(author=self.amanda)
+        with open('photos/test_photos/death-valley-sand-dunes.jpg') as f:
+            image_uploads.process_file_upload(pending_photo, read_in_chunks(f))
+
+        photo_operations.add_pending_photos_to_album([pending_photo.photo_id], album1.id, date1)
+
+        photo = Photo.objects.get(pk=pending_photo.photo_id)
+        photo.update_glance_score(1)
+
+        date2 = datetime.datetime(2010, 1, 2, tzinfo=utc)
+        album2 = Album.objects.create_album(self.barney, 'Album 2', date2)
+        photo_operations.copy_photos_to_album(self.barney, [pending_photo.photo_id], album2.id, date2)
+        photo2 = album2.get_photos()[0]
+        photo2.update_glance_score(2)
+        self.assertEqual(photo.get_global_glance_score(), 3)
+
+        photo2.delete()
+        self.assertEqual(photo.get_global_glance_score(), 1)
+
+        # A score that got out of sync is fixed by the rebuild
+        Photo.objects.filter(pk=photo.photo_id).update(global_glance_score=10)
+        GlobalGlanceScoreChange.objects.all().delete()
+        self.assertEqual(Photo.objects.rebuild_global_glance_scores(), 1)
+        self.assertEqual(photo.get_global_glance_score(), 1)
+        self.assertEqual(list(GlobalGlanceScoreChange.objects.values_list('original_photo_id', flat=True)), [photo.photo_id])
+        self.assertEqual(Photo.objects.rebuild_global_glance_scores(), 0)
+
     def test_set_photo_user_glance_score_delta(self):
         date1 = datetime.datetime(2010, 1, 1, tzinfo=utc)
         album1 = Album.objects.create_album(self.amanda, 'Album 1', date1)
@@ -348,6 +444,44 @@ class AlbumTest(TestCase):
         self.assertEquals(new_phone_number.user.nickname, 'Chloe Smith')
         self.assertTrue(self.party_album.is_user_member(new_phone_number.user.id))
 
+    def test_allocate_album_indexes(self):
+        the_time = datetime.datetime(2000, 01, 02, tzinfo=utc)
+
+        self.assertEqual(self.party_album.allocate_album_indexes(), 0)
+        self.assertEqual(self.party_album.allocate_album_indexes(3), 1)
+        self.assertEqual(self.party_album.allocate_album_indexes(), 4)
+
+        # A photo that was given an album_index directly is never reused
+        Photo.objects.create(
+                photo_id = Photo.generate_photo_id(),
+                media_type = Photo.MEDIA_TYPE_PHOTO,
+                storage_id = 'explicit_index',
+                date_created = the_time,
+                author = self.amanda,
+                album = self.party_album,
+                album_index = 10)
+        self.assertEqual(self.party_album.allocate_album_indexes(), 11)
+
+        photo_operations.add_photo('', 'added_photo', self.amanda, self.party_album, the_time)
+        self.assertEqual(Photo.objects.get(storage_id='added_photo').album_index, 12)
+
+        # Adding the same photo again does not use up an album_index
+        photo_operations.add_photo('', 'added_photo', self.amanda, self.party_album, the_time)
+        self.assertEqual(self.party_album.allocate_album_indexes(), 13)
+
+    def test_benchmark_json_rendering_command(self):
+        num_albums = Album.objects.count()
+        num_users = User.objects.count()
+        out = StringIO()
+        call_command('benchmark_json_rendering', counts='3,6', repeat=1, stdout=out)
+
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[1].split(), ['photos', 'Payload', 'JSONRenderer', 'Streaming'])
+        self.assertEqual([line.split()[0] for line in lines[2:]], ['3', '6'])
+        # Nothing is saved
+        self.assertEqual(Album.objects.count(), num_albums)
+        self.assertEqual(User.objects.count(), num_users)
+
 
 class ImageUploads(TestCase):
     def test_box_fit_expanded(self):
@@ -376,3 +510,454 @@ class ImageUploads(TestCase):
         self.assertEqual(image_uploads.BoxFitWithRotationOnlyShrink(960, 640).get_image_dimensions(1024, 768), (853, 640))
         self.assertEqual(image_uploads.BoxFitWithRotationOnlyShrink(1136, 640).get_image_dimensions(1024, 768), (853, 640))
         self.assertEqual(image_uploads.BoxFitWithRotationOnlyShrink(1136, 640).get_image_dimensions(1024, 768), (853, 640))
+
+
+@override_settings(LOCAL_PHOTOS_DIRECTORY='.tmp_photos')
+class ProcessUploadedImageTest(TestCase):
+    def setUp(self):
+        image_uploads.mkdir_p(settings.LOCAL_PHOTOS_DIRECTORY)
+
+    def tearDown(self):
+        shutil.rmtree(settings.LOCAL_PHOTOS_DIRECTORY, ignore_errors=True)
+
+    def process_test_photo(self, storage_id, num_workers):
+        shutil.copyfile('photos/test_photos/death-valley-sand-dunes.jpg',
+                os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, storage_id + '.jpg'))
+        return image_uploads.process_uploaded_image(storage_id, num_workers)
+
+    def test_parallel_matches_serial(self):
+        serial_dimensions = self.process_test_photo('serial', 1)
+        parallel_dimensions = self.process_test_photo('parallel', 3)
+
+        self.assertEqual(serial_dimensions, (1024, 768))
+        self.assertEqual(parallel_dimensions, serial_dimensions)
+
+        self.assertTrue(image_uploads.photo_is_processed('serial'))
+        self.assertTrue(image_uploads.photo_is_processed('parallel'))
+
+        for image_size_str in image_uploads.image_sizes.iterkeys():
+            serial_file = os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, 'serial_' + image_size_str + '.jpg')
+            parallel_file = os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, 'parallel_' + image_size_str + '.jpg')
+            self.assertEqual(os.path.islink(serial_file), os.path.islink(parallel_file))
+            self.assertTrue(filecmp.cmp(serial_file, parallel_file, shallow=False))
+
+    def test_concurrent_parallel_renders(self):
+        # Two different images, rendered by the process pools of two threads
+        # at the same time
+        shutil.copyfile('photos/test_photos/death-valley-sand-dunes.jpg',
+                os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, 'a.jpg'))
+        Image.open('photos/test_photos/death-valley-sand-dunes.jpg').transpose(Image.FLIP_LEFT_RIGHT) \
+                .save(os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, 'b.jpg'))
+        for storage_id in ('a', 'b'):
+            shutil.copyfile(os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, storage_id + '.jpg'),
+                    os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, storage_id + '_serial.jpg'))
+            image_uploads.render_uploaded_image(storage_id + '_serial', 1)
+
+        # Each thread creates its pool only once the other thread is about to
+        # create its own
+        real_pool = multiprocessing.Pool
+        cond = threading.Condition()
+        waiting = [0]
+        def pool_after_other_thread(*args, **kwargs):
+            with cond:
+                waiting[0] += 1
+                cond.notify_all()
+                while waiting[0] < 2:
+                    cond.wait(10)
+            return real_pool(*args, **kwargs)
+
+        errors = []
+        def render(storage_id):
+            try:
+                image_uploads.render_uploaded_image(storage_id, 3)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=render, args=(storage_id,)) for storage_id in ('a', 'b')]
+        with patch('multiprocessing.Pool', pool_after_other_thread):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+
+        for storage_id in ('a', 'b'):
+            for image_size_str in image_uploads.image_sizes.iterkeys():
+                serial_file = os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, storage_id + '_serial_' + image_size_str + '.jpg')
+                parallel_file = os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, storage_id + '_' + image_size_str + '.jpg')
+                self.assertTrue(filecmp.cmp(serial_file, parallel_file, shallow=False))
+
+    def test_manifest(self):
+        self.process_test_photo('all', 1)
+        shutil.copyfile('photos/test_photos/death-valley-sand-dunes.jpg',
+                os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, 'some.jpg'))
+        image_uploads.process_uploaded_image('some', 1, image_size_strs=['thumb75', 'r_qvga'])
+        # Rendering some of the sizes again keeps the others
+        image_uploads.process_uploaded_image('all', 1, image_size_strs=['thumb75'])
+
+        missing = ProcessedImageManifest.objects.get_missing_image_sizes(['all', 'some', 'none'])
+        self.assertEqual(missing['all'], [])
+        self.assertEqual(missing['some'], sorted(s for s in image_uploads.image_sizes if s not in ('thumb75', 'r_qvga')))
+        self.assertEqual(missing['none'], sorted(image_uploads.image_sizes))
+
+        self.assertTrue(image_uploads.photo_is_processed('all'))
+        self.assertFalse(image_uploads.photo_is_processed('some'))
+
+        image_uploads.process_uploaded_image('some', 1, image_size_strs=[s for s in image_uploads.image_sizes if s != 'thumb75'])
+        self.assertTrue(image_uploads.photo_is_processed('some'))
+
+        manifest = ProcessedImageManifest.objects.get(storage_id='all')
+        self.assertEqual((manifest.width, manifest.height), (1024, 768))
+        self.assertEqual(manifest.get_sizes()['r_qvga'], [320, 240])
+
+        # Manifests from a different version of the image sizes don't count
+        ProcessedImageManifest.objects.filter(storage_id='all').update(version='old')
+        self.assertFalse(image_uploads.photo_is_processed('all'))
+
+    def test_backfill_manifests_command(self):
+        self.process_test_photo('old', 1)
+        self.process_test_photo('recorded', 1)
+        ProcessedImageManifest.objects.filter(storage_id='old').delete()
+        # A file that was created by a different version of the image sizes
+        Image.new('RGB', (10, 10)).save(os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, 'old_thumb75.jpg'))
+        self.assertFalse(image_uploads.photo_is_processed('old'))
+
+        call_command('backfill_processed_image_manifests', 'old', 'recorded', dry_run=True, stdout=StringIO())
+        self.assertFalse(image_uploads.photo_is_processed('old'))
+
+        call_command('backfill_processed_image_manifests', 'old', 'recorded', stdout=StringIO())
+        missing = ProcessedImageManifest.objects.get_missing_image_sizes(['old', 'recorded'])
+        self.assertEqual(missing['old'], ['thumb75'])
+        self.assertEqual(missing['recorded'], [])
+        self.assertEqual(ProcessedImageManifest.objects.get_original_dimensions('old'), (1024, 768))
+
+    def test_reprocess_photos_command(self):
+        for storage_id in ('one', 'two'):
+            shutil.copyfile('photos/test_photos/death-valley-sand-dunes.jpg',
+                    os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, storage_id + '.jpg'))
+        checkpoint_file = os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, 'checkpoint')
+
+        # Resuming skips the photos that are in the checkpoint
+        with open(checkpoint_file, 'w') as f:
+            f.write(image_uploads.get_image_sizes_version() + '\n')
+            f.write('two\n')
+        call_command('reprocess_photos', 'one', 'two', workers=1, checkpoint=checkpoint_file, stdout=StringIO())
+
+        self.assertTrue(image_uploads.photo_is_processed('one'))
+        self.assertFalse(image_uploads.photo_is_processed('two'))
+        self.assertFalse(os.path.exists(checkpoint_file))
+
+        call_command('reprocess_photos', 'one', 'two', workers=1, checkpoint=checkpoint_file, stdout=StringIO())
+        self.assertTrue(image_uploads.photo_is_processed('two'))
+
+    def test_reprocess_photos_after_image_sizes_change(self):
+        for storage_id in ('one', 'two'):
+            shutil.copyfile('photos/test_photos/death-valley-sand-dunes.jpg',
+                    os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, storage_id + '.jpg'))
+        checkpoint_file = os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, 'checkpoint')
+
+        # An interrupted run, after "two" was processed
+        old_version = image_uploads.get_image_sizes_version()
+        image_uploads.process_uploaded_image('two', 1)
+        with open(checkpoint_file, 'w') as f:
+            f.write(old_version + '\n')
+            f.write('two\n')
+
+        with patch.object(image_uploads, 'IMAGE_PROCESSING_VERSION', image_uploads.IMAGE_PROCESSING_VERSION + 1):
+            self.assertNotEqual(image_uploads.get_image_sizes_version(), old_version)
+            self.assertFalse(image_uploads.photo_is_processed('two'))
+
+            call_command('reprocess_photos', 'one', 'two', workers=1, checkpoint=checkpoint_file, stdout=StringIO())
+            self.assertTrue(image_uploads.photo_is_processed('one'))
+            self.assertTrue(image_uploads.photo_is_processed('two'))
+        self.assertFalse(os.path.exists(checkpoint_file))
+
+    def test_reprocess_photos_checkpoint_version(self):
+        shutil.copyfile('photos/test_photos/death-valley-sand-dunes.jpg',
+                os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, 'one.jpg'))
+        checkpoint_file = os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, 'checkpoint')
+
+        # A photo that fails keeps the checkpoint, which starts with the version
+        with self.assertRaises(CommandError):
+            call_command('reprocess_photos', 'one', 'missing', workers=1, checkpoint=checkpoint_file, stdout=StringIO(), stderr=StringIO())
+        with open(checkpoint_file) as f:
+            self.assertEqual(f.read().split(), [image_uploads.get_image_sizes_version(), 'one'])
+
+    def test_fast_decode_rotated(self):
+        # A large photo taken sideways, so that it is decoded at a reduced scale
+        exif = Image.Exif()
+        exif[0x0112] = 6 # Orientation: Rotated 90 CW
+        img = Image.open('photos/test_photos/death-valley-sand-dunes.jpg').resize((6000, 4000))
+        img.save(os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, 'full.jpg'), exif=exif.tobytes())
+        shutil.copyfile(os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, 'full.jpg'),
+                os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, 'fast.jpg'))
+
+        full_dimensions = image_uploads.process_uploaded_image('full', 1, fast_decode=False)
+        fast_dimensions = image_uploads.process_uploaded_image('fast', 1, fast_decode=True)
+
+        self.assertEqual(full_dimensions, (4000, 6000))
+        self.assertEqual(fast_dimensions, full_dimensions)
+
+        for image_size_str in image_uploads.image_sizes.iterkeys():
+            full_img = Image.open(os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, 'full_' + image_size_str + '.jpg'))
+            fast_img = Image.open(os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, 'fast_' + image_size_str + '.jpg'))
+            self.assertEqual(fast_img.size, full_img.size)
+
+
+@override_settings(USING_LOCAL_PHOTOS=True)
+@override_settings(LOCAL_PHOTOS_DIRECTORY='.tmp_photos')
+@override_settings(PHOTO_PROCESSING_LAZY=True)
+@override_settings(PHOTO_PROCESSING_HOT_SIZES=('thumb75',))
+class LazyRenderingTest(TestCase):
+    fixtures = ['tests/test_users']
+
+    def setUp(self):
+        self.amanda = auth.get_user_model().objects.get(pk=2)
+        render_cache._cache_bytes = None
+
+    def tearDown(self):
+        shutil.rmtree(settings.LOCAL_PHOTOS_DIRECTORY, ignore_errors=True)
+        render_cache._cache_bytes = None
+
+    def upload_photo(self):
+        the_date = datetime.datetime(2010, 1, 1, tzinfo=utc)
+        album = Album.objects.create_album(self.amanda, 'Lazy', the_date)
+        pending_photo = Photo.objects.upload_request(author=self.amanda)
+        with open('photos/test_photos/death-valley-sand-dunes.jpg') as f:
+            image_uploads.process_file_upload(pending_photo, read_in_chunks(f))
+        photo_operations.add_pending_photos_to_album([pending_photo.photo_id], album.id, the_date)
+        return Photo.objects.get(pk=pending_photo.photo_id)
+
+    def test_only_hot_sizes_on_upload(self):
+        photo = self.upload_photo()
+
+        self.assertTrue(image_uploads.photo_is_processed(photo.storage_id))
+        self.assertTrue(os.path.isfile(os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, photo.storage_id + '_thumb75.jpg')))
+        self.assertFalse(os.path.exists(os.path.join(settings.LOCAL_PHOTOS_DIRECTORY, photo.storage_id + '_r_qvga.jpg')))
+
+    def test_serve_renders_on_demand(self):
+        photo = self.upload_photo()
+
+        response = self.client.get('/photos/' + photo.subdomain + '/' + photo.photo_id + '_r_qvga.jpg')
+        self.assertEqual(response.status_code, 200)
+        rendered = Image.open(os.path.join(render_cache.get_cache_directory(), photo.storage_id + '_r_qvga.jpg'))
+        self.assertEqual(rendered.size, (320, 240))
+
+        response = self.client.get('/photos/' + photo.subdomain + '/' + photo.photo_id + '_bogus.jpg')
+        self.assertEqual(response.status_code, 404)
+
+    def test_evicts_least_recently_used(self):
+        photo = self.upload_photo()
+        cache_directory = render_cache.get_cache_directory()
+
+        render_cache.find_or_render(photo.storage_id, 'r_qvga')
+        render_cache.find_or_render(photo.storage_id, 'r_hvga')
+        os.utime(os.path.join(cache_directory, photo.storage_id + '_r_qvga.jpg'), (0, 0))
+        # A cache hit marks the file as recently used
+        render_cache.find_or_render(photo.storage_id, 'r_qvga')
+        os.utime(os.path.join(cache_directory, photo.storage_id + '_r_hvga.jpg'), (0, 0))
+
+        budget = os.path.getsize(os.path.join(cache_directory, photo.storage_id + '_r_qvga.jpg')) + 1
+        render_cache.evict(cache_directory, budget)
+
+        self.assertEqual(os.listdir(cache_directory), [photo.storage_id + '_r_qvga.jpg'])
+
+    def test_manifest_of_rendered_sizes(self):
+        photo = self.upload_photo()
+        cache_directory = render_cache.get_cache_directory()
+
+        render_cache.find_or_render(photo.storage_id, 'r_qvga')
+        render_cache.find_or_render(photo.storage_id, 'r_hvga')
+        missing = ProcessedImageManifest.objects.get_missing_image_sizes([photo.storage_id], ['thumb75', 'r_qvga', 'r_hvga'])
+        self.assertEqual(missing[photo.storage_id], [])
+
+        os.utime(os.path.join(cache_directory, photo.storage_id + '_r_hvga.jpg'), (0, 0))
+        render_cache.evict(cache_directory, os.path.getsize(os.path.join(cache_directory, photo.storage_id + '_r_qvga.jpg')) + 1)
+        missing = ProcessedImageManifest.objects.get_missing_image_sizes([photo.storage_id], ['thumb75', 'r_qvga', 'r_hvga'])
+        self.assertEqual(missing[photo.storage_id], ['r_hvga'])
+
+    def test_parse_resized_image_filename(self):
+        self.assertEqual(image_uploads.parse_resized_image_filename('a_b_r_qvga.jpg'), ('a_b', 'r_qvga'))
+        self.assertEqual(image_uploads.parse_resized_image_filename('a_b.jpg'), None)
+
+
+class WorkerPoolTest(TestCase):
+    def test_run(self):
+        pool = worker_pool.WorkerPool(2, 10, 1)
+
+        self.assertIn(pool.run(threading.current_thread), pool.threads)
+
+        # Nested actions run directly in the pool thread
+        self.assertEqual(pool.run(lambda: pool.run(lambda: 42)), 42)
+
+        def fail():
+            raise ValueError('failed')
+        with self.assertRaises(ValueError):
+            pool.run(fail)
+
+        stats = pool.get_stats()
+        self.assertEqual(stats['num_completed'], 2)
+        self.assertEqual(stats['num_failed'], 1)
+        self.assertEqual(stats['queue_length'], 0)
+
+    def test_queue_full(self):
+        pool = worker_pool.WorkerPool(1, 1, 0.01)
+        release = threading.Event()
+
+        # Occupy the only thread, and fill the queue
+        blocked = [threading.Thread(target=pool.run, args=(release.wait,)) for i in xrange(2)]
+        for t in blocked:
+            t.start()
+        while pool.queue.qsize() < 1 or pool.get_stats()['num_busy'] < 1:
+            time.sleep(0.01)
+
+        with self.assertRaises(worker_pool.WorkerPoolFullException):
+            pool.run(lambda: None)
+        self.assertEqual(pool.get_stats()['num_rejected'], 1)
+
+        release.set()
+        for t in blocked:
+            t.join()
+
+
+class PhotoServersTest(TestCase):
+    def start_photo_server(self):
+        """
+        Starts an HTTP server that records the bodies of the requests that it
+        receives. Returns its url
+        """
+        received = self.received = []
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_POST(self):
+                received.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.addCleanup(server.shutdown)
+        return 'http://127.0.0.1:{0}/update'.format(server.server_port)
+
+    def closed_port_url(self):
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        return 'http://127.0.0.1:{0}/update'.format(port)
+
+    def test_send_updates(self):
+        the_date = datetime.datetime(2010, 1, 1, tzinfo=utc)
+        good_server = PhotoServer.objects.create(photos_update_url=self.start_photo_server(),
+                subdomain='photos01', auth_key='key', date_registered=the_date, unreachable=False)
+        bad_server = PhotoServer.objects.create(photos_update_url=self.closed_port_url(),
+                subdomain='photos01', auth_key='key', date_registered=the_date, unreachable=False)
+
+        commands = [{ 'cmd': 'set', 'key': 'photo', 'value': 'storage' }]
+
+        num_failed = photo_servers.send_updates([(good_server, commands), (bad_server, commands)])
+
+        self.assertEqual(num_failed, 1)
+        self.assertEqual(self.received, [commands])
+        # It will get the update from the dispatcher when it is back
+        self.assertFalse(PhotoServer.objects.get(pk=bad_server.pk).unreachable)
+
+    def test_circuit_breaker(self):
+        breaker = photo_servers.CircuitBreaker(2, 0.05)
+
+        breaker.record_failure()
+        self.assertTrue(breaker.allow_request())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow_request())
+
+        # After the cooldown a single request is let through
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow_request())
+        self.assertFalse(breaker.allow_request())
+
+        breaker.record_success()
+        self.assertFalse(breaker.is_open())
+        self.assertTrue(breaker.allow_request())
+
+    def add_photo(self, album, subdomain, the_date):
+        p = Photo.objects.create(
+                photo_id = Photo.generate_photo_id(),
+                media_type = Photo.MEDIA_TYPE_PHOTO,
+                storage_id = Photo.generate_photo_id(),
+                subdomain = subdomain,
+                date_created = the_date,
+                author = album.creator,
+                album = album,
+                album_index = album.allocate_album_indexes())
+        photo_operations.update_all_photo_servers({ subdomain: [p] })
+        return p
+
+    @override_settings(PHOTO_SERVER_SYNC_CHUNK_SIZE=2)
+    def test_register_photo_server(self):
+        the_date = datetime.datetime(2010, 1, 1, tzinfo=utc)
+        amanda = User.objects.create_user('amanda')
+        album = Album.objects.create_album(amanda, 'Party', the_date)
+
+        photos = [self.add_photo(album, 'photos01', the_date) for i in xrange(5)]
+        self.add_photo(album, 'photos02', the_date)
+
+        url = self.start_photo_server()
+        photo_operations.register_photo_server(url, 'photos01', 'key', timezone.now())
+
+        # Sent in chunks, and only the photos of its subdomain
+        self.assertEqual(len(self.received), 3)
+        sent = dict((c['key'], c['value']) for body in self.received for c in body)
+        self.assertEqual(sent, dict((p.photo_id, p.storage_id) for p in photos))
+
+        # The dispatcher starts from before any change that may not have
+        # been committed yet when the photos were sent
+        photo_server = PhotoServer.objects.get(photos_update_url=url)
+        self.assertEqual(photo_server.last_change_id, 0)
+
+        # From now on, it is sent the new photos of its subdomain right away
+        new_photo = self.add_photo(album, 'photos01', the_date)
+        self.assertEqual(self.received[-1], [{ 'cmd': 'set', 'key': new_photo.photo_id, 'value': new_photo.storage_id }])
+
+    @override_settings(PHOTO_SERVER_IMMEDIATE_UPDATES=False)
+    def test_dispatch_photo_server_changes(self):
+        the_date = datetime.datetime(2010, 1, 1, tzinfo=utc)
+        amanda = User.objects.create_user('amanda')
+        album = Album.objects.create_album(amanda, 'Party', the_date)
+
+        photo_server = PhotoServer.objects.create(photos_update_url=self.start_photo_server(),
+                subdomain='photos01', auth_key='key', date_registered=the_date, unreachable=False)
+
+        photo = self.add_photo(album, 'photos01', the_date)
+        photo_id = photo.photo_id
+        self.add_photo(album, 'photos02', the_date)
+        photo.delete()
+        self.assertEqual(self.received, [])
+
+        already_sent = {}
+        now = timezone.now()
+
+        # The changes are delivered in one batch, but they are too new to be
+        # acknowledged
+        self.assertEqual(photo_operations.dispatch_photo_server_changes(now, already_sent), 2)
+        self.assertEqual(self.received, [[
+            { 'cmd': 'set', 'key': photo_id, 'value': photo.storage_id },
+            { 'cmd': 'delete', 'key': photo_id }]])
+        self.assertEqual(PhotoServer.objects.get(pk=photo_server.pk).last_change_id, 0)
+
+        # Not sent again
+        self.assertEqual(photo_operations.dispatch_photo_server_changes(now, already_sent), 0)
+
+        later = now + datetime.timedelta(seconds=settings.PHOTO_SERVER_CHANGE_SETTLE_TIME + 1)
+        self.assertEqual(photo_operations.dispatch_photo_server_changes(later, already_sent), 0)
+        self.assertEqual(PhotoServer.objects.get(pk=photo_server.pk).last_change_id,
+                PhotoServerChange.objects.filter(subdomain='photos01').latest('id').id)
+        self.assertEqual(len(self.received), 1)
+
+        # Everything was received by all of the photo servers
+        PhotoServerChange.objects.prune(later)
+        self.assertEqual(list(PhotoServerChange.objects.filter(subdomain='photos01')), [])
@@ -1,9 +1,15 @@
+import json
+
 from django.contrib import admin
+from django.http import HttpResponse
 from django.shortcuts import render_to_response
 from django.template import RequestContext
 
-from photos.models import Photo
+from photos.models import Photo, ProcessedImageManifest
 from photos import image_uploads
+from photos import worker_pool
+from photos_api import check_modified
+from photos_api import optimized_views
 
 @admin.site.admin_view
 def processed_photos(request):
@@ -11,12 +17,14 @@ def processed_photos(request):
     already_processed_photos = []
     now_processed_photos = []
     num_processed = 0
-    for photo in Photo.objects.all():
-        if image_uploads.photo_is_processed(photo.storage_id):
+    photos = list(Photo.objects.all())
+    missing_image_sizes = ProcessedImageManifest.objects.get_missing_image_sizes([p.storage_id for p in photos])
+    for photo in photos:
+        if not missing_image_sizes[photo.storage_id]:
             already_processed_photos.append(photo)
         else:
             if 'process_photos' in request.POST and num_processed < int(request.POST['num_photos']):
-                image_uploads.process_uploaded_image(photo.storage_id)
+                image_uploads.process_uploaded_image(photo.storage_id, image_size_strs=image_uploads.get_eager_image_size_strs())
                 now_processed_photos.append(photo)
                 num_processed += 1
             else:
@@ -28,3 +36,35 @@ def processed_photos(request):
             'now_processed_photos': now_processed_photos,
             }
     return render_to_response('photos/processed_photos.html', data, context_instance=RequestContext(request))
+
+
+@admin.site.admin_view
+def action_pool_status(request):
+    """
+    Statistics of the worker pool of the process that handles this request
+    """
+    stats = worker_pool.get_action_pool().get_stats()
+    return HttpResponse(json.dumps(stats, indent=4, sort_keys=True), content_type='application/json')
+
+
+@admin.site.admin_view
+def album_payload_cache_status(request):
+    """
+    Statistics of the album payload cache of the process that handles this
+    request
+    """
+    if optimized_views.album_payload_cache is None:
+        stats = None
+    else:
+        stats = optimized_views.album_payload_cache.get_stats()
+    return HttpResponse(json.dumps(stats, indent=4, sort_keys=True), content_type='application/json')
+
+
+@admin.site.admin_view
+def conditional_response_status(request):
+    """
+    The number of "304 Not Modified" and of other responses of each view that
+    supports conditional GET requests, in the process that handles this request
+    """
+    stats = check_modified.get_response_counts()
+    return HttpResponse(json.dumps(stats, indent=4, sort_keys=True), content_type='application/json')
@@ -0,0 +1,201 @@
+"""
+A process-wide pool of threads for running database actions that must run in
+their own connection (and therefore their own transaction), separately from
+the transaction of the current request.
+
+This replaces starting a new thread (with a new database connection) for every
+action. The number of threads, and so the number of database connections, is
+bounded, and each thread keeps its connection open between actions.
+"""
+
+import Queue
+import os
+import sys
+import threading
+import time
+
+from django.conf import settings
+import django.db
+
+
+class WorkerPoolFullException(RuntimeError):
+    pass
+
+
+class _Task(object):
+    def __init__(self, fn):
+        self.fn = fn
+        self.submit_time = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+    def wait(self):
+        """
+        Returns the result of the task. If the task raised an exception, then
+        it is raised here (with the original traceback)
+        """
+        self.done.wait()
+        if self.exc_info is not None:
+            t, v, tb = self.exc_info
+            raise t, v, tb
+        return self.result
+
+
+class WorkerPool(object):
+    def __init__(self, num_threads, max_queue_size, submit_timeout):
+        self.num_threads = num_threads
+        self.submit_timeout = submit_timeout
+        self.queue = Queue.Queue(max_queue_size)
+
+        self.lock = threading.Lock()
+        self.threads = []
+        self.local = threading.local()
+
+        self.num_busy = 0
+        self.num_completed = 0
+        self.num_failed = 0
+        self.num_rejected = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.total_run_time = 0.0
+
+    def run(self, fn):
+        """
+        Runs `fn' (a callable with no arguments) on one of the pool threads,
+        waits for it to finish, and returns its result.
+
+        May raise `WorkerPoolFullException' if too many actions are already
+        waiting
+        """
+        return self.submit(fn).wait()
+
+    def submit(self, fn):
+        """
+        Like `run', but doesn't wait for `fn' to finish. Returns an object
+        whose `wait' method returns the result of `fn' (or raises its
+        exception)
+
+        May raise `WorkerPoolFullException' if too many actions are already
+        waiting
+        """
+        task = _Task(fn)
+
+        if getattr(self.local, 'is_worker', False):
+            # Waiting for another pool thread from inside a pool thread could
+            # deadlock
+            try:
+                task.result = fn()
+            except Exception:
+                task.exc_info = sys.exc_info()
+            task.done.set()
+            return task
+
+        self._start_threads()
+
+        try:
+            self.queue.put(task, True, self.submit_timeout)
+        except Queue.Full:
+            with self.lock:
+                self.num_rejected += 1
+            raise WorkerPoolFullException('Worker pool queue is full ({0} waiting)'.format(self.queue.qsize()))
+
+        return task
+
+    def get_stats(self):
+        with self.lock:
+            num_finished = self.num_completed + self.num_failed
+            return {
+                'num_threads': len(self.threads),
+                'num_busy': self.num_busy,
+                'queue_length': self.queue.qsize(),
+                'num_completed': self.num_completed,
+                'num_failed': self.num_failed,
+                'num_rejected': self.num_rejected,
+                'avg_wait_time': self.total_wait_time / num_finished if num_finished else 0.0,
+                'max_wait_time': self.max_wait_time,
+                'avg_run_time': self.total_run_time / num_finished if num_finished else 0.0
+            }
+
+    def _start_threads(self):
+        if len(self.threads) == self.num_threads:
+            return
+
+        with self.lock:
+            while len(self.threads) < self.num_threads:
+                t = threading.Thread(target=self._worker)
+                # Don't prevent the process from exiting. Callers always wait
+                # for their own tasks, so no work is lost
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+
+    def _worker(self):
+        self.local.is_worker = True
+        while True:
+            task = self.queue.get()
+
+            start_time = time.time()
+            wait_time = start_time - task.submit_time
+            with self.lock:
+                self.num_busy += 1
+
+            try:
+                task.result = task.fn()
+            except Exception:
+                task.exc_info = sys.exc_info()
+            finally:
+                # Keeps the connection open for the next task (unless it is
+                # broken or too old, see CONN_MAX_AGE)
+                django.db.close_old_connections()
+
+            run_time = time.time() - start_time
+            with self.lock:
+                self.num_busy -= 1
+                if task.exc_info is None:
+                    self.num_completed += 1
+                else:
+                    self.num_failed += 1
+                self.total_wait_time += wait_time
+                self.max_wait_time = max(self.max_wait_time, wait_time)
+                self.total_run_time += run_time
+
+            task.done.set()
+            # Don't keep the traceback (and everything it references) alive
+            # until the next task arrives
+            task = None
+
+
+_action_pool = None
+_action_pool_pid = None
+_action_pool_lock = threading.Lock()
+
+def get_action_pool():
+    """
+    Returns the process-wide pool, creating it if needed (threads don't
+    survive a fork, so a new pool is created in child processes)
+    """
+    global _action_pool, _action_pool_pid
+
+    with _action_pool_lock:
+        if _action_pool is None or _action_pool_pid != os.getpid():
+            _action_pool = WorkerPool(
+                    settings.ACTION_POOL_NUM_THREADS,
+                    settings.ACTION_POOL_MAX_QUEUE_SIZE,
+                    settings.ACTION_POOL_SUBMIT_TIMEOUT)
+            _action_pool_pid = os.getpid()
+        return _action_pool
+
+def run_action(fn):
+    """
+    Runs `fn' in its own database connection, and returns its result. Any
+    exception that it raises is raised here.
+
+    When USING_LOCAL_PHOTOS, `fn' is run directly instead. This is needed for
+    the tests to work with sqlite. See this bug:
+        https://code.djangoproject.com/ticket/12118
+    """
+    if settings.USING_LOCAL_PHOTOS:
+        return fn()
+    else:
+        return get_action_pool().run(fn)
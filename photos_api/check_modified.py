@@ -1,5 +1,6 @@
 import calendar
 import datetime
+import threading
 
 from django.utils.http import http_date, parse_http_date_safe
 from django.utils.http import parse_etags, quote_etag
@@ -8,6 +9,33 @@ from django.views.decorators.csrf import csrf_exempt
 from rest_framework import status
 from rest_framework.response import Response
 
+# The number of "304 Not Modified" and of other responses to GET requests of
+# each view, in this process
+_response_counts = {}
+_response_counts_lock = threading.Lock()
+
+def record_response(View, request, response):
+    if not request.method in ('GET', 'HEAD'):
+        return
+
+    with _response_counts_lock:
+        counts = _response_counts.setdefault(View.__name__, {
+            'num_not_modified': 0,
+            'num_ok': 0,
+            'num_other': 0
+            })
+        if response.status_code == status.HTTP_304_NOT_MODIFIED:
+            counts['num_not_modified'] += 1
+        elif response.status_code == status.HTTP_200_OK:
+            counts['num_ok'] += 1
+        else:
+            counts['num_other'] += 1
+
+def get_response_counts():
+    with _response_counts_lock:
+        return dict((name, dict(counts)) for name, counts in _response_counts.iteritems())
+
+
 def supports_last_modified(View):
     # Note: session based authentication is explicitly CSRF validated,
     # all other authentication is CSRF exempt.
@@ -66,6 +94,7 @@ def supports_last_modified(View):
             response = self.handle_exception(exc)
 
         self.response = self.finalize_response(request, response, *args, **kwargs)
+        record_response(View, request, self.response)
         return self.response
 
     View.dispatch = dispatch
@@ -119,11 +148,15 @@ def supports_etag(View):
             if request.method.lower() in self.http_method_names:
                 resource_etag = self.get_etag(request, *args, **kwargs)
 
-                handler = getattr(self, request.method.lower(),
-                                  self.http_method_not_allowed)
+                not_modified_response = get_not_modified_response(resource_etag)
+                if not_modified_response:
+                    response = not_modified_response
+                else:
+                    handler = getattr(self, request.method.lower(),
+                                      self.http_method_not_allowed)
+                    response = handler(request, *args, **kwargs)
 
                 # The ETag header is added!
-                response = handler(request, *args, **kwargs)
                 response['ETag'] = quote_etag(resource_etag)
             else:
                 handler = self.http_method_not_allowed
@@ -133,6 +166,7 @@ def supports_etag(View):
             response = self.handle_exception(exc)
 
         self.response = self.finalize_response(request, response, *args, **kwargs)
+        record_response(View, request, self.response)
         return self.response
 
     View.dispatch = dispatch
@@ -1,103 +1,366 @@
+import base64
 import collections
+import datetime
+import json
+import sqlite3
 
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import connection
 
-from phone_auth.models import User, avatar_url_from_avatar_file_data
-from photos.models import Photo, Video, AlbumMember
+from phone_auth.models import avatar_url_from_avatar_file_data
+from photos.models import Photo, Video, Album, AlbumMember, AlbumChange, GlobalGlanceScoreChange, PhotoGlanceScoreDelta, UserHiddenPhoto
+from photos import image_uploads
+from photos_api.payload_cache import PayloadCache
 from photos_api.serializers import album_name_or_members
 
+# The payloads of album details are cached in every process (see
+# `get_album_shared_payload')
+if settings.ALBUM_PAYLOAD_CACHE_MAX_BYTES:
+    album_payload_cache = PayloadCache(settings.ALBUM_PAYLOAD_CACHE_MAX_BYTES)
+else:
+    album_payload_cache = None
+
 def get_album_members_payload(album_id):
+    return get_albums_members_payloads([album_id]).get(album_id, [])
+
+def get_albums_members_payloads(album_ids):
+    """
+    Returns a dict from each of the album ids to the list of the payloads of
+    the members of the album (albums without members are left out)
+    """
     cursor = connection.cursor()
     cursor.execute(
         """
-        SELECT user_id0,
-               user_nickname0,
-               user_last_online0,
-               user_avatar_file0,
-               user_glance_score0,
-               member_album_admin0,
-               member_added_by_user_id0,
-               user_phone_verified0,
-               user_phone_link_visited0
-        FROM (SELECT u.id as user_id0,
-                     u.nickname as user_nickname0,
-                     u.last_online as user_last_online0,
-                     u.avatar_file as user_avatar_file0,
-                     u.user_glance_score as user_glance_score0,
-                     (SELECT COUNT(*)
-                      FROM phone_auth_phonenumber
-                      WHERE user_id=u.id AND
-                            verified) as user_phone_verified0,
-                     (SELECT COUNT(*)
-                      FROM phone_auth_phonenumberlinkcode
-                      LEFT OUTER JOIN phone_auth_phonenumber
-                      ON phone_auth_phonenumberlinkcode.phone_number_id=phone_auth_phonenumber.id
-                      WHERE phone_auth_phonenumber.user_id = u.id AND
-                            phone_auth_phonenumberlinkcode.was_visited) as user_phone_link_visited0
-              FROM phone_auth_user u) as T1,
-             (SELECT user_id as user_id1,
-                     album_admin as member_album_admin0,
-                     added_by_user_id as member_added_by_user_id0
-              FROM photos_album_members
-              WHERE album_id=%s) as T2
-        WHERE user_id0=user_id1
+        SELECT am.album_id,
+               u.id,
+               u.nickname,
+               u.last_online,
+               u.avatar_file,
+               u.user_glance_score,
+               u.invite_status,
+               am.album_admin,
+               am.added_by_user_id
+        FROM photos_album_members am
+        INNER JOIN phone_auth_user u
+        ON am.user_id=u.id
+        WHERE am.album_id IN (""" + sql_placeholders(album_ids) + """)
         """,
-        [album_id])
+        album_ids)
 
-    members = []
+    albums_members = {}
     for row in cursor.fetchall():
-        (row_user_id,
+        (row_album_id,
+        row_user_id,
         row_user_nickname,
         row_user_last_online,
         row_user_avatar_file,
         row_user_glance_score,
+        row_user_invite_status,
         row_member_album_admin,
-        row_member_added_by_user_id,
-        row_user_phone_verified,
-        row_user_phone_link_visited) = row
-
-        if row_user_phone_verified > 0:
-            invite_status = User.STATUS_JOINED
-        elif row_user_phone_link_visited > 0:
-            invite_status = User.STATUS_INVITATION_VIEWED
-        else:
-            invite_status = User.STATUS_SMS_SENT
+        row_member_added_by_user_id) = row
 
-        members.append({
+        albums_members.setdefault(row_album_id, []).append({
             'id': row_user_id,
             'nickname': row_user_nickname,
             'last_online': row_user_last_online,
-            'avatar_url': avatar_url_from_avatar_file_data(row_user_avatar_file),
+            'avatar_url': get_avatar_url(row_user_avatar_file),
             'user_glance_score': row_user_glance_score,
             'album_admin': row_member_album_admin,
             'added_by_user_id': row_member_added_by_user_id,
-            'invite_status': invite_status
+            'invite_status': row_user_invite_status
         })
 
-    return members
+    return albums_members
+
+def sql_placeholders(values):
+    return ', '.join(['%s'] * len(values))
+
+def get_users_payloads(user_ids):
+    """
+    Returns a dict from the user ids to the payloads of the users (as the
+    author of a photo or a comment, or the creator of an album)
+    """
+    user_ids = list(user_ids)
+    users = {}
+    # Stay well below the limit of the number of query parameters of the
+    # database
+    CHUNK_SIZE = 500
+    for i in xrange(0, len(user_ids), CHUNK_SIZE):
+        chunk = user_ids[i:i+CHUNK_SIZE]
+        cursor = connection.cursor()
+        cursor.execute(
+            """
+            SELECT id,
+                   nickname,
+                   last_online,
+                   avatar_file,
+                   user_glance_score
+            FROM phone_auth_user
+            WHERE id IN (""" + sql_placeholders(chunk) + """)
+            """,
+            chunk)
+
+        for row in cursor.fetchall():
+            (row_user_id,
+            row_user_nickname,
+            row_user_last_online,
+            row_user_avatar_file,
+            row_user_glance_score) = row
+
+            users[row_user_id] = {
+                'id': row_user_id,
+                'nickname': row_user_nickname,
+                'last_online': row_user_last_online,
+                'avatar_url': get_avatar_url(row_user_avatar_file),
+                'user_glance_score': row_user_glance_score
+            }
+
+    return users
+
+def make_member_payload(user_payload, member):
+    """
+    Returns the payload of a member of an album (like in
+    `get_albums_members_payloads') from the payload of the user (see
+    `get_users_payloads') and the shared payload of the membership (see
+    `get_album_shared_payload')
+    """
+    return {
+        'id': user_payload['id'],
+        'nickname': user_payload['nickname'],
+        'last_online': user_payload['last_online'],
+        'avatar_url': user_payload['avatar_url'],
+        'user_glance_score': user_payload['user_glance_score'],
+        'album_admin': member['album_admin'],
+        'added_by_user_id': member['added_by_user_id'],
+        'invite_status': member['invite_status']
+    }
+
+_avatar_urls = {}
+
+def get_avatar_url(avatar_file):
+    """
+    Like `avatar_url_from_avatar_file_data'. Most users have one of the
+    default avatars, so the results are cached
+    """
+    try:
+        return _avatar_urls[avatar_file]
+    except KeyError:
+        pass
+
+    avatar_url = avatar_url_from_avatar_file_data(avatar_file)
+
+    if len(_avatar_urls) < 10000:
+        _avatar_urls[avatar_file] = avatar_url
+    return avatar_url
+
+_image_dimensions_payloads = {}
+
+def get_image_dimensions_payload(width, height):
+    """
+    Returns a dict from each of the `image_uploads.image_sizes' to the
+    [width, height] of that resized version of an image with the given
+    dimensions.
+
+    Most photos have one of a few common dimensions, so the results are cached
+    (the returned dict must not be modified)
+    """
+    try:
+        return _image_dimensions_payloads[(width, height)]
+    except KeyError:
+        pass
+
+    payload = {}
+    for image_size_str, d in image_uploads.image_sizes.iteritems():
+        payload[image_size_str] = list(d.get_image_dimensions(width, height))
+
+    if len(_image_dimensions_payloads) < 10000:
+        _image_dimensions_payloads[(width, height)] = payload
+    return payload
 
 def get_album_photos_payload(user_id, album_id, only_newest=None):
     if only_newest:
-        order_limit_clause = \
-           """
-           ORDER BY album_index0 DESC
-           LIMIT {0}
-           """.format(only_newest)
+        newest_sql, newest_params = newest_photo_ids_sql(user_id, only_newest, '%s', [album_id])
+        albums_photos = get_photos_payload(user_id,
+                """
+                p.photo_id IN (""" + newest_sql + """)
+                """,
+                newest_params,
+                """
+                ORDER BY album_index0 DESC
+                """)
+    else:
+        albums_photos = get_photos_payload(user_id,
+                """
+                p.album_id = %s
+                """,
+                [album_id],
+                """
+                ORDER BY album_index0
+                """)
+
+    return albums_photos.get(album_id, [])
+
+def supports_window_functions():
+    # Window functions were added in SQLite 3.25
+    return connection.vendor != 'sqlite' or sqlite3.sqlite_version_info >= (3, 25, 0)
+
+def not_hidden_sql(alias):
+    """
+    An SQL expression that is true if the user (a parameter) has not hidden
+    the photo of the table `alias'
+    """
+    return \
+        """
+        NOT EXISTS (SELECT 1
+                    FROM photos_userhiddenphoto
+                    WHERE photos_userhiddenphoto.photo_id = {0}.photo_id AND
+                          photos_userhiddenphoto.user_id = %s)
+        """.format(alias)
+
+def newest_photo_ids_sql(user_id, only_newest, albums_sql, albums_params):
+    """
+    Returns a tuple (sql, params) of an SQL query for the ids of the
+    `only_newest' newest photos of every album that `albums_sql' selects.
+    Photos that the user has hidden are left out.
+
+    albums_sql: An SQL expression or query that is used as
+    "album_id IN (albums_sql)", with the parameters `albums_params'
+    """
+    if supports_window_functions():
+        sql = \
+            """
+            SELECT photo_id
+            FROM (SELECT np.photo_id,
+                         ROW_NUMBER() OVER (PARTITION BY np.album_id
+                                            ORDER BY np.album_index DESC) as photo_rank0
+                  FROM photos_photo np
+                  WHERE np.album_id IN (""" + albums_sql + """) AND
+                        """ + not_hidden_sql('np') + """) as R
+            WHERE photo_rank0 <= {0}
+            """.format(int(only_newest))
+        params = albums_params + [user_id]
+    else:
+        # Count the newer photos of the same album instead
+        sql = \
+            """
+            SELECT np.photo_id
+            FROM photos_photo np
+            WHERE np.album_id IN (""" + albums_sql + """) AND
+                  """ + not_hidden_sql('np') + """ AND
+                  (SELECT COUNT(*)
+                   FROM photos_photo np2
+                   WHERE np2.album_id = np.album_id AND
+                         np2.album_index > np.album_index AND
+                         """ + not_hidden_sql('np2') + """) < {0}
+            """.format(int(only_newest))
+        params = albums_params + [user_id, user_id]
+
+    return (sql, params)
+
+# The largest page size of `get_album_photos_page_payload'
+MAX_PAGE_SIZE = 500
+
+def encode_photos_cursor(album_index):
+    return base64.urlsafe_b64encode('album_index:{0}'.format(album_index))
+
+def decode_photos_cursor(cursor):
+    """
+    Returns the album_index of the last photo of the previous page. Raises
+    ValueError if the cursor is invalid
+    """
+    try:
+        decoded = base64.urlsafe_b64decode(str(cursor))
+    except (TypeError, UnicodeEncodeError):
+        raise ValueError('Invalid cursor')
+    prefix, _, album_index = decoded.partition(':')
+    if prefix != 'album_index':
+        raise ValueError('Invalid cursor')
+    return int(album_index)
+
+def get_album_photos_page_payload(user_id, album_id, page_size, cursor=None, include_users=True):
+    """
+    Returns a tuple (photos, next_cursor) of a page of the photos of an album,
+    ordered by album_index, starting after the page of `cursor' (or from the
+    first photo if it is None). The comments are only loaded for the photos
+    of the page.
+
+    next_cursor is None if this is the last page.
+
+    include_users: See `get_photos_payload'
+
+    Raises ValueError if the cursor is invalid
+    """
+    if cursor is None:
+        after_album_index = -1
+    else:
+        after_album_index = decode_photos_cursor(cursor)
+
+    db_cursor = connection.cursor()
+    db_cursor.execute(
+        """
+        SELECT np.photo_id,
+               np.album_index
+        FROM photos_photo np
+        WHERE np.album_id = %s AND
+              np.album_index > %s AND
+              """ + not_hidden_sql('np') + """
+        ORDER BY np.album_index
+        LIMIT %s
+        """,
+        [album_id, after_album_index, user_id, page_size + 1])
+    rows = db_cursor.fetchall()
+
+    # One extra row is read to find out if there is another page
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_photos_cursor(rows[-1][1])
     else:
-        order_limit_clause = \
-           """
-           ORDER BY album_index0
-           """
+        next_cursor = None
 
+    if not rows:
+        return ([], next_cursor)
+
+    photos = get_photos_payload(user_id,
+            """
+            p.photo_id IN (""" + ', '.join(['%s'] * len(rows)) + """)
+            """,
+            [photo_id for photo_id, _ in rows],
+            """
+            ORDER BY album_index0
+            """,
+            include_users)
+
+    return (photos.get(album_id, []), next_cursor)
+
+def get_photos_payload(user_id, condition, condition_params, order_clause, include_users=True):
+    """
+    Returns an OrderedDict from album ids to lists of the payloads of the
+    photos (including their comments) that match `condition', an SQL
+    expression on "photos_photo p" with the parameters `condition_params'.
+    Photos that the user has hidden are left out.
+
+    user_id: May be None, to include all of the photos, each with a
+    my_glance_score_delta of 0
+
+    order_clause: The order of the photos of each album (album_index0 can be
+    used)
+
+    include_users: If False, the "author" of the photos and of their comments
+    is only the user id (see `UserPhotosOverlay')
+    """
     cursor = connection.cursor()
     cursor.execute(
         """
-        SELECT photo_id0,
+        SELECT album_id0,
+               photo_id0,
                photo_youtube_id0,
                photo_media_type0,
                photo_client_upload_id0,
                photo_subdomain0,
                photo_date_created0,
+               photo_width0,
+               photo_height0,
                video_status0,
                video_storage_id0,
                video_duration0,
@@ -114,6 +377,8 @@ def get_album_photos_payload(user_id, album_id, only_newest=None):
                      p.client_upload_id as photo_client_upload_id0,
                      p.subdomain as photo_subdomain0,
                      p.date_created as photo_date_created0,
+                     p.width as photo_width0,
+                     p.height as photo_height0,
                      p.album_id as album_id0,
                      p.album_index as album_index0,
                      photos_video.status as video_status0,
@@ -124,17 +389,7 @@ def get_album_photos_payload(user_id, album_id, only_newest=None):
                      phone_auth_user.last_online as author_last_online0,
                      phone_auth_user.avatar_file as author_avatar_file0,
                      phone_auth_user.user_glance_score as author_user_glance_score0,
-                     (CASE WHEN p.copied_from_photo_id IS NULL
-                           THEN (SELECT COALESCE(SUM(photo_glance_score), 0) + p.photo_glance_score
-                                 FROM photos_photo
-                                 WHERE copied_from_photo_id=p.photo_id)
-                           ELSE (SELECT COALESCE(SUM(photo_glance_score), 0) +
-                                            (SELECT photo_glance_score
-                                             FROM photos_photo
-                                             WHERE photo_id=p.copied_from_photo_id)
-                                 FROM photos_photo
-                                 WHERE copied_from_photo_id=p.copied_from_photo_id)
-                           END) as photo_global_glance_score0,
+                     COALESCE(original.global_glance_score, p.global_glance_score) as photo_global_glance_score0,
                      (SELECT score_delta
                       FROM photos_photoglancescoredelta
                       WHERE photo_id=p.photo_id AND
@@ -143,22 +398,29 @@ def get_album_photos_payload(user_id, album_id, only_newest=None):
                       WHERE photos_userhiddenphoto.photo_id=p.photo_id AND
                             photos_userhiddenphoto.user_id=%s) as photo_hidden0
               FROM photos_photo p
+              LEFT OUTER JOIN photos_photo original
+              ON p.copied_from_photo_id=original.photo_id
               LEFT OUTER JOIN phone_auth_user
               ON p.author_id=phone_auth_user.id
               LEFT OUTER JOIN photos_video
-              ON p.storage_id=photos_video.storage_id) as T1
-        WHERE album_id0=%s AND photo_hidden0=0
-        """ + order_limit_clause,
-        [user_id, user_id ,album_id])
+              ON p.storage_id=photos_video.storage_id
+              WHERE """ + condition + """) as T1
+        WHERE photo_hidden0=0
+        """ + order_clause,
+        [user_id, user_id] + condition_params)
 
-    photos = collections.OrderedDict()
+    albums_photos = collections.OrderedDict()
+    photos = {}
     for row in cursor.fetchall():
-        (row_photo_id,
+        (row_album_id,
+        row_photo_id,
         row_youtube_id,
         row_media_type,
         row_client_upload_id,
         row_photo_subdomain,
         row_photo_date_created,
+        row_photo_width,
+        row_photo_height,
         row_video_status,
         row_video_storage_id,
         row_video_duration,
@@ -178,6 +440,17 @@ def get_album_photos_payload(user_id, album_id, only_newest=None):
         # Manually create a Photo instance so we can use it's helper methods
         photo = Photo(photo_id=row_photo_id, subdomain=row_photo_subdomain, media_type=row_media_type)
 
+        if include_users:
+            author = {
+                'id': row_author_id,
+                'nickname': row_author_nickname,
+                'last_online': row_author_last_online,
+                'avatar_url': get_avatar_url(row_author_avatar_file),
+                'user_glance_score': row_author_user_glance_score
+            }
+        else:
+            author = row_author_id
+
         photos[row_photo_id] = {
             'photo_id': row_photo_id,
             'youtube_id': row_youtube_id,
@@ -185,19 +458,17 @@ def get_album_photos_payload(user_id, album_id, only_newest=None):
             'client_upload_id': row_client_upload_id,
             'photo_url': photo.get_photo_url(),
             'date_created': row_photo_date_created,
-            'author': {
-                'id': row_author_id,
-                'nickname': row_author_nickname,
-                'last_online': row_author_last_online,
-                'avatar_url': avatar_url_from_avatar_file_data(row_author_avatar_file),
-                'user_glance_score': row_author_user_glance_score
-            },
+            'author': author,
             'comments': [], # Will be filled in later
             'user_tags': [], # Not used yet, will be left empty
             'glances': [], # Deprecated, will be left empty
             'global_glance_score': row_photo_global_glance_score,
-            'my_glance_score_delta': my_glance_score_delta
+            'my_glance_score_delta': my_glance_score_delta,
+            'width': row_photo_width,
+            'height': row_photo_height
         }
+        if row_photo_width is not None and row_photo_height is not None:
+            photos[row_photo_id]['image_dimensions'] = get_image_dimensions_payload(row_photo_width, row_photo_height)
         if photo.is_video():
             # Manually create a Video instance so we can use it's helper methods
             video = Video(status=row_video_status)
@@ -206,6 +477,8 @@ def get_album_photos_payload(user_id, album_id, only_newest=None):
             photos[row_photo_id]['video_thumbnail_url'] = Video.get_video_thumbnail_url(row_video_storage_id)
             photos[row_photo_id]['video_duration'] = row_video_duration
 
+        albums_photos.setdefault(row_album_id, []).append(photos[row_photo_id])
+
     cursor = connection.cursor()
     cursor.execute(
         """
@@ -223,10 +496,12 @@ def get_album_photos_payload(user_id, album_id, only_newest=None):
             ON photos_photocomment.photo_id=photos_photo.photo_id
         LEFT OUTER JOIN phone_auth_user
             ON photos_photocomment.author_id=phone_auth_user.id
-        WHERE album_id=%s
+        WHERE photos_photocomment.photo_id IN (SELECT p.photo_id
+                                               FROM photos_photo p
+                                               WHERE """ + condition + """)
         ORDER BY photos_photocomment.date_created;
         """,
-        [album_id])
+        condition_params)
 
     for row in cursor.fetchall():
         (row_photo_id,
@@ -239,16 +514,21 @@ def get_album_photos_payload(user_id, album_id, only_newest=None):
         row_photocomment_client_msg_id,
         row_photocomment_comment_text) = row
 
+        if include_users:
+            author = {
+                'id': row_photo_author_user_id,
+                'nickname': row_photo_author_user_nickname,
+                'last_online': row_photo_author_user_last_online,
+                'avatar_url': get_avatar_url(row_photo_author_user_avatar_file),
+                'user_glance_score': row_photo_author_user_user_glance_score
+            }
+        else:
+            author = row_photo_author_user_id
+
         photo_id = row_photo_id
         try:
             photos[photo_id]['comments'].append({
-                'author': {
-                    'id': row_photo_author_user_id,
-                    'nickname': row_photo_author_user_nickname,
-                    'last_online': row_photo_author_user_last_online,
-                    'avatar_url': avatar_url_from_avatar_file_data(row_photo_author_user_avatar_file),
-                    'user_glance_score': row_photo_author_user_user_glance_score
-                },
+                'author': author,
                 'date_created': row_photocomment_date_created,
                 'client_msg_id': row_photocomment_client_msg_id,
                 'comment': row_photocomment_comment_text,
@@ -257,16 +537,10 @@ def get_album_photos_payload(user_id, album_id, only_newest=None):
             # Ignore comments on photos that we are not interested in
             pass
 
-    return photos.values()
-
-def get_album_detail_payload(user, album):
-    album_member = AlbumMember.objects.filter(user=user, album=album).first()
-
-    members = get_album_members_payload(album.id)
-
-    photos = get_album_photos_payload(user.id, album.id)
+    return albums_photos
 
-    creator = {
+def get_album_creator_payload(album):
+    return {
         'id': album.creator.id,
         'nickname': album.creator.nickname,
         'last_online': album.creator.last_online,
@@ -274,21 +548,225 @@ def get_album_detail_payload(user, album):
         'user_glance_score': album.creator.user_glance_score
     }
 
+def get_album_shared_payload(album):
+    """
+    Returns the part of the album detail payload that is the same for all of
+    the members of the album: the creator, members, and photos (including
+    their comments and hidden photos, with a my_glance_score_delta of 0)
+
+    The fields of the users (which change without a revision of the album)
+    are left out: the creator and the authors of the photos and comments are
+    only user ids, and the members only have the fields of their membership
+    (see `make_member_payload'). "user_ids" lists all of them, to be looked
+    up with `get_users_payloads'.
+
+    The payload is cached by the album's revision_number, which is read (by
+    the caller) before the payload, so a cached payload is never older than
+    its revision. The returned payload must not be modified.
+    """
+    return get_albums_shared_payloads([album])[album.id]
+
+def get_album_cache_key(album):
+    # A revision that was rolled back (together with a payload that was
+    # cached in the same transaction) had the same revision_number as the
+    # next one, but not the same last_revision_date
+    return (album.id, album.revision_number, album.last_revision_date)
+
+def get_albums_shared_payloads(albums):
+    """
+    Like `get_album_shared_payload', for several albums. Returns a dict from
+    album ids to the payloads.
+
+    The payloads of all of the albums that are not cached are built with the
+    same few queries
+    """
+    payloads = {}
+    uncached_albums = []
+    for album in albums:
+        if album_payload_cache is not None:
+            payload = album_payload_cache.get(get_album_cache_key(album))
+            if payload is not None:
+                payloads[album.id] = payload
+                continue
+        uncached_albums.append(album)
+
+    if not uncached_albums:
+        return payloads
+
+    album_ids = [album.id for album in uncached_albums]
+    albums_members = get_albums_members_payloads(album_ids)
+    albums_photos = get_photos_payload(None,
+            """
+            p.album_id IN (""" + sql_placeholders(album_ids) + """)
+            """,
+            album_ids,
+            """
+            ORDER BY album_id0, album_index0
+            """,
+            include_users=False)
+
+    for album in uncached_albums:
+        members = [{
+            'id': m['id'],
+            'album_admin': m['album_admin'],
+            'added_by_user_id': m['added_by_user_id'],
+            'invite_status': m['invite_status']
+            } for m in albums_members.get(album.id, [])]
+        photos = albums_photos.get(album.id, [])
+
+        user_ids = get_photos_user_ids(photos)
+        user_ids.add(album.creator_id)
+        user_ids.update(m['id'] for m in members)
+
+        payload = {
+            'id': album.id,
+            'name': album.name,
+            'creator': album.creator_id,
+            'date_created': album.date_created,
+            'last_updated': album.last_updated,
+            'revision_number': album.revision_number,
+            'members': members,
+            'photos': photos,
+            'user_ids': sorted(user_ids)
+        }
+
+        if album_payload_cache is not None:
+            size = len(json.dumps(payload, cls=DjangoJSONEncoder))
+            album_payload_cache.put(get_album_cache_key(album), payload, size)
+
+        payloads[album.id] = payload
+
+    return payloads
+
+def get_photos_user_ids(photos):
+    """
+    Returns a set of the ids of the authors of the photos and of their
+    comments, in payloads without the users (see `get_photos_payload')
+    """
+    user_ids = set()
+    for photo in photos:
+        user_ids.add(photo['author'])
+        user_ids.update(c['author'] for c in photo['comments'])
+    return user_ids
+
+def get_album_etag(user_id, album):
+    """
+    The ETag of the album detail payload for the user (see `Album.get_etag')
+    """
+    last_access = AlbumMember.objects.filter(album=album, user__id=user_id) \
+            .values_list('last_access', flat=True).first()
+    num_hidden_photos = UserHiddenPhoto.objects.filter(user__id=user_id, photo__album=album).count()
+    return album.get_etag(last_access, num_hidden_photos)
+
+def get_album_member_fields(user, album):
+    """
+    Returns a tuple (name, last_access, num_new_photos) of the album, as seen
+    by the user
+    """
+    album_member = AlbumMember.objects.filter(user=user, album=album).first()
+
     if album_member:
-        name = album_name_or_members(album_member)
-        last_access = album_member.last_access
-        num_new_photos = album_member.get_num_new_photos()
+        return (album_name_or_members(album_member),
+                album_member.last_access,
+                album_member.get_num_new_photos())
+    else:
+        return (album.name, None, 0)
+
+class UserPhotosOverlay(object):
+    """
+    Turns the shared payloads of the photos of an album (with all of the
+    photos, and a my_glance_score_delta of 0) into the payloads that the user
+    sees
+    """
+    def __init__(self, user, album, hidden_photo_ids=None, my_glance_score_deltas=None, users=None):
+        """
+        The photos that the user has hidden and the user's glance score deltas
+        are queried, unless they are given (they may also include the photos
+        of other albums)
+
+        users: If the authors of the photos and comments are only user ids
+        (like in `get_album_shared_payload'), the payloads of the users (see
+        `get_users_payloads')
+        """
+        if hidden_photo_ids is None:
+            hidden_photo_ids = set(UserHiddenPhoto.objects
+                    .filter(user=user, photo__album=album)
+                    .values_list('photo_id', flat=True))
+        if my_glance_score_deltas is None:
+            my_glance_score_deltas = dict(PhotoGlanceScoreDelta.objects
+                    .filter(author=user, photo__album=album)
+                    .exclude(score_delta=0)
+                    .values_list('photo_id', 'score_delta'))
+        self.hidden_photo_ids = hidden_photo_ids
+        self.my_glance_score_deltas = my_glance_score_deltas
+        self.users = users
+
+    def apply_photo(self, photo):
+        """
+        Returns None if the user has hidden the photo, the same `photo' if the
+        user sees it unchanged, or else a changed copy of it
+        """
+        if photo['photo_id'] in self.hidden_photo_ids:
+            return None
+        if self.users is not None:
+            # Don't modify the shared payload
+            photo = dict(photo)
+            photo['author'] = self.users[photo['author']]
+            comments = []
+            for shared_comment in photo['comments']:
+                comment = dict(shared_comment)
+                comment['author'] = self.users[comment['author']]
+                comments.append(comment)
+            photo['comments'] = comments
+        if photo['photo_id'] in self.my_glance_score_deltas:
+            if self.users is None:
+                photo = dict(photo)
+            photo['my_glance_score_delta'] = self.my_glance_score_deltas[photo['photo_id']]
+        return photo
+
+    def apply(self, shared_photos):
+        photos = []
+        for photo in shared_photos:
+            photo = self.apply_photo(photo)
+            if photo is not None:
+                photos.append(photo)
+        return photos
+
+def get_album_detail_payload(user, album):
+    shared_payload = get_album_shared_payload(album)
+    users = get_users_payloads(shared_payload['user_ids'])
+
+    photos = UserPhotosOverlay(user, album, users=users).apply(shared_payload['photos'])
+
+    return make_album_detail_payload(shared_payload, get_album_member_fields(user, album), photos, users)
+
+def make_album_detail_payload(shared_payload, member_fields, photos, users=None):
+    """
+    shared_payload: The album fields of the payload (see
+    `get_album_shared_payload')
+
+    member_fields: The result of `get_album_member_fields'
+
+    users: If the creator and the members of `shared_payload' are only user
+    ids and memberships (like in `get_album_shared_payload'), the payloads of
+    the users (see `get_users_payloads')
+    """
+    name, last_access, num_new_photos = member_fields
+
+    if users is None:
+        creator = shared_payload['creator']
+        members = shared_payload['members']
     else:
-        name = album.name
-        last_access = None
-        num_new_photos = 0
+        creator = users[shared_payload['creator']]
+        members = [make_member_payload(users[m['id']], m) for m in shared_payload['members']]
 
     payload = {
-        'id': album.id,
+        'id': shared_payload['id'],
         'name': name,
         'creator': creator,
-        'date_created': album.date_created,
-        'last_updated': album.last_updated,
+        'date_created': shared_payload['date_created'],
+        'last_updated': shared_payload['last_updated'],
+        'revision_number': shared_payload['revision_number'],
         'last_access': last_access,
         'num_new_photos': num_new_photos,
         'members': members,
@@ -297,18 +775,247 @@ def get_album_detail_payload(user, album):
     return payload
 
 
-def get_album_list_payload(user_id):
-    if connection.vendor == 'sqlite':
-        am_last_access_offset = \
-            """
-            datetime(am.last_access, '0.1 second')
-            """
+def get_album_header_payload(user, album):
+    """
+    The album detail payload, with None instead of the photos
+    """
+    album_payload = {
+        'id': album.id,
+        'creator': get_album_creator_payload(album),
+        'date_created': album.date_created,
+        'last_updated': album.last_updated,
+        'revision_number': album.revision_number,
+        'members': get_album_members_payload(album.id)
+    }
+    return make_album_detail_payload(album_payload, get_album_member_fields(user, album), None)
+
+def get_album_page_payload(user, album, page_size, cursor=None):
+    """
+    Like `get_album_detail_payload', but with only a page of the photos (see
+    `get_album_photos_page_payload'), and the cursor of the next page in
+    "next_cursor".
+
+    Raises ValueError if the cursor is invalid
+    """
+    photos, next_cursor = get_album_photos_page_payload(user.id, album.id, page_size, cursor)
+
+    payload = get_album_header_payload(user, album)
+    payload['photos'] = photos
+    payload['next_cursor'] = next_cursor
+    return payload
+
+# The maximum number of albums in a request of `get_album_details_payload'
+MAX_ALBUM_DETAILS = 100
+
+def get_album_details_payload(user, known_etags):
+    """
+    The payload of the details of several albums at once, for clients that
+    sync many albums (for example after the album list has changed).
+
+    known_etags: An OrderedDict from album ids to the ETag of the album that
+    the client already has (see `get_album_etag'), or None
+
+    Only the albums that the user is a member of are included, each with its
+    current ETag, and with the same payload as `get_album_detail_payload'
+    only if the ETag has changed. The other album ids are in
+    "removed_album_ids".
+
+    Albums that are too large to include (see `is_large_album') are marked
+    "fetch_individually" instead, without their payload, so that the client
+    fetches each of them on its own (where they are streamed)
+
+    The number of queries doesn't depend on the number of albums
+    """
+    album_ids = known_etags.keys()
+
+    memberships = dict((m.album_id, m) for m in AlbumMember.objects
+            .filter(user=user, album__id__in=album_ids)
+            .select_related('album', 'album__creator'))
+
+    hidden_photos = UserHiddenPhoto.objects \
+            .filter(user=user, photo__album__id__in=memberships.keys()) \
+            .values_list('photo__album_id', 'photo_id')
+    hidden_photo_ids = set()
+    num_hidden_photos = collections.Counter()
+    for album_id, photo_id in hidden_photos:
+        hidden_photo_ids.add(photo_id)
+        num_hidden_photos[album_id] += 1
+
+    etags = {}
+    large_album_ids = set()
+    changed_albums = []
+    for album_id in album_ids:
+        membership = memberships.get(album_id)
+        if membership is None:
+            continue
+        etags[album_id] = membership.album.get_etag(membership.last_access, num_hidden_photos[album_id])
+        if etags[album_id] != known_etags[album_id]:
+            if is_large_album(membership.album):
+                large_album_ids.add(album_id)
+            else:
+                changed_albums.append(membership.album)
+
+    album_payloads = {}
+    if changed_albums:
+        changed_album_ids = [album.id for album in changed_albums]
+        shared_payloads = get_albums_shared_payloads(changed_albums)
+        user_ids = set()
+        for shared_payload in shared_payloads.itervalues():
+            user_ids.update(shared_payload['user_ids'])
+        users = get_users_payloads(user_ids)
+        overlay = UserPhotosOverlay(user, None,
+                hidden_photo_ids = hidden_photo_ids,
+                my_glance_score_deltas = dict(PhotoGlanceScoreDelta.objects
+                    .filter(author=user, photo__album__id__in=changed_album_ids)
+                    .exclude(score_delta=0)
+                    .values_list('photo_id', 'score_delta')),
+                users = users)
+        member_names = get_unnamed_albums_member_names(user.id, sql_placeholders(changed_album_ids), changed_album_ids)
+
+        for album in changed_albums:
+            membership = memberships[album.id]
+            shared_payload = shared_payloads[album.id]
+            # See: photos_api.serializers.album_name_or_members
+            name = album.name or u', '.join(member_names.get(album.id, []))
+            album_payloads[album.id] = make_album_detail_payload(shared_payload,
+                    (name, membership.last_access, membership.num_new_photos),
+                    overlay.apply(shared_payload['photos']),
+                    users)
+
+    payload = {
+        'albums': [{
+            'id': album_id,
+            'etag': etags[album_id],
+            'album': album_payloads.get(album_id),
+            'fetch_individually': album_id in large_album_ids
+            } for album_id in album_ids if album_id in etags],
+        'removed_album_ids': [album_id for album_id in album_ids if album_id not in etags]
+    }
+    return payload
+
+def is_large_album(album):
+    """
+    Whether the album has enough photos that its detail payload is streamed
+    (see `photos_api.streaming'), instead of being built in memory at once.
+
+    next_album_index is an upper bound of the number of photos
+    """
+    min_photos = settings.ALBUM_DETAIL_STREAMING_MIN_PHOTOS
+    return bool(min_photos) and album.next_album_index >= min_photos
+
+# When more photos than this changed, the full album payload is returned
+# instead of the changes (it is cheaper to build, since it is cached)
+MAX_CHANGED_PHOTOS = 500
+
+# The global glance score changes from this long before the client's revision
+# are sent again, since a change is recorded before its transaction commits
+# (sending a photo again is harmless)
+GLOBAL_GLANCE_SCORE_CHANGES_MARGIN = datetime.timedelta(minutes=1)
+
+def get_album_changes_payload(user, album, since_revision_number):
+    """
+    Returns the payload of the changes to the album after the revision
+    `since_revision_number', up to the album's current revision (see
+    `AlbumChange'). The photos and members that changed are included in full
+    (as in `get_album_detail_payload'), and the ids of the ones that are no
+    longer in the album (or that the user has hidden) are listed separately.
+
+    The photos whose `global_glance_score' changed because of a glance in
+    another album (see `GlobalGlanceScoreChange') are also included
+
+    If the changes are not known, then the full album payload is returned
+    instead, with "full_sync" set to true
+    """
+    if since_revision_number == album.revision_number:
+        changes = []
+    elif 0 <= since_revision_number < album.revision_number:
+        changes = AlbumChange.objects.get_changes(album, since_revision_number, album.revision_number)
     else:
-        am_last_access_offset = \
-            """
-            (am.last_access + INTERVAL '0.001 second')
-            """
+        changes = None
 
+    if changes is not None:
+        since_date = AlbumChange.objects.get_revision_date(album, since_revision_number)
+        changed_photo_ids = set(c.photo_id for c in changes if c.photo_id)
+        changed_photo_ids.update(GlobalGlanceScoreChange.objects.get_changed_photo_ids(album,
+            since_date - GLOBAL_GLANCE_SCORE_CHANGES_MARGIN))
+        changed_member_ids = set(c.user_id for c in changes if c.user_id is not None)
+        if len(changed_photo_ids) > MAX_CHANGED_PHOTOS:
+            changes = None
+
+    if changes is None:
+        payload = get_album_detail_payload(user, album)
+        payload['revision_number'] = album.revision_number
+        payload['full_sync'] = True
+        return payload
+
+    if changed_photo_ids:
+        photo_ids = list(changed_photo_ids)
+        photos = get_photos_payload(user.id,
+                """
+                p.album_id = %s AND
+                p.photo_id IN (""" + ', '.join(['%s'] * len(photo_ids)) + """)
+                """,
+                [album.id] + photo_ids,
+                """
+                ORDER BY album_index0
+                """).get(album.id, [])
+    else:
+        photos = []
+
+    if changed_member_ids:
+        members = [m for m in get_album_members_payload(album.id) if m['id'] in changed_member_ids]
+    else:
+        members = []
+
+    name, last_access, num_new_photos = get_album_member_fields(user, album)
+
+    payload = {
+        'id': album.id,
+        'name': name,
+        'date_created': album.date_created,
+        'last_updated': album.last_updated,
+        'last_access': last_access,
+        'num_new_photos': num_new_photos,
+        'revision_number': album.revision_number,
+        'full_sync': False,
+        'photos': photos,
+        'removed_photo_ids': sorted(changed_photo_ids - set(p['photo_id'] for p in photos)),
+        'members': members,
+        'removed_member_ids': sorted(changed_member_ids - set(m['id'] for m in members))
+    }
+    return payload
+
+
+def get_unnamed_albums_member_names(user_id, albums_sql, albums_params):
+    """
+    Returns a dict from the ids of the albums that `albums_sql' selects (see
+    `newest_photo_ids_sql') and that have no name, to the nicknames of their
+    members other than the user, ordered by user id
+    """
+    cursor = connection.cursor()
+    cursor.execute(
+        """
+        SELECT am.album_id,
+               phone_auth_user.nickname
+        FROM photos_album_members am
+        INNER JOIN photos_album
+            ON am.album_id = photos_album.id
+        INNER JOIN phone_auth_user
+            ON am.user_id = phone_auth_user.id
+        WHERE am.album_id IN (""" + albums_sql + """) AND
+              (photos_album.name = '' OR photos_album.name IS NULL) AND
+              am.user_id != %s
+        ORDER BY am.album_id, am.user_id
+        """,
+        albums_params + [user_id])
+
+    member_names = {}
+    for row_album_id, row_nickname in cursor.fetchall():
+        member_names.setdefault(row_album_id, []).append(row_nickname)
+    return member_names
+
+
+def get_album_list_payload(user_id):
     cursor = connection.cursor()
     cursor.execute(
         """
@@ -319,6 +1026,7 @@ def get_album_list_payload(user_id):
                album_revision_number0,
                album_last_access0,
                album_num_new_photos0,
+               album_num_hidden_photos0,
                album_creator_id0,
                album_creator_nickname0,
                album_creator_last_online0,
@@ -326,17 +1034,13 @@ def get_album_list_payload(user_id):
                album_creator_user_glance_score0
         FROM (SELECT am.album_id as album_id0,
                      am.last_access as album_last_access0,
-                     (CASE WHEN am.last_access IS NULL
-                           THEN (SELECT COUNT(*)
-                                 FROM photos_photo
-                                 WHERE photos_photo.album_id = am.album_id AND
-                                       photos_photo.author_id != %s)
-                           ELSE (SELECT COUNT(*)
-                                 FROM photos_photo
-                                 WHERE photos_photo.album_id = am.album_id AND
-                                       photos_photo.author_id != %s AND
-                                       photos_photo.date_created > """ + am_last_access_offset + """)
-                           END) as album_num_new_photos0
+                     am.num_new_photos as album_num_new_photos0,
+                     (SELECT COUNT(*)
+                      FROM photos_userhiddenphoto h
+                      INNER JOIN photos_photo hp
+                      ON h.photo_id = hp.photo_id
+                      WHERE h.user_id = am.user_id AND
+                            hp.album_id = am.album_id) as album_num_hidden_photos0
               FROM photos_album_members am
               WHERE am.user_id = %s) as T1,
              (SELECT a.id as album_id1,
@@ -354,7 +1058,26 @@ def get_album_list_payload(user_id):
               ON a.creator_id = phone_auth_user.id) as T2
         WHERE album_id0 = album_id1
         """,
-        [user_id, user_id, user_id])
+        [user_id])
+
+    user_albums_sql = \
+        """
+        SELECT album_id
+        FROM photos_album_members
+        WHERE user_id = %s
+        """
+
+    newest_sql, newest_params = newest_photo_ids_sql(user_id, 2, user_albums_sql, [user_id])
+    latest_photos = get_photos_payload(user_id,
+            """
+            p.photo_id IN (""" + newest_sql + """)
+            """,
+            newest_params,
+            """
+            ORDER BY album_id0, album_index0 DESC
+            """)
+
+    member_names = get_unnamed_albums_member_names(user_id, user_albums_sql, [user_id])
 
     albums = collections.OrderedDict()
     for row in cursor.fetchall():
@@ -365,6 +1088,7 @@ def get_album_list_payload(user_id):
         row_album_revision_number,
         row_album_last_access,
         row_album_num_new_photos,
+        row_album_num_hidden_photos,
         row_album_creator_id,
         row_album_creator_nickname,
         row_album_creator_last_online,
@@ -374,25 +1098,21 @@ def get_album_list_payload(user_id):
         albums[row_album_id] = {
             'id': row_album_id,
 
-            # TODO Could be optimized. Instead of a seperate query for each album, do
-            # one big query of all the members of all the albums:
-            'name': album_name_or_members(AlbumMember.objects.get(user__id=user_id, album__id=row_album_id)),
+            # See: photos_api.serializers.album_name_or_members
+            'name': row_album_name or u', '.join(member_names.get(row_album_id, [])),
 
             'creator': {
                 'id': row_album_creator_id,
                 'nickname': row_album_creator_nickname,
                 'last_online': row_album_creator_last_online,
-                'avatar_url': avatar_url_from_avatar_file_data(row_album_creator_avatar_file),
+                'avatar_url': get_avatar_url(row_album_creator_avatar_file),
                 'user_glance_score': row_album_creator_user_glance_score
             },
             'date_created': row_album_date_created,
             'last_updated': row_album_last_updated,
-            'etag': u'{0}'.format(row_album_revision_number), # See: photos.models.Album.get_etag
+            'etag': Album.format_etag(row_album_revision_number, row_album_last_access, row_album_num_hidden_photos),
 
-            # TODO: This is not optimized, we should do a single SQL query to
-            # get all photos of all albums, instead of a separate query per
-            # album:
-            'latest_photos': get_album_photos_payload(user_id, row_album_id, only_newest=2),
+            'latest_photos': latest_photos.get(row_album_id, []),
 
             'num_new_photos': row_album_num_new_photos,
             'last_access': row_album_last_access
@@ -0,0 +1,78 @@
+"""
+An in-process cache of API payloads, with least recently used eviction.
+
+The cached payloads are shared between requests (and threads), so they must
+never be modified after they have been put in the cache.
+"""
+
+import collections
+import threading
+
+
+class PayloadCache(object):
+    def __init__(self, max_bytes):
+        """
+        max_bytes: The total (approximate) size of the payloads that are kept.
+        When a new payload doesn't fit, the least recently used payloads are
+        evicted
+        """
+        self.max_bytes = max_bytes
+
+        self.lock = threading.Lock()
+        # Ordered from the least recently used to the most recently used. The
+        # values are tuples (payload, size)
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+
+    def get(self, key):
+        """
+        Returns the payload, or None if it is not in the cache
+        """
+        with self.lock:
+            try:
+                entry = self.entries.pop(key)
+            except KeyError:
+                self.num_misses += 1
+                return None
+            self.entries[key] = entry
+            self.num_hits += 1
+            return entry[0]
+
+    def put(self, key, payload, size):
+        with self.lock:
+            old_entry = self.entries.pop(key, None)
+            if old_entry is not None:
+                self.total_bytes -= old_entry[1]
+
+            if size > self.max_bytes:
+                return
+
+            while self.total_bytes + size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.num_evictions += 1
+
+            self.entries[key] = (payload, size)
+            self.total_bytes += size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def get_stats(self):
+        with self.lock:
+            num_lookups = self.num_hits + self.num_misses
+            return {
+                'num_entries': len(self.entries),
+                'total_bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'num_hits': self.num_hits,
+                'num_misses': self.num_misses,
+                'num_evictions': self.num_evictions,
+                'hit_rate': float(self.num_hits) / num_lookups if num_lookups else 0.0
+            }
@@ -23,3 +23,5 @@ class PhotoObjectSerializer(serializers.Serializer):
         ('ready', 'ready'),
         ('invalid', 'invalid'),
     ))
+    width = serializers.IntegerField(required=False)
+    height = serializers.IntegerField(required=False)
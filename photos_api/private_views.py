@@ -1,3 +1,4 @@
+from django.db import transaction
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 
@@ -144,7 +145,8 @@ def photo_object(request, storage_id):
     if status_ == 'processing':
         raise RuntimeError('"processing" status not yet implemented')
     elif status_ == 'ready':
-        photo_operations.add_photo(client_upload_id, storage_id, author, album, now)
+        photo_operations.add_photo(client_upload_id, storage_id, author, album, now,
+                serializer.object.get('width'), serializer.object.get('height'))
     elif status_ == 'invalid':
         raise RuntimeError('"invalid" status not yet implemented')
     else:
@@ -153,6 +155,8 @@ def photo_object(request, storage_id):
     return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+# register_photo_server manages its own transactions
+@transaction.non_atomic_requests
 @api_view(['POST'])
 @permission_classes((IsAllowedPrivateAPI, ))
 def photo_server_register(request):
@@ -328,6 +328,15 @@ class QueryPhonesRequestSerializer(serializers.Serializer):
         attrs['default_country'] = attrs['default_country'].upper()
         return attrs
 
+class AlbumDetailsRequestItemSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    etag = serializers.CharField(required=False)
+
+
+class AlbumDetailsRequestSerializer(serializers.Serializer):
+    albums = AlbumDetailsRequestItemSerializer(many=True)
+
+
 class PhotoUploadInitSerializer(serializers.Serializer):
     user_auth_token = serializers.CharField()
 
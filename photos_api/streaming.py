@@ -0,0 +1,68 @@
+"""
+Streams the JSON of album detail payloads, for albums that are too large to
+build the whole payload (and its JSON) in memory.
+
+The photos are read a page at a time, in album_index order (see
+`optimized_views.get_album_photos_page_payload'), and each page is encoded and
+sent before the next one is read. The output is exactly the same as the JSON
+that `JSONRenderer' makes from `optimized_views.get_album_detail_payload'.
+"""
+
+import json
+import uuid
+
+from rest_framework.renderers import JSONRenderer
+
+from photos_api import optimized_views
+
+# The number of photos that are read (and kept in memory) at a time
+STREAMING_PAGE_SIZE = optimized_views.MAX_PAGE_SIZE
+
+def encode_json(obj):
+    return json.dumps(obj, cls=JSONRenderer.encoder_class, ensure_ascii=JSONRenderer.ensure_ascii)
+
+def iter_photos_json(overlay, album_id):
+    """
+    Yields the JSON of the photos of the album, separated by ", "
+    """
+    cursor = None
+    first = True
+    while True:
+        # The shared payloads are read and then overlaid for the user, exactly
+        # like in `optimized_views.get_album_detail_payload', so that the
+        # photos are encoded the same way (down to the order of the keys)
+        shared_photos, cursor = optimized_views.get_album_photos_page_payload(None, album_id, STREAMING_PAGE_SIZE, cursor,
+                include_users=False)
+        overlay.users = optimized_views.get_users_payloads(optimized_views.get_photos_user_ids(shared_photos))
+        photos = overlay.apply(shared_photos)
+        if photos:
+            chunk = ', '.join(encode_json(photo) for photo in photos)
+            yield chunk if first else ', ' + chunk
+            first = False
+        if cursor is None:
+            return
+
+def iter_album_detail_json(user, album):
+    """
+    Returns an iterator over the chunks of the JSON of the album detail
+    payload.
+
+    Everything except for the photos is read right away (in the current
+    transaction). The photos are read while iterating, in their own queries
+    """
+    payload = optimized_views.get_album_header_payload(user, album)
+    overlay = optimized_views.UserPhotosOverlay(user, album)
+
+    # The photos are streamed in place of this string, so that the rest of
+    # the payload is encoded exactly like the whole payload would be
+    placeholder = uuid.uuid4().hex
+    payload['photos'] = placeholder
+    head, tail = encode_json(payload).split('"' + placeholder + '"')
+
+    def chunks():
+        yield head + '['
+        for chunk in iter_photos_json(overlay, album.id):
+            yield chunk
+        yield ']' + tail
+
+    return chunks()
@@ -1,3 +1,4 @@
+import collections
 import datetime
 import filecmp
 import httplib
@@ -8,27 +9,40 @@ from boto.s3.key import Key
 from django.core.urlresolvers import reverse
 import os
 import shutil
+import StringIO
+import time
 import unittest
 
 from django.conf import settings
 from django.conf.urls import patterns, include, url
 from django.contrib import auth
 from django.test import TestCase, Client
-from django.test.utils import override_settings
+from django.db import connection
+from django.test.utils import override_settings, CaptureQueriesContext
 from django.utils import timezone
+from django.utils.http import http_date
 
 from phone_auth.models import AuthToken
 from phone_auth.models import PhoneNumber, PhoneContact, AnonymousPhoneNumber, PhoneNumberLinkCode
+from phone_auth.signals import user_avatar_changed
 from phone_auth.sms_send import send_sms, mark_sms_test_case
-from photos.models import Photo, PendingPhoto, Album, AlbumMember, PhotoGlance, PhotoComment, PhotoUserTag, Video
+from photos.models import Photo, PendingPhoto, Album, AlbumChange, AlbumMember, GlobalGlanceScoreChange, PhotoGlance, PhotoComment, PhotoUserTag, Video, PhotoProcessingJob, UserHiddenPhoto
+from photos import image_uploads
+from photos import public_feed
 from photos_api import is_phone_number_mobile
+from photos_api import check_modified
+from photos_api import optimized_views
+from photos_api.payload_cache import PayloadCache
+from photos_api import streaming
 from invites_manager.models import SMSInviteMessage
 import invites_manager
 import frontend.urls
 import photos_api.urls
 
-from photos_api.serializers import AlbumUpdateSerializer, MemberIdentifier, MemberIdentifierSerializer, AlbumAddSerializer
+from photos_api.serializers import AlbumUpdateSerializer, MemberIdentifier, MemberIdentifierSerializer, AlbumAddSerializer, album_name_or_members
 import requests
+from mock import patch
+from rest_framework.renderers import JSONRenderer
 
 try:
     from django.contrib.auth import get_user_model
@@ -626,6 +640,86 @@ class PhotoUpload(BaseTestCase):
         all_album_photos = [x['photo_id'] for x in album_json['photos']]
         self.assertIn(photo_id, all_album_photos)
 
+        photo_json = [x for x in album_json['photos'] if x['photo_id'] == photo_id][0]
+        self.assertEqual((photo_json['width'], photo_json['height']), (1024, 768))
+        self.assertEqual(photo_json['image_dimensions']['r_qvga'], [320, 240])
+        self.assertEqual(photo_json['image_dimensions']['crop140'], [140, 140])
+
+    @override_settings(PHOTO_PROCESSING_ASYNC=True)
+    def test_async_processing(self):
+        upload_request_json = json.loads(self.client.post('/photos/upload_request/?num_photos=2').content)
+
+        for r in upload_request_json:
+            with open('photos/test_photos/death-valley-sand-dunes.jpg', 'rb') as f:
+                upload_response = self.client.post(r['upload_url'], { 'photo': f })
+            self.assertEqual(upload_response.status_code, 200)
+
+        first_photo_id = upload_request_json[0]['photo_id']
+        status_json = json.loads(self.client.get(upload_request_json[0]['upload_url']).content)
+        self.assertEqual(status_json, { 'photo_id': first_photo_id, 'uploaded': True, 'processing_done': False, 'processing_failed': False })
+        self.assertEqual(PhotoProcessingJob.objects.get_queue_length(), 2)
+
+        # A worker processes the first photo
+        job = PhotoProcessingJob.objects.claim(timezone.now(), [PendingPhoto.objects.get(pk=first_photo_id).storage_id])
+        image_uploads.run_processing_job(job)
+        status_json = json.loads(self.client.get(upload_request_json[0]['upload_url']).content)
+        self.assertTrue(status_json['processing_done'])
+
+        # Adding to an album waits for a worker to run the job that is still
+        # queued (which happens while the request is waiting)
+        def worker_runs_jobs(generation, timeout):
+            self.assertEqual(PhotoProcessingJob.objects.get_queue_length(), 1)
+            image_uploads.process_queued_jobs()
+
+        photo_list = { 'add_photos': [ { 'photo_id': r['photo_id'] } for r in upload_request_json ] }
+        with patch.object(image_uploads._jobs_finished, 'wait', side_effect=worker_runs_jobs) as wait:
+            add_response = self.client.post('/albums/8/', content_type='application/json', data=json.dumps(photo_list))
+        self.assertEqual(add_response.status_code, 200)
+        self.assertEqual(wait.call_count, 1)
+        self.assertEqual(PhotoProcessingJob.objects.get_queue_length(), 0)
+
+        for r in upload_request_json:
+            self.assertTrue(image_uploads.photo_is_processed(Photo.objects.get(pk=r['photo_id']).storage_id))
+
+    @override_settings(PHOTO_PROCESSING_ASYNC=True)
+    @override_settings(PHOTO_PROCESSING_JOB_MAX_ATTEMPTS=2)
+    def test_async_processing_failure(self):
+        upload_request_json = json.loads(self.client.post('/photos/upload_request/?num_photos=2').content)
+
+        for r, content in zip(upload_request_json, ['Not a photo', None]):
+            if content is None:
+                with open('photos/test_photos/death-valley-sand-dunes.jpg', 'rb') as f:
+                    upload_response = self.client.post(r['upload_url'], { 'photo': f })
+            else:
+                f = StringIO.StringIO(content)
+                f.name = 'invalid.jpg'
+                upload_response = self.client.post(r['upload_url'], { 'photo': f })
+            self.assertEqual(upload_response.status_code, 200)
+
+        # The invalid photo doesn't stop the other job, and is retried until
+        # it has failed too many times
+        num_ran, errors = image_uploads.process_queued_jobs()
+        self.assertEqual(num_ran, 1)
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(PhotoProcessingJob.objects.get_queue_length(), 0)
+        self.assertEqual(PhotoProcessingJob.objects.get_num_failed(), 1)
+
+        status_json = json.loads(self.client.get(upload_request_json[0]['upload_url']).content)
+        self.assertFalse(status_json['processing_done'])
+        self.assertTrue(status_json['processing_failed'])
+
+        photo_list = { 'add_photos': [ { 'photo_id': r['photo_id'] } for r in upload_request_json ] }
+        add_response = self.client.post('/albums/8/', content_type='application/json', data=json.dumps(photo_list))
+        self.assertEqual(add_response.status_code, 400)
+
+        # A job whose worker died is not claimed again after too many attempts
+        PhotoProcessingJob.objects.all().delete()
+        PhotoProcessingJob.objects.enqueue('crashing', timezone.now())
+        PhotoProcessingJob.objects.filter(storage_id='crashing').update(
+                date_started=timezone.now() - datetime.timedelta(days=1), num_attempts=2)
+        self.assertIsNone(PhotoProcessingJob.objects.claim(timezone.now()))
+        self.assertEqual(PhotoProcessingJob.objects.get_num_failed(), 1)
+
     def test_copy_to_album(self):
         upload_request_response = self.client.post('/photos/upload_request/')
         self.assertEqual(upload_request_response.status_code, 200)
@@ -742,6 +836,25 @@ class PublicAlbumTest(BaseTestCase):
         album_response_json = json.loads(album_response.content)
         self.assertEqual(album_response_json['name'], 'Public Feed')
 
+    def test_set_public_feed(self):
+        amanda = User.objects.get(pk=2)
+        public_album = Album.objects.get(pk=settings.PUBLIC_ALBUM_ID)
+        membership = AlbumMember.objects.create(
+                user = amanda,
+                album = public_album,
+                datetime_added = timezone.now(),
+                added_by_user = amanda,
+                album_admin = False)
+        membership.update_last_access(timezone.now())
+        revision_number = public_album.revision_number
+
+        new_photos = list(Album.objects.get(pk=7).get_photos())
+        public_feed.set_public_feed(new_photos, timezone.now())
+
+        public_album = Album.objects.get(pk=settings.PUBLIC_ALBUM_ID)
+        self.assertGreater(public_album.revision_number, revision_number)
+        self.assertEqual(AlbumMember.objects.get(pk=membership.pk).num_new_photos, len(new_photos))
+
 
 class PhotoVideoTest(TestCase):
     urls = 'photos_api.urls'
@@ -792,6 +905,8 @@ class PhotoVideoTest(TestCase):
 
         self.assertEqual(photo1_json['photo_id'], 'test-video-id-1')
         self.assertEqual(photo1_json['media_type'], 'video')
+        self.assertEqual(photo1_json['width'], None)
+        self.assertNotIn('image_dimensions', photo1_json)
         self.assertEqual(photo1_json['video_status'], 'ready')
         self.assertEqual(photo1_json['video_duration'], 10)
         self.assertEqual(photo1_json['video_url'], Video.get_video_url('test-storage-id-2'))
@@ -1132,6 +1247,646 @@ class PhotoGlanceTest(TestCase):
         self.assertEqual(j['photos'][0]['glances'][1]['author']['id'], blake.id)
 
 
+class AlbumListPayloadTest(BaseTestCase):
+    def setUp(self):
+        self.amanda = User.objects.get(pk=2)
+        self.barney = User.objects.get(pk=3)
+
+        the_date = datetime.datetime(2010, 1, 1, tzinfo=timezone.utc)
+        self.unnamed_album = Album.objects.create_album(self.amanda, '', the_date)
+        with self.unnamed_album.modify(the_date) as m:
+            m.add_user_id(self.amanda, self.barney.id)
+
+        album = Album.objects.get(pk=9)
+        hidden_photo = album.photo_set.order_by('-album_index')[0]
+        UserHiddenPhoto.objects.create(user=self.amanda, photo=hidden_photo)
+
+    def check_album_list_payload(self):
+        with CaptureQueriesContext(connection) as queries:
+            payload = optimized_views.get_album_list_payload(self.amanda.id)
+        # Does not depend on the number of albums
+        self.assertLessEqual(len(queries), 5)
+
+        self.assertEqual(len(payload), AlbumMember.objects.filter(user=self.amanda).count())
+        for album_payload in payload:
+            member = AlbumMember.objects.get(user=self.amanda, album__id=album_payload['id'])
+            self.assertEqual(album_payload['name'], album_name_or_members(member))
+
+            expected_photos = optimized_views.get_album_photos_payload(self.amanda.id, album_payload['id'])
+            expected_photos.reverse()
+            self.assertEqual(album_payload['latest_photos'], expected_photos[:2])
+
+        unnamed_payload = [a for a in payload if a['id'] == self.unnamed_album.id][0]
+        self.assertEqual(unnamed_payload['name'], self.barney.nickname)
+
+    def test_album_list_payload(self):
+        self.check_album_list_payload()
+
+    def test_album_list_payload_without_window_functions(self):
+        with patch('photos_api.optimized_views.supports_window_functions', return_value=False):
+            self.check_album_list_payload()
+
+
+class AlbumPayloadCacheTest(BaseTestCase):
+    def setUp(self):
+        self.album = Album.objects.get(pk=7)
+        self.users = [m.user for m in AlbumMember.objects.filter(album=self.album).order_by('user__id')]
+
+        photos = list(self.album.get_photos())
+        UserHiddenPhoto.objects.create(user=self.users[0], photo=photos[0])
+        with self.album.modify(timezone.now()) as m:
+            m.set_photo_user_glance_score_delta(self.users[1], photos[1], 1)
+
+    def check_album_detail_payloads(self, cache):
+        album = Album.objects.get(pk=self.album.id)
+        expected_payloads = [optimized_views.get_album_detail_payload(u, album) for u in self.users]
+        with patch('photos_api.optimized_views.album_payload_cache', cache):
+            payloads = [optimized_views.get_album_detail_payload(u, album) for u in self.users]
+        self.assertEqual(payloads, expected_payloads)
+
+    def test_album_detail_payload_cache(self):
+        cache = PayloadCache(10 * 1024 * 1024)
+
+        self.check_album_detail_payloads(cache)
+        self.assertEqual(cache.get_stats()['num_misses'], 1)
+        self.assertEqual(cache.get_stats()['num_hits'], len(self.users) - 1)
+
+        photo = self.album.get_photos()[2]
+        with self.album.modify(timezone.now()) as m:
+            m.comment_on_photo(photo, self.users[0], 1, 'New comment')
+
+        self.check_album_detail_payloads(cache)
+        self.assertEqual(cache.get_stats()['num_misses'], 2)
+        self.assertEqual(cache.get_stats()['num_hits'], 2 * (len(self.users) - 1))
+
+    def test_user_fields_are_not_cached(self):
+        cache = PayloadCache(10 * 1024 * 1024)
+        self.check_album_detail_payloads(cache)
+
+        # These change without a revision of the album
+        author = self.album.get_photos()[0].author
+        User.objects.filter(pk=author.id).update(nickname='Renamed', user_glance_score=1000)
+
+        self.check_album_detail_payloads(cache)
+        self.assertEqual(cache.get_stats()['num_misses'], 1)
+        # (The first user has hidden the photo)
+        payload = optimized_views.get_album_detail_payload(self.users[1], Album.objects.get(pk=self.album.id))
+        author_payloads = [p['author'] for p in payload['photos'] if p['author']['id'] == author.id]
+        author_payloads += [m for m in payload['members'] if m['id'] == author.id]
+        self.assertTrue(author_payloads)
+        for author_payload in author_payloads:
+            self.assertEqual(author_payload['nickname'], 'Renamed')
+            self.assertEqual(author_payload['user_glance_score'], 1000)
+
+    def test_rolled_back_revision(self):
+        cache = PayloadCache(10 * 1024 * 1024)
+        album = Album.objects.get(pk=self.album.id)
+        with patch('photos_api.optimized_views.album_payload_cache', cache):
+            optimized_views.get_album_detail_payload(self.users[0], album)
+
+            # A revision with the same number as the one that was cached, and
+            # different contents
+            album.last_revision_date = timezone.now()
+            album.name = 'Another name'
+            self.assertEqual(optimized_views.get_album_shared_payload(album)['name'], 'Another name')
+
+    def test_payload_cache_eviction(self):
+        cache = PayloadCache(100)
+        cache.put(1, 'a', 40)
+        cache.put(2, 'b', 40)
+        self.assertEqual(cache.get(1), 'a')
+        cache.put(3, 'c', 40)
+        self.assertEqual(cache.get(2), None)
+        self.assertEqual(cache.get(1), 'a')
+        self.assertEqual(cache.get(3), 'c')
+        cache.put(4, 'd', 1000)
+        self.assertEqual(cache.get(4), None)
+        self.assertEqual(cache.get_stats()['num_evictions'], 1)
+        self.assertEqual(cache.get_stats()['total_bytes'], 80)
+
+
+class AlbumPhotosPageTest(BaseTestCase):
+    def setUp(self):
+        self.album = Album.objects.get(pk=7)
+        self.user = AlbumMember.objects.filter(album=self.album).order_by('user__id')[0].user
+        UserHiddenPhoto.objects.create(user=self.user, photo=self.album.get_photos()[1])
+
+    def test_album_photos_pages(self):
+        all_photos = optimized_views.get_album_photos_payload(self.user.id, self.album.id)
+        self.assertEqual(len(all_photos), 3)
+
+        for page_size in (1, 2, 3, 4):
+            photos = []
+            cursor = None
+            while True:
+                page, cursor = optimized_views.get_album_photos_page_payload(self.user.id, self.album.id, page_size, cursor)
+                self.assertLessEqual(len(page), page_size)
+                photos.extend(page)
+                if cursor is None:
+                    break
+            self.assertEqual(photos, all_photos)
+
+    def test_album_page_api(self):
+        self.client.login(username='2', password='amanda')
+
+        response = self.client.get('/albums/9/', {'page_size': 1})
+        self.assertEqual(response.status_code, 200)
+        payload = json.loads(response.content)
+        self.assertEqual(len(payload['photos']), 1)
+        self.assertIsNone(payload['next_cursor'])
+
+        response = self.client.get('/albums/9/', {'page_size': 1, 'cursor': 'invalid'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/albums/9/', {'page_size': 0})
+        self.assertEqual(response.status_code, 400)
+
+
+class AlbumStreamingTest(BaseTestCase):
+    def setUp(self):
+        self.album = Album.objects.get(pk=7)
+        self.barney = User.objects.get(pk=3)
+
+        photos = list(self.album.get_photos())
+        UserHiddenPhoto.objects.create(user=self.barney, photo=photos[1])
+        with self.album.modify(timezone.now()) as m:
+            m.set_photo_user_glance_score_delta(self.barney, photos[0], 1)
+            m.comment_on_photo(photos[2], self.barney, 1, u'Caf\xe9 \u263a')
+
+    def get_expected_json(self):
+        album = Album.objects.get(pk=self.album.id)
+        return JSONRenderer().render(optimized_views.get_album_detail_payload(self.barney, album))
+
+    def test_streamed_json(self):
+        expected_json = self.get_expected_json()
+        for page_size in (1, 2, 500):
+            with patch('photos_api.streaming.STREAMING_PAGE_SIZE', page_size):
+                album = Album.objects.get(pk=self.album.id)
+                streamed_json = ''.join(streaming.iter_album_detail_json(self.barney, album))
+            self.assertEqual(streamed_json, expected_json)
+
+    def test_album_detail_streaming_api(self):
+        # The fixtures don't allocate album indexes
+        Album.objects.filter(pk=self.album.id).update(next_album_index=4)
+
+        self.client.login(username='3', password='barney')
+        with self.settings(ALBUM_DETAIL_STREAMING_MIN_PHOTOS=4):
+            response = self.client.get('/albums/7/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertIn('ETag', response)
+        self.assertEqual(''.join(response.streaming_content), self.get_expected_json())
+
+        with self.settings(ALBUM_DETAIL_STREAMING_MIN_PHOTOS=5):
+            response = self.client.get('/albums/7/')
+        self.assertFalse(response.streaming)
+        self.assertEqual(response.content, self.get_expected_json())
+
+
+class ConditionalGetTest(BaseTestCase):
+    def setUp(self):
+        self.client.login(username='2', password='amanda')
+        self.amanda = User.objects.get(pk=2)
+
+    def get_album_list_etag(self, album_id):
+        response = self.client.get('/albums/')
+        return [a['etag'] for a in json.loads(response.content) if a['id'] == album_id][0]
+
+    def test_album_etag(self):
+        response = self.client.get('/albums/9/')
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(etag, '"{0}"'.format(self.get_album_list_etag(9)))
+
+        num_not_modified = check_modified.get_response_counts()['AlbumDetail']['num_not_modified']
+        with patch('photos_api.optimized_views.get_album_detail_payload') as get_payload:
+            response = self.client.get('/albums/9/', HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertFalse(get_payload.called)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(check_modified.get_response_counts()['AlbumDetail']['num_not_modified'], num_not_modified + 1)
+
+        # The payload of the user changes when a photo is hidden, or the album
+        # is viewed, even though the album itself didn't change
+        UserHiddenPhoto.objects.create(user=self.amanda, photo=Album.objects.get(pk=9).get_photos()[0])
+        response = self.client.get('/albums/9/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        etag = response['ETag']
+        self.assertEqual(etag, '"{0}"'.format(self.get_album_list_etag(9)))
+
+        AlbumMember.objects.get(user=self.amanda, album__id=9).update_last_access(timezone.now())
+        response = self.client.get('/albums/9/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response['ETag'], '"{0}"'.format(self.get_album_list_etag(9)))
+
+    def test_album_etag_user_changes(self):
+        # An album without a name is named after its members
+        album = Album.objects.create_album(self.amanda, '')
+        with album.modify(timezone.now()) as m:
+            m.add_user_id(self.amanda, 11)
+        url = '/albums/{0}/'.format(album.id)
+
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.assertEqual(json.loads(response.content)['name'], 'jackie')
+
+        jackie_client = Client()
+        jackie_client.login(username='11', password='jackie')
+        response = jackie_client.patch('/users/11/', content_type='application/json', data=json.dumps({'nickname': 'jacqueline'}))
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['name'], 'jacqueline')
+        etag = response['ETag']
+
+        user_avatar_changed.send(sender=self, user=User.objects.get(pk=11))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_album_etag_former_member_changes(self):
+        # Barney commented on a photo and left the album
+        barney = User.objects.get(pk=3)
+        album = Album.objects.get(pk=9)
+        photo = album.get_photos()[0]
+        with album.modify(timezone.now()) as m:
+            m.add_user_id(self.amanda, barney.id)
+            m.comment_on_photo(photo, barney, 1, 'Nice')
+        AlbumMember.objects.filter(album=album, user=barney).delete()
+        url = '/albums/9/'
+
+        response = self.client.get(url)
+        etag = response['ETag']
+        revision = json.loads(response.content)['revision_number']
+
+        barney_client = Client()
+        barney_client.login(username='3', password='barney')
+        response = barney_client.patch('/users/3/', content_type='application/json', data=json.dumps({'nickname': 'barnabas'}))
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        comment = [p for p in json.loads(response.content)['photos'] if p['photo_id'] == photo.photo_id][0]['comments'][-1]
+        self.assertEqual(comment['author']['nickname'], 'barnabas')
+
+        changes = json.loads(self.client.get('/albums/9/changes/', {'since_revision': revision}).content)
+        self.assertFalse(changes['full_sync'])
+        self.assertEqual([p['photo_id'] for p in changes['photos']], [photo.photo_id])
+        self.assertEqual(changes['photos'][0]['comments'][-1]['author']['nickname'], 'barnabas')
+
+    def test_album_list_last_modified(self):
+        # Users whose album list has not changed since this was recorded
+        response = self.client.get('/albums/', HTTP_IF_MODIFIED_SINCE='Sat, 01 Jan 2050 00:00:00 GMT')
+        self.assertEqual(response.status_code, 200)
+
+        User.objects.filter(pk=self.amanda.id).update(album_list_last_changed=datetime.datetime(2010, 1, 1, tzinfo=timezone.utc))
+        response = self.client.get('/albums/', HTTP_IF_MODIFIED_SINCE='Sat, 01 Jan 2050 00:00:00 GMT')
+        self.assertEqual(response.status_code, 304)
+
+        # Amanda is added to an album that was last updated a long time ago
+        before = http_date(time.time() - 60)
+        barney = User.objects.get(pk=3)
+        album = Album.objects.create_album(barney, 'Old Album', datetime.datetime(2000, 1, 1, tzinfo=timezone.utc))
+        with album.modify(datetime.datetime(2000, 1, 1, tzinfo=timezone.utc)) as m:
+            m.add_user_id(barney, self.amanda.id)
+        response = self.client.get('/albums/', HTTP_IF_MODIFIED_SINCE=before)
+        self.assertEqual(response.status_code, 200)
+
+    def test_album_list_last_changed(self):
+        before = http_date(time.time() - 60)
+        long_ago = datetime.datetime(2010, 1, 1, tzinfo=timezone.utc)
+
+        def reset_album_list():
+            User.objects.filter(pk=self.amanda.id).update(album_list_last_changed=long_ago)
+            response = self.client.get('/albums/', HTTP_IF_MODIFIED_SINCE=before)
+            self.assertEqual(response.status_code, 304)
+
+        def assert_album_list_changed():
+            response = self.client.get('/albums/', HTTP_IF_MODIFIED_SINCE=before)
+            self.assertEqual(response.status_code, 200)
+            reset_album_list()
+
+        reset_album_list()
+
+        # Photo updates don't write to the rows of all of the members
+        album = Album.objects.get(pk=9)
+        with album.modify(timezone.now()) as m:
+            m.comment_on_photo(album.get_photos()[0], User.objects.get(pk=11), 1, 'Hi')
+        self.assertEqual(User.objects.get(pk=self.amanda.id).album_list_last_changed, long_ago)
+
+        # Other revisions change the album lists of all of the members
+        with album.modify(timezone.now()) as m:
+            album.name = 'New Name'
+            album.save(update_fields=['name'])
+        assert_album_list_changed()
+
+        AlbumMember.objects.get(user=self.amanda, album=album).update_last_access(timezone.now())
+        assert_album_list_changed()
+
+        UserHiddenPhoto.objects.create(user=self.amanda, photo=album.get_photos()[0])
+        assert_album_list_changed()
+
+        self.client.post('/albums/9/leave/')
+        assert_album_list_changed()
+
+
+class AlbumChangesTest(BaseTestCase):
+    def setUp(self):
+        self.client.login(username='2', password='amanda')
+        self.amanda = User.objects.get(pk=2)
+        self.barney = User.objects.get(pk=3)
+        self.album = Album.objects.get(pk=9)
+        self.photo = Photo.objects.get(pk='43c74de2-042d-4c83-af54-27b3233cc80b')
+
+    def get_revision(self):
+        response = self.client.get('/albums/9/')
+        return json.loads(response.content)['revision_number']
+
+    def get_changes(self, since_revision):
+        response = self.client.get('/albums/9/changes/', {'since_revision': since_revision})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_no_changes(self):
+        revision = self.get_revision()
+        changes = self.get_changes(revision)
+        self.assertEqual(changes['revision_number'], revision)
+        self.assertFalse(changes['full_sync'])
+        self.assertEqual(changes['photos'], [])
+        self.assertEqual(changes['removed_photo_ids'], [])
+        self.assertEqual(changes['members'], [])
+        self.assertEqual(changes['removed_member_ids'], [])
+
+    def test_album_changes(self):
+        revision = self.get_revision()
+
+        with self.album.modify(timezone.now()) as m:
+            m.comment_on_photo(self.photo, self.amanda, 1, 'Nice')
+        with self.album.modify(timezone.now()) as m:
+            m.add_user_id(self.amanda, self.barney.id)
+
+        changes = self.get_changes(revision)
+        self.assertFalse(changes['full_sync'])
+        self.assertEqual(changes['revision_number'], revision + 2)
+        self.assertEqual(len(changes['photos']), 1)
+        self.assertEqual(changes['photos'][0]['photo_id'], self.photo.photo_id)
+        self.assertEqual(changes['photos'][0]['comments'][0]['comment'], 'Nice')
+        self.assertEqual([m['id'] for m in changes['members']], [self.barney.id])
+
+        revision = changes['revision_number']
+
+        barney_client = Client()
+        barney_client.login(username=3, password='barney')
+        barney_client.post('/albums/9/leave/')
+        self.photo.delete()
+        self.album.save_revision(timezone.now(), changes=[AlbumChange(
+            change_type = AlbumChange.CHANGE_PHOTO_REMOVED,
+            photo_id = '43c74de2-042d-4c83-af54-27b3233cc80b')])
+
+        changes = self.get_changes(revision)
+        self.assertFalse(changes['full_sync'])
+        self.assertEqual(changes['photos'], [])
+        self.assertEqual(changes['removed_photo_ids'], ['43c74de2-042d-4c83-af54-27b3233cc80b'])
+        self.assertEqual(changes['members'], [])
+        self.assertEqual(changes['removed_member_ids'], [self.barney.id])
+
+    def test_copy_glance_score_changes(self):
+        other_album = Album.objects.create_album(self.amanda, 'Copies')
+        photo_copy = self.photo.create_copy(self.amanda, other_album, 0, timezone.now())
+        # So that the time of the revision is known
+        self.album.save_revision(timezone.now(), changes=[])
+        global_glance_score = self.photo.get_global_glance_score()
+        revision = self.get_revision()
+
+        # The original shows the global_glance_score of all of its copies,
+        # without a new revision of its album
+        with other_album.modify(timezone.now()) as m:
+            m.set_photo_user_glance_score_delta(self.barney, photo_copy, 1)
+        self.assertEqual(self.get_revision(), revision)
+
+        changes = self.get_changes(revision)
+        self.assertFalse(changes['full_sync'])
+        self.assertEqual(changes['revision_number'], revision)
+        self.assertEqual([p['photo_id'] for p in changes['photos']], [self.photo.photo_id])
+        self.assertEqual(changes['photos'][0]['global_glance_score'], global_glance_score + 1)
+
+        photo_copy.delete()
+        self.assertEqual(self.get_revision(), revision)
+
+        changes = self.get_changes(revision)
+        self.assertFalse(changes['full_sync'])
+        self.assertEqual(changes['photos'][0]['global_glance_score'], global_glance_score)
+
+        # Changes from long before the revision are not sent again
+        GlobalGlanceScoreChange.objects.update(last_changed=timezone.now() - datetime.timedelta(days=1))
+        self.assertEqual(self.get_changes(revision)['photos'], [])
+
+    def test_unknown_changes(self):
+        revision = self.get_revision()
+        self.album.save_revision(timezone.now())
+
+        changes = self.get_changes(revision)
+        self.assertTrue(changes['full_sync'])
+        self.assertEqual(changes['revision_number'], revision + 1)
+        self.assertEqual(len(changes['photos']), 1)
+        self.assertEqual(len(changes['members']), AlbumMember.objects.filter(album=self.album).count())
+
+        # The journal doesn't go back this far
+        self.assertTrue(self.get_changes(0)['full_sync'])
+        self.assertTrue(self.get_changes(revision + 10)['full_sync'])
+
+    def test_invalid_since_revision(self):
+        response = self.client.get('/albums/9/changes/', {'since_revision': 'abc'})
+        self.assertEqual(response.status_code, 400)
+
+
+class AlbumDetailsTest(BaseTestCase):
+    def setUp(self):
+        self.client.login(username='2', password='amanda')
+        self.amanda = User.objects.get(pk=2)
+        self.barney = User.objects.get(pk=3)
+
+        # An album without a name, with more than one photo and a hidden
+        # photo
+        the_date = datetime.datetime(2010, 1, 1, tzinfo=timezone.utc)
+        self.unnamed_album = Album.objects.create_album(self.amanda, '', the_date)
+        with self.unnamed_album.modify(the_date) as m:
+            m.add_user_id(self.amanda, self.barney.id)
+        for i in range(4):
+            Photo.objects.create(
+                    photo_id = 'test-photo-id-{0}'.format(i),
+                    media_type = Photo.MEDIA_TYPE_PHOTO,
+                    client_upload_id = '',
+                    storage_id = 'test-storage-id-{0}'.format(i),
+                    subdomain = 'test-subdomain',
+                    date_created = the_date,
+                    author = self.amanda,
+                    album = self.unnamed_album,
+                    album_index = i)
+        UserHiddenPhoto.objects.create(user=self.amanda, photo=self.unnamed_album.get_photos()[0])
+
+        self.album_ids = list(AlbumMember.objects.filter(user=self.amanda)
+                .order_by('album__id')
+                .values_list('album__id', flat=True))
+
+    def get_details(self, albums):
+        response = self.client.post('/albums/details/', json.dumps({'albums': albums}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def get_album(self, album_id):
+        response = self.client.get('/albums/{0}/'.format(album_id))
+        self.assertEqual(response.status_code, 200)
+        return (json.loads(response['ETag']), json.loads(response.content))
+
+    def test_album_details(self):
+        # Amanda is not a member of album 7
+        details = self.get_details([{'id': album_id} for album_id in self.album_ids] + [{'id': 7}, {'id': 1000}])
+        self.assertEqual(details['removed_album_ids'], [7, 1000])
+        self.assertEqual([a['id'] for a in details['albums']], self.album_ids)
+        for album_details in details['albums']:
+            etag, album = self.get_album(album_details['id'])
+            self.assertEqual(album_details['etag'], etag)
+            self.assertEqual(album_details['album'], album)
+            self.assertFalse(album_details['fetch_individually'])
+
+        unnamed_details = [a for a in details['albums'] if a['id'] == self.unnamed_album.id][0]
+        self.assertEqual(unnamed_details['album']['name'], self.barney.nickname)
+        self.assertEqual(len(unnamed_details['album']['photos']), 3)
+
+    def test_unchanged_albums(self):
+        albums = [{'id': a['id'], 'etag': a['etag']} for a in self.get_details([{'id': album_id} for album_id in self.album_ids])['albums']]
+        details = self.get_details(albums)
+        self.assertEqual(details['albums'], [dict(a, album=None, fetch_individually=False) for a in albums])
+
+        album = Album.objects.get(pk=9)
+        with album.modify(timezone.now()) as m:
+            m.comment_on_photo(album.get_photos()[0], self.amanda, 1, 'Nice')
+
+        details = self.get_details(albums)
+        changed_albums = [a for a in details['albums'] if a['album'] is not None]
+        self.assertEqual([a['id'] for a in changed_albums], [9])
+        self.assertEqual(changed_albums[0]['album']['photos'][0]['comments'][-1]['comment'], 'Nice')
+
+    def test_large_albums(self):
+        Album.objects.filter(pk=self.unnamed_album.id).update(next_album_index=4)
+        etag, album = self.get_album(self.unnamed_album.id)
+
+        with self.settings(ALBUM_DETAIL_STREAMING_MIN_PHOTOS=4):
+            details = self.get_details([{'id': self.unnamed_album.id}, {'id': 9}])
+            self.assertEqual(details['albums'][0], {
+                'id': self.unnamed_album.id,
+                'etag': etag,
+                'album': None,
+                'fetch_individually': True
+                })
+            self.assertFalse(details['albums'][1]['fetch_individually'])
+            self.assertEqual(details['albums'][1]['album']['id'], 9)
+
+            # Unchanged large albums are not fetched again
+            details = self.get_details([{'id': self.unnamed_album.id, 'etag': etag}])
+            self.assertEqual(details['albums'][0], {
+                'id': self.unnamed_album.id,
+                'etag': etag,
+                'album': None,
+                'fetch_individually': False
+                })
+
+        with self.settings(ALBUM_DETAIL_STREAMING_MIN_PHOTOS=5):
+            details = self.get_details([{'id': self.unnamed_album.id}])
+        self.assertFalse(details['albums'][0]['fetch_individually'])
+        self.assertEqual(details['albums'][0]['album'], album)
+
+    def test_album_details_num_queries(self):
+        known_etags = collections.OrderedDict((album_id, None) for album_id in self.album_ids)
+        with CaptureQueriesContext(connection) as queries:
+            optimized_views.get_album_details_payload(self.amanda, known_etags)
+        # Does not depend on the number of albums
+        self.assertLessEqual(len(queries), 8)
+
+    def test_invalid_request(self):
+        response = self.client.post('/albums/details/', json.dumps({'albums': [{'etag': '1'}]}), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+        albums = [{'id': i} for i in range(optimized_views.MAX_ALBUM_DETAILS + 1)]
+        response = self.client.post('/albums/details/', json.dumps({'albums': albums}), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class NewPhotosCountTest(BaseTestCase):
+    def setUp(self):
+        self.client.login(username='2', password='amanda')
+        self.amanda = User.objects.get(pk=2)
+        self.jackie = User.objects.get(pk=11)
+        self.album = Album.objects.get(pk=9)
+
+        # The fixtures don't have the counts
+        AlbumMember.objects.repair_num_new_photos()
+
+    def add_photo(self, photo_id, author, now):
+        Photo.objects.create(
+                photo_id = photo_id,
+                media_type = Photo.MEDIA_TYPE_PHOTO,
+                client_upload_id = '',
+                storage_id = photo_id,
+                subdomain = 'test-subdomain',
+                date_created = now,
+                author = author,
+                album = self.album,
+                album_index = self.album.allocate_album_indexes())
+        self.album.save_revision(now, True, [AlbumChange(
+            change_type = AlbumChange.CHANGE_PHOTO_ADDED,
+            photo_id = photo_id)])
+
+    def get_num_new_photos(self, user):
+        return AlbumMember.objects.get(user=user, album=self.album).num_new_photos
+
+    def test_num_new_photos(self):
+        now = timezone.now()
+        self.client.post('/albums/9/view/', content_type='application/json', data=json.dumps({
+            'timestamp': now.isoformat()
+        }))
+        self.assertEqual(self.get_num_new_photos(self.amanda), 0)
+        jackie_num_new_photos = self.get_num_new_photos(self.jackie)
+
+        self.add_photo('test-photo-id-1', self.jackie, now + datetime.timedelta(seconds=5))
+        self.add_photo('test-photo-id-2', self.jackie, now + datetime.timedelta(seconds=10))
+        self.add_photo('test-photo-id-3', self.amanda, now + datetime.timedelta(seconds=15))
+
+        self.assertEqual(self.get_num_new_photos(self.amanda), 2)
+        # Photos that the user added are not new for them
+        self.assertEqual(self.get_num_new_photos(self.jackie), jackie_num_new_photos + 1)
+
+        payload = optimized_views.get_album_list_payload(self.amanda.id)
+        album_payload = [a for a in payload if a['id'] == 9][0]
+        self.assertEqual(album_payload['num_new_photos'], 2)
+
+        # Viewing the album in between the two photos
+        self.client.post('/albums/9/view/', content_type='application/json', data=json.dumps({
+            'timestamp': (now + datetime.timedelta(seconds=7)).isoformat()
+        }))
+        self.assertEqual(self.get_num_new_photos(self.amanda), 1)
+
+        Photo.objects.get(pk='test-photo-id-2').delete()
+        self.album.save_revision(timezone.now(), changes=[AlbumChange(
+            change_type = AlbumChange.CHANGE_PHOTO_REMOVED,
+            photo_id = 'test-photo-id-2')])
+        self.assertEqual(self.get_num_new_photos(self.amanda), 0)
+
+        self.assertEqual(AlbumMember.objects.repair_num_new_photos(), 0)
+
+    def test_repair_num_new_photos(self):
+        AlbumMember.objects.filter(user=self.amanda, album=self.album).update(num_new_photos=42)
+
+        self.assertEqual(AlbumMember.objects.repair_num_new_photos(dry_run=True), 1)
+        self.assertEqual(self.get_num_new_photos(self.amanda), 42)
+
+        self.assertEqual(AlbumMember.objects.repair_num_new_photos(), 1)
+        self.assertEqual(self.get_num_new_photos(self.amanda), self.album.photo_set.exclude(author=self.amanda).count())
+        self.assertEqual(AlbumMember.objects.repair_num_new_photos(), 0)
+
+
 class AlbumNameTest(BaseTestCase):
     def setUp(self):
         self.client.login(username='2', password='amanda')
@@ -1252,6 +2007,45 @@ class MembersTests(BaseTestCase):
         barney_status = [m['invite_status'] for m in j3['members'] if m['id'] == barney.id][0]
         self.assertEqual(barney_status, User.STATUS_INVITATION_VIEWED)
 
+    def test_invite_status_changes_album(self):
+        album = Album.objects.get(pk=9)
+        revision_number = album.revision_number
+
+        PhoneNumber.objects.create(
+                phone_number = '+12127184123',
+                user = User.objects.get(pk=11),
+                date_created = timezone.now(),
+                verified = True)
+
+        self.assertEqual(User.objects.get(pk=11).invite_status, User.STATUS_JOINED)
+
+        changes_url = reverse('album-changes', kwargs={'pk': 9})
+        j = json.loads(self.client.get(changes_url, {'since_revision': revision_number}).content)
+        self.assertEqual([m['id'] for m in j['members']], [11])
+        self.assertEqual(j['members'][0]['invite_status'], User.STATUS_JOINED)
+
+        # A status never goes back
+        self.assertFalse(User.objects.advance_invite_status(11, User.STATUS_INVITATION_VIEWED))
+        self.assertEqual(Album.objects.get(pk=9).revision_number, revision_number + 1)
+
+    def test_members_payload_num_queries(self):
+        with self.assertNumQueries(1):
+            members = optimized_views.get_album_members_payload(9)
+        self.assertEqual(len(members), 7)
+
+    def test_rebuild_invite_statuses(self):
+        PhoneNumber.objects.create(
+                phone_number = '+12127184123',
+                user = User.objects.get(pk=11),
+                date_created = timezone.now(),
+                verified = True)
+        User.objects.filter(pk__in=[11, 13]).update(invite_status=User.STATUS_INVITATION_VIEWED)
+
+        self.assertEqual(User.objects.rebuild_invite_statuses(), 2)
+        self.assertEqual(User.objects.get(pk=11).invite_status, User.STATUS_JOINED)
+        self.assertEqual(User.objects.get(pk=13).invite_status, User.STATUS_SMS_SENT)
+        self.assertEqual(User.objects.rebuild_invite_statuses(), 0)
+
     def test_add_members(self):
         album_details_url = reverse('album-detail', kwargs={'pk': 9})
         album_before_response = self.client.get(album_details_url)
@@ -14,6 +14,8 @@ urlpatterns = patterns('',
     url(r'^albums/$', views.Albums.as_view(), name='album-list'),
     url(r'^youtube_upload/(?P<storage_id>[\w-]+)/', views.youtube_upload, name='youtube-upload'),
     url(r'^albums/(?P<pk>\d+)/$', views.AlbumDetail.as_view(), name='album-detail'),
+    url(r'^albums/details/$', views.AlbumDetailsView.as_view(), name='album-details'),
+    url(r'^albums/(?P<pk>\d+)/changes/$', views.AlbumChangesView.as_view(), name='album-changes'),
     url(r'^albums/(?P<pk>\d+)/name/$', views.AlbumNameView.as_view(), name='album-name'),
     url(r'^albums/(?P<pk>\d+)/members/$', views.AlbumMembersView.as_view(), name='album-members'),
     url(r'^albums/(?P<pk>\d+)/members/(?P<user_id>\d+)/phone_number/$', views.AlbumMemberPhoneNumberView.as_view(), name='album-member-phonenumber'),
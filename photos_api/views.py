@@ -1,3 +1,4 @@
+import collections
 import random
 import tempfile
 
@@ -9,15 +10,15 @@ from django.core.files import File
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 from django.contrib import auth
-from django.db.models import Q
+from django.db.models import Max, Q
 from django.db import transaction
 from django.views.decorators.csrf import csrf_exempt
 
 #from django.http import HttpResponseNotModified
-from django.http import Http404
+from django.http import Http404, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
-from phone_auth.signals import user_avatar_changed
+from phone_auth.signals import user_avatar_changed, user_nickname_changed
 from photos_api.permissions import IsUserInAlbum, UserDetailsPagePermission, \
     IsSameUserOrStaff
 from photos_api.parsers import PhotoUploadParser
@@ -27,6 +28,7 @@ from phone_auth.models import AnonymousPhoneNumber, random_default_avatar_file_d
 from photos_api.private_serializers import PhotoObjectSerializer
 from photos_api.signals import photos_added_to_album, member_leave_album
 from photos_api import optimized_views
+from photos_api import streaming
 
 from rest_framework import generics, serializers, mixins
 from rest_framework.decorators import api_view, permission_classes
@@ -53,13 +55,14 @@ from photos_api.serializers import AlbumNameSerializer, AlbumSerializer, \
     AlbumNameChangeSerializer, AlbumMembersSerializer, \
     PhotoCommentSerializer, PhotoUserTagSerializer, PhotoGlanceScoreSerializer, \
     PhotoGlanceSerializer, UserGlanceScoreSerializer, \
-    AlbumMemberPhoneNumberSerializer, YouTubeUploadSerializer
+    AlbumMemberPhoneNumberSerializer, YouTubeUploadSerializer, \
+    AlbumDetailsRequestSerializer
 from photos_api.check_modified import supports_last_modified, supports_etag
 
 import invites_manager
 from photos import photo_operations
 
-from photos.models import UserHiddenPhoto
+from photos.models import UserHiddenPhoto, AlbumChange, PhotoProcessingJob
 
 @api_view(['PUT'])
 # @permission_classes((IsAllowedPrivateAPI, ))
@@ -180,12 +183,34 @@ class AlbumDetail(GenericAPIView):
         return super(AlbumDetail, self).initial(request, pk, *args, **kwargs)
 
     def get_etag(self, request, pk):
-        return self.album.get_etag()
+        etag = optimized_views.get_album_etag(request.user.id, self.album)
+        if 'page_size' in request.GET:
+            # Every page is a different resource
+            return u'{0}-{1}-{2}'.format(etag, request.GET['page_size'], request.GET.get('cursor', ''))
+        return etag
 
     def get(self, request, pk):
-        payload = optimized_views.get_album_detail_payload(request.user, self.album)
+        if 'page_size' in request.GET:
+            try:
+                page_size = int(request.GET['page_size'])
+                if not 1 <= page_size <= optimized_views.MAX_PAGE_SIZE:
+                    raise ValueError('Invalid page_size')
+                payload = optimized_views.get_album_page_payload(request.user, self.album, page_size, request.GET.get('cursor'))
+            except ValueError:
+                return Response(u"Invalid page_size or cursor", status=status.HTTP_400_BAD_REQUEST)
+        elif self.should_stream(request):
+            return StreamingHttpResponse(streaming.iter_album_detail_json(request.user, self.album), content_type='application/json')
+        else:
+            payload = optimized_views.get_album_detail_payload(request.user, self.album)
         return Response(payload, content_type='application/json')
 
+    def should_stream(self, request):
+        # Only plain JSON is streamed (not the browsable API, or indented
+        # JSON)
+        return (optimized_views.is_large_album(self.album) and
+                request.accepted_renderer.format == 'json' and
+                'indent' not in request.accepted_media_type)
+
     def post(self, request, pk):
         serializer = AlbumUpdateSerializer(data=request.DATA)
         if not serializer.is_valid():
@@ -202,6 +227,8 @@ class AlbumDetail(GenericAPIView):
                 return Response(u"Trying to add a Photo that has not yet been uploaded", status=status.HTTP_400_BAD_REQUEST)
             except photo_operations.InvalidPhotoIdAddPhotoException:
                 return Response(u"Trying to add a Photo with an invalid photo_id", status=status.HTTP_400_BAD_REQUEST)
+            except photo_operations.PhotoProcessingFailedAddPhotoException:
+                return Response(u"Trying to add a Photo that could not be processed", status=status.HTTP_400_BAD_REQUEST)
 
             photos_added_to_album.send(sender=self,
                                        photos=photo_ids,
@@ -223,6 +250,45 @@ class AlbumDetail(GenericAPIView):
         return Response(payload, content_type='application/json')
 
 
+class AlbumDetailsView(GenericAPIView):
+    permission_classes = (IsAuthenticated,)
+    serializer_class = AlbumDetailsRequestSerializer
+
+    def post(self, request):
+        serializer = AlbumDetailsRequestSerializer(data=request.DATA)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        albums = serializer.object['albums']
+        if len(albums) > optimized_views.MAX_ALBUM_DETAILS:
+            return Response(u"At most {0} albums can be requested at once".format(optimized_views.MAX_ALBUM_DETAILS), status=status.HTTP_400_BAD_REQUEST)
+
+        known_etags = collections.OrderedDict()
+        for album in albums:
+            known_etags[album['id']] = album.get('etag')
+
+        payload = optimized_views.get_album_details_payload(request.user, known_etags)
+        return Response(payload, content_type='application/json')
+
+
+class AlbumChangesView(GenericAPIView):
+    permission_classes = (IsUserInAlbum,)
+
+    def initial(self, request, pk, *args, **kwargs):
+        self.album = get_object_or_404(Album, pk=pk)
+
+        return super(AlbumChangesView, self).initial(request, pk, *args, **kwargs)
+
+    def get(self, request, pk):
+        try:
+            since_revision_number = int(request.GET['since_revision'])
+        except (KeyError, ValueError):
+            return Response(u"Missing or invalid since_revision", status=status.HTTP_400_BAD_REQUEST)
+
+        payload = optimized_views.get_album_changes_payload(request.user, self.album, since_revision_number)
+        return Response(payload, content_type='application/json')
+
+
 class AlbumNameView(GenericAPIView):
     permission_classes = (IsAuthenticated, IsUserInAlbum)
     serializer_class = AlbumNameChangeSerializer
@@ -302,6 +368,9 @@ class LeaveAlbum(generics.DestroyAPIView):
     def post(self, request, *args, **kwargs):
         album = self.get_object().album
         response = self.delete(request, *args, **kwargs)
+        album.save_revision(timezone.now(), changes=[AlbumChange(
+            change_type = AlbumChange.CHANGE_MEMBER_REMOVED,
+            user_id = request.user.id)])
 
         member_leave_album.send(sender=self, user=request.user, album=album)
 
@@ -347,6 +416,14 @@ class AlbumMemberUser(generics.DestroyAPIView):
             raise Http404(_(u"Album not found"))
         return obj
 
+    def destroy(self, request, *args, **kwargs):
+        member = self.get_object()
+        member.delete()
+        member.album.save_revision(timezone.now(), changes=[AlbumChange(
+            change_type = AlbumChange.CHANGE_MEMBER_REMOVED,
+            user_id = member.user_id)])
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
 
 class ViewAlbum(GenericAPIView):
     permission_classes = (IsAuthenticated, IsUserInAlbum)
@@ -433,6 +510,14 @@ class UserDetail(generics.RetrieveUpdateAPIView):
 
         return super(UserDetail, self).get_queryset()
 
+    def pre_save(self, obj):
+        old_nickname = self.model.objects.filter(pk=obj.pk).values_list('nickname', flat=True).first()
+        self.nickname_changed = obj.nickname != old_nickname
+
+    def post_save(self, obj, created=False):
+        if self.nickname_changed:
+            user_nickname_changed.send(sender=self, user=obj)
+
     def put(self, request, *args, **kwargs):
         """PUT handler"""
         self.__check_update_attr_permissions(request)
@@ -526,25 +611,11 @@ class Albums(GenericAPIView):
     """
     permission_classes = (IsAuthenticated,)
 
-    def initial(self, request, *args, **kwargs):
-        if request.user.is_staff:
-            self.is_staff = True
-            self.albums = Album.objects.all()
-        elif request.user.is_authenticated():
-            self.is_staff = False
-            self.albums = AlbumMember.objects.get_user_memberships(self.request.user.id)
-
-        return super(Albums, self).initial(request, *args, **kwargs)
-
-    # TODO This could use an optimized query
     def last_modified(self, request):
-        if not self.albums:
-            return None
-
-        if self.is_staff:
-            return max([a.last_updated for a in self.albums])
+        if request.user.is_staff:
+            return Album.objects.aggregate(Max('last_updated'))['last_updated__max']
         else:
-            return max([m.album.last_updated for m in self.albums])
+            return request.user.album_list_last_changed
 
     def get(self, request):
         payload = optimized_views.get_album_list_payload(request.user.id)
@@ -602,10 +673,13 @@ class DeletePhotosView(mixins.DestroyModelMixin, generics.MultipleObjectAPIView)
                 photo.author.increment_user_glance_score(-3)
 
                 album = photo.album or None
+                photo_id = photo.photo_id
                 photo.delete()
 
                 # Save album revision, because we deleted photo from it.
-                album.save_revision(timezone.now())
+                album.save_revision(timezone.now(), changes=[AlbumChange(
+                    change_type = AlbumChange.CHANGE_PHOTO_REMOVED,
+                    photo_id = photo_id)])
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -674,6 +748,31 @@ class PhotoUpload(views.APIView):
 
         return Response()
 
+    def get(self, request, photo_id, format=None):
+        try:
+            pending_photo = PendingPhoto.objects.get(pk=photo_id)
+        except PendingPhoto.DoesNotExist:
+            photo = get_object_or_404(Photo, pk=photo_id)
+            if photo.author != request.user:
+                return Response(status=403)
+            uploaded = True
+            processing_done = True
+            processing_failed = False
+        else:
+            if pending_photo.author != request.user:
+                return Response(status=403)
+            uploaded = pending_photo.is_file_uploaded()
+            processing_done = pending_photo.is_processing_done()
+            processing_failed = PhotoProcessingJob.objects.filter(
+                    storage_id=pending_photo.storage_id, date_failed__isnull=False).exists()
+
+        return Response({
+            'photo_id': photo_id,
+            'uploaded': uploaded,
+            'processing_done': processing_done,
+            'processing_failed': processing_failed
+            })
+
     def post(self, request, photo_id, format=None):
         return self.process_upload_request(request, photo_id,
                                            request.FILES['photo'].chunks())
@@ -94,6 +94,83 @@ MIDDLEWARE_CLASSES = (
 
 USING_LOCAL_PHOTOS = True
 
+# Number of worker processes used for encoding the resized versions of an
+# uploaded photo (only relevant when USING_LOCAL_PHOTOS). A value of 1 encodes
+# them serially in the calling process
+PHOTO_PROCESSING_NUM_WORKERS = 1
+
+# Decode uploaded JPEGs at the smallest scale that is still large enough for
+# all of the resized versions, instead of at full resolution
+PHOTO_PROCESSING_FAST_DECODE = True
+
+# When True, only the PHOTO_PROCESSING_HOT_SIZES are created when a photo is
+# uploaded. All of the other sizes are rendered when they are first requested,
+# and are kept in PHOTO_RENDER_CACHE_DIRECTORY (by default a "render_cache"
+# subdirectory of LOCAL_PHOTOS_DIRECTORY). The least recently used files are
+# deleted when the cache grows larger than PHOTO_RENDER_CACHE_MAX_BYTES
+PHOTO_PROCESSING_LAZY = False
+PHOTO_PROCESSING_HOT_SIZES = ('thumb75', 'crop140', 'r_qvga')
+PHOTO_RENDER_CACHE_DIRECTORY = None
+PHOTO_RENDER_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# When True, uploaded photos (when USING_LOCAL_PHOTOS) are not processed
+# during the upload request. Instead a PhotoProcessingJob is queued, which is
+# run by the "process_photo_jobs" management command. A job that was started
+# more than PHOTO_PROCESSING_JOB_TIMEOUT seconds ago is assumed to have
+# crashed, and will be run again. After PHOTO_PROCESSING_JOB_MAX_ATTEMPTS
+# attempts the job is marked as failed
+PHOTO_PROCESSING_ASYNC = False
+PHOTO_PROCESSING_JOB_TIMEOUT = 300
+PHOTO_PROCESSING_JOB_MAX_ATTEMPTS = 3
+
+# Requests that add photos to an album wait for their processing jobs to be
+# finished by the workers. With PostgreSQL the workers notify the waiting
+# requests, otherwise (and in case a notification was missed) the jobs are
+# checked again every PHOTO_PROCESSING_WAIT_CHECK_INTERVAL seconds
+PHOTO_PROCESSING_WAIT_CHECK_INTERVAL = 1.0
+
+# Album actions that need their own database connection (see
+# photos.worker_pool) are run on a pool of this many threads per process. When
+# ACTION_POOL_MAX_QUEUE_SIZE actions are already waiting, a new action waits up
+# to ACTION_POOL_SUBMIT_TIMEOUT seconds for room in the queue before failing
+ACTION_POOL_NUM_THREADS = 4
+ACTION_POOL_MAX_QUEUE_SIZE = 100
+ACTION_POOL_SUBMIT_TIMEOUT = 5
+
+# Changes to the photos are delivered to the photo servers from the
+# PhotoServerChange log by "manage.py dispatch_photo_server_changes", in
+# batches of PHOTO_SERVER_SYNC_CHUNK_SIZE (a newly registered photo server is
+# also sent the photos of its subdomain in chunks of this size). Changes that
+# are less than PHOTO_SERVER_CHANGE_SETTLE_TIME seconds old may still be
+# followed by changes with smaller ids from transactions that are still
+# running, so they are not acknowledged yet.
+#
+# When PHOTO_SERVER_IMMEDIATE_UPDATES is set, new photos are also sent right
+# away, concurrently to all of the servers, from a pool of
+# PHOTO_SERVER_NUM_THREADS threads per process. Each request times out after
+# PHOTO_SERVER_TIMEOUT seconds. After PHOTO_SERVER_CIRCUIT_BREAKER_THRESHOLD
+# consecutive failures, no requests are sent to a server for
+# PHOTO_SERVER_CIRCUIT_BREAKER_COOLDOWN seconds. See photos.photo_servers
+PHOTO_SERVER_SYNC_CHUNK_SIZE = 1000
+PHOTO_SERVER_CHANGE_SETTLE_TIME = 60
+PHOTO_SERVER_IMMEDIATE_UPDATES = True
+PHOTO_SERVER_NUM_THREADS = 8
+PHOTO_SERVER_MAX_QUEUE_SIZE = 1000
+PHOTO_SERVER_TIMEOUT = 5
+PHOTO_SERVER_CIRCUIT_BREAKER_THRESHOLD = 3
+PHOTO_SERVER_CIRCUIT_BREAKER_COOLDOWN = 30
+
+# The part of the album detail payloads that is the same for all of the members
+# is cached in every process, by the album revision. The least recently used
+# payloads are evicted when the cached payloads (as JSON) are larger than this.
+# Set to 0 to disable the cache
+ALBUM_PAYLOAD_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# The details of albums with at least this many photos are streamed a page of
+# photos at a time, instead of being built in memory (and they are not
+# cached). Set to 0 to never stream
+ALBUM_DETAIL_STREAMING_MIN_PHOTOS = 2000
+
 ALL_PHOTO_SUBDOMAINS = (
     'photos01',
     'photos02',
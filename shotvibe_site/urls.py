@@ -25,6 +25,9 @@ urlpatterns = patterns('',
     url(r'^slideshow/', include(slideshow.urls)),
 
     url(r'^admin/processed_photos/', 'photos.views.processed_photos'),
+    url(r'^admin/action_pool_status/', 'photos.views.action_pool_status'),
+    url(r'^admin/album_payload_cache_status/', 'photos.views.album_payload_cache_status'),
+    url(r'^admin/conditional_response_status/', 'photos.views.conditional_response_status'),
     url(r'^admin/upp_status/', 'photos_api.device_push.upp_status'),
 
     # Uncomment the next line to enable the admin:
@@ -76,6 +79,8 @@ if settings.USING_LOCAL_PHOTOS:
         from django.views.static import serve
 
         from photos.models import Photo
+        from photos import image_uploads
+        from photos import render_cache
 
         photo_id, suffix = parse_filename(photo_filename)
 
@@ -84,6 +89,17 @@ if settings.USING_LOCAL_PHOTOS:
         if photo.subdomain != subdomain:
             return HttpResponseNotFound()
 
+        # Resized versions that were not created during upload are rendered
+        # on demand
+        if suffix.startswith('_') and suffix.endswith('.jpg'):
+            image_size_str = suffix[1:-len('.jpg')]
+            if image_size_str in image_uploads.image_sizes:
+                result = render_cache.find_or_render(photo.storage_id, image_size_str)
+                if result is None:
+                    return HttpResponseNotFound()
+                directory, filename = result
+                return serve(request, filename, directory)
+
         return serve(request, photo.storage_id + suffix, settings.LOCAL_PHOTOS_DIRECTORY)
 
     urlpatterns += (
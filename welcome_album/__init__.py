@@ -1,8 +1,8 @@
 from django.conf import settings
 from django.db import transaction
-import django.db
 
 from photos import photo_operations
+from photos import worker_pool
 from photos.models import Album
 from welcome_album.models import ScheduledWelcomeAlbumJob
 
@@ -13,31 +13,16 @@ def create_welcome_album(new_user, current_time):
 
     now = current_time
 
-    class CreateAlbumAction(photo_operations.ExThread):
-        def run_with_exception(self):
-            try:
-                self.perform_action()
-            finally:
-                django.db.close_old_connections()
-
-        def perform_action(self):
-            with transaction.atomic():
-                self.new_album = Album.objects.create_album(template_album.creator, template_album.name, now)
-                with self.new_album.modify(now) as m:
-                    m.add_user_id(template_album.creator, new_user.id)
-
-    action = CreateAlbumAction()
-    # TODO This is only current needed to make tests work with sqlite
-    # See this bug:
-    #     https://code.djangoproject.com/ticket/12118
-    if settings.USING_LOCAL_PHOTOS:
-        action.perform_action()
-    else:
-        action.daemon = False
-        action.start()
-        action.join_with_exception()
-
-    photo_operations.copy_photos_to_album(template_album.creator, photo_ids, action.new_album.id, now)
+    def create_album():
+        with transaction.atomic():
+            new_album = Album.objects.create_album(template_album.creator, template_album.name, now)
+            with new_album.modify(now) as m:
+                m.add_user_id(template_album.creator, new_user.id)
+        return new_album
+
+    new_album = worker_pool.run_action(create_album)
+
+    photo_operations.copy_photos_to_album(template_album.creator, photo_ids, new_album.id, now)
 
 
 def process_scheduled_jobs(current_time):